@@ -0,0 +1,638 @@
+#!/usr/bin/env python3
+"""
+Benchmark offline cho YT Backend - không cần mạng.
+
+- upstream: HTTP server giả lập googlevideo (Range, giới hạn băng thông mỗi connection,
+  403 khi URL hết hạn, HLS playlist + segment) và /api/streams của go2rtc
+- serve: chạy app.py với yt_dlp.YoutubeDL thay bằng fixture trong bench/fixtures
+- run (mặc định): khởi động hai process trên, bắn tải vào /proxy, /proxy?token=,
+  /proxy_m3u8, /search, /search_list, /play_on_go2rtc với concurrency tuỳ chọn và in kết quả JSON:
+  throughput, p50/p99 TTFB + latency, CPU mỗi MB relay, peak RSS của process backend
+
+    python bench/bench.py --concurrency 8 --requests 200 --output before.json
+    python bench/bench.py --concurrency 8 --requests 200 --compare before.json
+
+Env của process backend được giữ nguyên (trừ API_KEY, PORT, EXTRACT_WORKERS, RANGE_CACHE_DIR,
+QUERY_INDEX_PATH, THUMB_CACHE_DIR, TOKEN_SECRET_PATH, GO2RTC_URL),
+nên có thể so sánh cấu hình, ví dụ RANGE_CACHE_MAX_MB=0 python bench/bench.py ...
+"""
+import argparse
+import http.client
+import itertools
+import json
+import math
+import os
+import platform
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from glob import glob
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+APP_DIR = os.path.join(REPO_DIR, "yt_youtube_backend")
+FIXTURES_DIR = os.path.join(BENCH_DIR, "fixtures")
+API_KEY = "bench"
+SCENARIOS = ("proxy", "proxy_video", "proxy_token", "proxy_m3u8", "search", "search_list", "play_on_go2rtc")
+
+
+# ======================
+# UPSTREAM - googlevideo + go2rtc API giả lập
+# ======================
+
+BLOCK = bytes(range(256)) * 256  # 64 KB, nội dung media lặp lại theo offset
+_EXPIRE_RE = re.compile(r'[?&/]expire[=/](\d+)')
+_SEGMENT_RE = re.compile(r'/api/manifest/hls_playlist/.*/itag/\d+/seg/(\d+)\.ts$')
+_PLAYLIST_RE = re.compile(r'/api/manifest/hls_playlist/.*/itag/\d+/index\.m3u8$')
+
+
+def media_bytes(start, length):
+    """length byte của media bắt đầu tại offset start (cùng offset -> cùng nội dung)"""
+    out = bytearray()
+    while len(out) < length:
+        offset = (start + len(out)) % len(BLOCK)
+        out += BLOCK[offset:offset + length - len(out)]
+    return bytes(out)
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    bandwidth = 0  # byte/s mỗi connection, 0 = không giới hạn
+    segments = 10
+    segment_size = 256 * 1024
+    streams = {}  # go2rtc: name -> source
+    streams_lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        parsed = urlsplit(self.path)
+        params = parse_qs(parsed.query)
+        if parsed.path == "/api/streams":
+            with self.streams_lock:
+                streams = {name: {"producers": [{"url": src}]} for name, src in self.streams.items()}
+            return self.send_json(streams)
+        match = _EXPIRE_RE.search(self.path)
+        if match and int(match.group(1)) < time.time():
+            return self.send_empty(403)
+
+        if parsed.path == "/videoplayback":
+            mime = params.get("mime", ["application/octet-stream"])[0]
+            return self.send_media(int(params["clen"][0]), mime)
+        if _SEGMENT_RE.search(parsed.path):
+            return self.send_media(self.segment_size, "video/mp2t")
+        if _PLAYLIST_RE.search(parsed.path):
+            return self.send_playlist()
+        return self.send_empty(404)
+
+    def do_PATCH(self):
+        parsed = urlsplit(self.path)
+        params = parse_qs(parsed.query)
+        if parsed.path != "/api/streams" or "src" not in params:
+            return self.send_empty(400)
+        with self.streams_lock:
+            self.streams[params.get("name", params["src"])[0]] = params["src"][0]
+        return self.send_empty(200)
+
+    def send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_playlist(self):
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:5", "#EXT-X-MEDIA-SEQUENCE:0"]
+        for n in range(self.segments):
+            lines += ["#EXTINF:5.0,", f"seg/{n}.ts"]
+        lines.append("#EXT-X-ENDLIST")
+        body = ("\n".join(lines) + "\n").encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.apple.mpegurl")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_media(self, size, content_type):
+        start, end, status = 0, size - 1, 200
+        match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get("Range", ""))
+        if match:
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(size - int(match.group(2)), 0)
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+
+        began = time.perf_counter()
+        sent = 0
+        try:
+            while start + sent <= end:
+                length = min(len(BLOCK), end - start - sent + 1)
+                self.wfile.write(media_bytes(start + sent, length))
+                sent += length
+                if self.bandwidth:
+                    ahead = sent / self.bandwidth - (time.perf_counter() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+
+def run_upstream(args):
+    UpstreamHandler.bandwidth = args.bandwidth_kb * 1024
+    UpstreamHandler.segments = args.segments
+    UpstreamHandler.segment_size = args.segment_kb * 1024
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), UpstreamHandler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+# ======================
+# SERVE - app.py với extractor giả
+# ======================
+
+def load_fixtures(directory=FIXTURES_DIR):
+    fixtures = []
+    for path in sorted(glob(os.path.join(directory, "*.json"))):
+        with open(path) as f:
+            fixtures.append(json.load(f))
+    return fixtures
+
+
+class FakeYoutubeDL:
+    """Thay yt_dlp.YoutubeDL: trả info từ fixture, URL trỏ về upstream giả"""
+
+    fixtures = []
+    base = ""
+    delay = 0.0
+    expire_after = 6 * 3600
+
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def close(self):
+        pass
+
+    def sanitize_info(self, info):
+        return info
+
+    def extract_info(self, query, download=False, **kwargs):
+        time.sleep(self.delay)  # thời gian yt-dlp thật gọi YouTube
+        fixture = next((f for f in self.fixtures if f["id"] in query), None)
+        if fixture is None:
+            fixture = self.fixtures[zlib.crc32(query.encode()) % len(self.fixtures)]
+        text = json.dumps(fixture)
+        text = text.replace("{base}", self.base).replace("{expire}", str(int(time.time() + self.expire_after)))
+        info = json.loads(text)
+        if query.startswith(("http://", "https://")):
+            return info
+        match = re.match(r"ytsearch(\d*):", query)
+        count = int(match.group(1) or 1) if match else 1
+        if count == 1 and not self.params.get("extract_flat"):
+            return {"_type": "playlist", "id": query, "entries": [info]}
+        # Flat search: chỉ metadata, không formats
+        start = self.fixtures.index(fixture)
+        entries = []
+        for i in range(count):
+            f = self.fixtures[(start + i) % len(self.fixtures)]
+            entries.append({"_type": "url", "ie_key": "Youtube", "id": f["id"], "title": f.get("title"),
+                            "channel": f.get("channel"), "duration": f.get("duration")})
+        return {"_type": "playlist", "id": query, "entries": entries}
+
+
+def run_serve(args):
+    FakeYoutubeDL.fixtures = load_fixtures(args.fixtures)
+    FakeYoutubeDL.base = args.upstream
+    FakeYoutubeDL.delay = args.extract_delay
+    FakeYoutubeDL.expire_after = args.expire_after
+
+    import yt_dlp
+    yt_dlp.YoutubeDL = FakeYoutubeDL
+
+    sys.path.insert(0, APP_DIR)
+    import app
+
+    def write_url_files(video_url, audio_url):
+        # GO2RTC_HANDOFF=files: /config của HA không có ở đây, ghi vào thư mục tạm
+        for name, url in (("youtube_url.txt", video_url), ("youtube_audio_url.txt", audio_url)):
+            with open(os.path.join(args.config_dir, name), "w") as f:
+                f.write(url)
+
+    app.write_url_files = write_url_files
+
+    if args.mode == "asgi":
+        import uvicorn
+        uvicorn.run(app.make_asgi_app(), host="127.0.0.1", port=args.port, log_level="warning")
+    else:
+        app.app.run(host="127.0.0.1", port=args.port, threaded=True, debug=False)
+
+
+# ======================
+# RUN - tạo tải và đo
+# ======================
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_port(port, proc, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"process exited with {proc.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"port {port} not ready after {timeout}s")
+
+
+def fetch(conn, method, path, body=None):
+    """Một request: (status, ttfb, latency, số byte body, body nếu nhỏ)"""
+    headers = {"X-API-Key": API_KEY}
+    if body is not None:
+        body = json.dumps(body).encode()
+        headers["Content-Type"] = "application/json"
+    started = time.perf_counter()
+    conn.request(method, path, body=body, headers=headers)
+    resp = conn.getresponse()
+    first = resp.read1(65536)
+    ttfb = time.perf_counter() - started
+    size = len(first)
+    kept = [first]
+    while True:
+        chunk = resp.read(65536)  # read() (khác read1) đóng response khi hết body -> connection tái sử dụng được
+        if not chunk:
+            break
+        size += len(chunk)
+        if size <= 1 << 20:
+            kept.append(chunk)
+    latency = time.perf_counter() - started
+    return resp.status, ttfb, latency, size, b"".join(kept) if size <= 1 << 20 else None
+
+
+def ok(status):
+    return 200 <= status < 400
+
+
+class Backend:
+    def __init__(self, port):
+        self.port = port
+
+    def connect(self):
+        return http.client.HTTPConnection("127.0.0.1", self.port, timeout=120)
+
+    def call(self, method, path, body=None):
+        conn = self.connect()
+        try:
+            status, _, _, _, data = fetch(conn, method, path, body)
+        finally:
+            conn.close()
+        if not ok(status):
+            raise RuntimeError(f"{method} {path} -> {status}")
+        return json.loads(data)
+
+
+def build_scenarios(backend, fixtures, queries):
+    """op(conn, i) -> (ok, ttfb, latency, bytes) cho từng scenario"""
+    resolved = [backend.call("POST", "/resolve", {"query": f"https://www.youtube.com/watch?v={f['id']}"})
+                for f in fixtures]
+
+    def get(path_of):
+        def op(conn, i):
+            status, ttfb, latency, size, _ = fetch(conn, "GET", path_of(i))
+            return ok(status), ttfb, latency, size
+        return op
+
+    def hls(conn, i):
+        status, ttfb, latency, size, data = fetch(conn, "GET", resolved[i % len(resolved)]["hls"]["proxy_url"])
+        if not ok(status):
+            return False, ttfb, latency, size
+        started = time.perf_counter() - latency
+        for line in data.decode().splitlines():
+            if line and not line.startswith("#"):
+                status, _, _, seg_size, _ = fetch(conn, "GET", line)
+                size += seg_size
+                if not ok(status):
+                    return False, ttfb, time.perf_counter() - started, size
+        return True, ttfb, time.perf_counter() - started, size
+
+    def post(path):
+        def op(conn, i):
+            status, ttfb, latency, size, data = fetch(conn, "POST", path, {"query": f"bench query {i % queries}"})
+            return ok(status) and json.loads(data).get("success", True), ttfb, latency, size
+        return op
+
+    return {
+        "proxy": get(lambda i: resolved[i % len(resolved)]["audio"]["proxy_url"]),
+        "proxy_video": get(lambda i: resolved[i % len(resolved)]["video"]["proxy_url"]),
+        "proxy_token": get(lambda i: resolved[i % len(resolved)]["audio"]["token_url"]),
+        "proxy_m3u8": hls,
+        "search": post("/search"),
+        "search_list": post("/search_list"),
+        "play_on_go2rtc": post("/play_on_go2rtc"),
+    }
+
+
+def read_rss(pid):
+    """(VmHWM, VmRSS) MB của process backend, None nếu không có /proc"""
+    values = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmHWM", "VmRSS"):
+                    values[key] = int(value.split()[0]) / 1024
+    except OSError:
+        return None, None
+    return values.get("VmHWM"), values.get("VmRSS")
+
+
+def read_cpu(pid):
+    """CPU time (user + system, giây) của process backend, None nếu không có /proc"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rpartition(")")[2].split()
+    except OSError:
+        return None
+    # Sau "(comm)": state là field 3, utime / stime là field 14 / 15
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def reset_peak_rss(pid):
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as f:
+            f.write("5")  # reset VmHWM về RSS hiện tại (Linux >= 4.0)
+    except OSError:
+        pass
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(math.ceil(p / 100 * len(ordered)) - 1, 0))]
+
+
+def summarize(samples, errors, elapsed, concurrency):
+    ttfb = [s[0] * 1000 for s in samples]
+    latency = [s[1] * 1000 for s in samples]
+    total_bytes = sum(s[2] for s in samples)
+
+    def ms(value):
+        return round(value, 2) if value is not None else None
+
+    return {
+        "requests": len(samples) + errors,
+        "errors": errors,
+        "concurrency": concurrency,
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(len(samples) / elapsed, 2) if elapsed else None,
+        "throughput_mb_s": round(total_bytes / elapsed / 1048576, 2) if elapsed else None,
+        "bytes": total_bytes,
+        "ttfb_ms": {"p50": ms(percentile(ttfb, 50)), "p99": ms(percentile(ttfb, 99))},
+        "latency_ms": {"p50": ms(percentile(latency, 50)), "p99": ms(percentile(latency, 99))},
+    }
+
+
+def run_scenario(backend, op, concurrency, total):
+    counter = itertools.count()
+    samples = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker():
+        conn = None
+        while True:
+            i = next(counter)
+            if i >= total:
+                break
+            conn = conn or backend.connect()
+            try:
+                success, ttfb, latency, size = op(conn, i)
+            except (OSError, http.client.HTTPException, ValueError):
+                success = False
+                conn.close()
+                conn = None
+            with lock:
+                if success:
+                    samples.append((ttfb, latency, size))
+                else:
+                    errors[0] += 1
+        if conn:
+            conn.close()
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return summarize(samples, errors[0], time.perf_counter() - started, concurrency)
+
+
+def git_version():
+    try:
+        rev = subprocess.run(["git", "-C", REPO_DIR, "describe", "--always", "--dirty"],
+                             capture_output=True, text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        rev = ""
+    return rev or None
+
+
+def compare(old, new):
+    """Bảng so sánh với kết quả cũ (stderr, stdout giữ JSON)"""
+    rows = [("throughput_mb_s",), ("requests_per_s",), ("ttfb_ms", "p50"), ("ttfb_ms", "p99"),
+            ("latency_ms", "p50"), ("latency_ms", "p99"), ("cpu_ms_per_mb",), ("peak_rss_mb",)]
+    print(f"compare {old['meta'].get('version')} -> {new['meta'].get('version')}", file=sys.stderr)
+    for name, result in new["scenarios"].items():
+        before = old.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        for row in rows:
+            a, b = before, result
+            for key in row:
+                a, b = (a or {}).get(key), (b or {}).get(key)
+            if a is None or b is None:
+                continue
+            delta = f"{(b - a) / a * 100:+.1f}%" if a else "n/a"
+            print(f"  {name:15} {'.'.join(row):16} {a:>10} -> {b:>10}  {delta}", file=sys.stderr)
+
+
+def run(args):
+    names = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"unknown scenario: {', '.join(sorted(unknown))}")
+
+    workdir = tempfile.mkdtemp(prefix="ytb-bench-")
+    upstream_port, backend_port = free_port(), free_port()
+    script = os.path.abspath(__file__)
+    log = open(os.path.join(workdir, "backend.log"), "w")
+    procs = []
+    try:
+        upstream = subprocess.Popen([
+            sys.executable, script, "upstream", "--port", str(upstream_port),
+            "--bandwidth-kb", str(args.bandwidth_kb), "--segments", str(args.segments),
+            "--segment-kb", str(args.segment_kb),
+        ])
+        procs.append(upstream)
+        env = dict(os.environ, API_KEY=API_KEY, PORT=str(backend_port), EXTRACT_WORKERS="0",
+                   RANGE_CACHE_DIR=os.path.join(workdir, "range_cache"),
+                   QUERY_INDEX_PATH=os.path.join(workdir, "query_index.db"),
+                   THUMB_CACHE_DIR=os.path.join(workdir, "thumb_cache"),
+                   TOKEN_SECRET_PATH=os.path.join(workdir, "token_secret"),
+                   GO2RTC_URL=f"http://127.0.0.1:{upstream_port}")
+        # Đo handoff qua /api/streams của upstream giả (mặc định của add-on là files)
+        env.setdefault("GO2RTC_HANDOFF", "api")
+        backend_proc = subprocess.Popen([
+            sys.executable, script, "serve", "--port", str(backend_port), "--mode", args.mode,
+            "--upstream", f"http://127.0.0.1:{upstream_port}", "--fixtures", args.fixtures,
+            "--extract-delay", str(args.extract_delay), "--expire-after", str(args.expire_after),
+            "--config-dir", workdir,
+        ], env=env, stdout=log, stderr=subprocess.STDOUT)
+        procs.append(backend_proc)
+        wait_port(upstream_port, upstream)
+        wait_port(backend_port, backend_proc)
+
+        backend = Backend(backend_port)
+        scenarios = build_scenarios(backend, load_fixtures(args.fixtures), args.queries)
+        results = {}
+        for name in names:
+            reset_peak_rss(backend_proc.pid)
+            cpu = read_cpu(backend_proc.pid)
+            result = run_scenario(backend, scenarios[name], args.concurrency, args.requests)
+            if cpu is not None:
+                cpu = read_cpu(backend_proc.pid) - cpu
+                result["cpu_s"] = round(cpu, 2)
+                result["cpu_ms_per_mb"] = round(cpu * 1000 / (result["bytes"] / 1048576), 2) if result["bytes"] else None
+            peak, current = read_rss(backend_proc.pid)
+            result["peak_rss_mb"] = round(peak, 1) if peak else None
+            result["rss_mb"] = round(current, 1) if current else None
+            results[name] = result
+            print(f"{name}: {result['requests_per_s']} req/s, {result['throughput_mb_s']} MB/s, "
+                  f"ttfb p50 {result['ttfb_ms']['p50']} ms, cpu {result.get('cpu_ms_per_mb')} ms/MB, "
+                  f"errors {result['errors']}", file=sys.stderr)
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        log.close()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    peaks = [r["peak_rss_mb"] for r in results.values() if r["peak_rss_mb"]]
+    report = {
+        "meta": {
+            "version": git_version(),
+            "timestamp": int(time.time()),
+            "python": platform.python_version(),
+            "mode": args.mode,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "bandwidth_kb": args.bandwidth_kb,
+            "extract_delay": args.extract_delay,
+            "expire_after": args.expire_after,
+        },
+        "peak_rss_mb": max(peaks) if peaks else None,
+        "scenarios": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark cho YT Backend")
+    sub = parser.add_subparsers(dest="command")
+
+    def upstream_args(p):
+        p.add_argument("--bandwidth-kb", type=int, default=8192, help="KB/s mỗi connection upstream, 0 = không giới hạn")
+        p.add_argument("--segments", type=int, default=10, help="Số segment mỗi HLS playlist")
+        p.add_argument("--segment-kb", type=int, default=256, help="Kích thước mỗi HLS segment")
+
+    def serve_args(p):
+        p.add_argument("--mode", choices=("asgi", "flask"), default=os.getenv("SERVER_MODE", "asgi"))
+        p.add_argument("--fixtures", default=FIXTURES_DIR, help="Thư mục info fixture (*.json)")
+        p.add_argument("--extract-delay", type=float, default=0.3, help="Giây giả lập mỗi lần extract_info")
+        p.add_argument("--expire-after", type=int, default=6 * 3600,
+                       help="Tuổi thọ (giây) của URL giả; hết hạn -> upstream trả 403")
+
+    run_parser = sub.add_parser("run", help="Chạy benchmark (mặc định)")
+    upstream_args(run_parser)
+    serve_args(run_parser)
+    run_parser.add_argument("--concurrency", type=int, default=4)
+    run_parser.add_argument("--requests", type=int, default=100, help="Số request mỗi scenario")
+    run_parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    run_parser.add_argument("--queries", type=int, default=20, help="Số query khác nhau cho /search, /search_list, /play_on_go2rtc")
+    run_parser.add_argument("--output", help="Ghi kết quả JSON ra file")
+    run_parser.add_argument("--compare", help="So sánh với file kết quả trước đó")
+    run_parser.add_argument("--keep", action="store_true", help="Giữ thư mục tạm (backend.log, range cache)")
+
+    upstream_parser = sub.add_parser("upstream", help="Chỉ chạy googlevideo giả lập")
+    upstream_parser.add_argument("--port", type=int, required=True)
+    upstream_args(upstream_parser)
+
+    serve_parser = sub.add_parser("serve", help="Chỉ chạy backend với extractor giả")
+    serve_parser.add_argument("--port", type=int, required=True)
+    serve_parser.add_argument("--upstream", required=True, help="Base URL của upstream giả")
+    serve_parser.add_argument("--config-dir", default=tempfile.gettempdir())
+    serve_args(serve_parser)
+
+    argv = sys.argv[1:]
+    if not argv or argv[0] not in ("run", "upstream", "serve", "-h", "--help"):
+        argv = ["run"] + argv
+    args = parser.parse_args(argv)
+    {"run": run, "upstream": run_upstream, "serve": run_serve}[args.command](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+# Cache / index trên disk trỏ vào thư mục tạm, không spawn worker khi import app.py
+_tmp = tempfile.mkdtemp(prefix="ytb-tests-")
+os.environ.update(
+    RANGE_CACHE_MAX_MB="0",
+    RANGE_CACHE_DIR=os.path.join(_tmp, "range_cache"),
+    THUMB_CACHE_DIR=os.path.join(_tmp, "thumb_cache"),
+    QUERY_INDEX_PATH="",
+    TOKEN_SECRET_PATH=os.path.join(_tmp, "token_secret"),
+    EXTRACT_WORKERS="0",
+)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "yt_youtube_backend"))
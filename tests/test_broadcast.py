@@ -0,0 +1,89 @@
+import os
+import threading
+import time
+
+import app
+
+
+def run_listener(listener, pace, chunk, out):
+    view = memoryview(bytearray(chunk))
+    data = bytearray()
+    while True:
+        n = listener.readinto(view)
+        if not n:
+            break
+        data += view[:n]
+        time.sleep(pace)
+    out.append(bytes(data))
+
+
+def start_broadcast(monkeypatch, media, capacity, timeout):
+    """Hub với upstream giả (nhanh hơn mọi listener), đếm số lần mở upstream / fallback"""
+    monkeypatch.setattr(app, "BROADCAST_SLOW_TIMEOUT", timeout)
+    calls = {"upstream": 0, "fallback": 0}
+
+    def open_upstream(url, headers, start=0):
+        calls["upstream"] += 1
+
+        def chunks():
+            for pos in range(start, len(media), 8192):
+                yield media[pos:pos + 8192]
+
+        return chunks(), len(media), "audio/webm"
+
+    def iter_upstream_range(url, headers, start, end):
+        calls["fallback"] += 1
+        return iter([media[start:end + 1]])
+
+    monkeypatch.setattr(app, "open_upstream", open_upstream)
+    monkeypatch.setattr(app, "iter_upstream_range", iter_upstream_range)
+    hub = app.BroadcastHub(capacity)
+    release = hub.track("media")
+    return hub, release, calls
+
+
+def test_paced_listeners_share_one_upstream_fetch(monkeypatch):
+    media = os.urandom(192 * 1024)
+    # Listener đọc ~80 KB/s: chậm hơn upstream và chậm hơn unit / timeout của cách chờ cũ
+    hub, release, calls = start_broadcast(monkeypatch, media, 64 * 1024, 0.1)
+    listeners = [hub.listen("media", "http://upstream/media", {}, 0, None)]
+    listeners += [hub.listen("media", "http://upstream/media", {}, 0, None, create=False) for _ in range(2)]
+    assert all(listeners)
+
+    out = []
+    threads = [threading.Thread(target=run_listener, args=(l, 0.05, 4096, out)) for l in listeners]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(30)
+    release()
+
+    assert out == [media] * 3
+    assert calls == {"upstream": 1, "fallback": 0}
+    assert hub.stats()["evicted"] == 0
+
+
+def test_stalled_listener_is_evicted_alone(monkeypatch):
+    media = os.urandom(128 * 1024)
+    hub, release, calls = start_broadcast(monkeypatch, media, 32 * 1024, 0.2)
+    listeners = [hub.listen("media", "http://upstream/media", {}, 0, None)]
+    listeners += [hub.listen("media", "http://upstream/media", {}, 0, None, create=False) for _ in range(2)]
+    stalled = hub.listen("media", "http://upstream/media", {}, 0, None, create=False)
+
+    out = []
+    threads = [threading.Thread(target=run_listener, args=(l, 0.002, 4096, out)) for l in listeners]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(30)
+
+    assert out == [media] * 3
+    assert calls["upstream"] == 1
+    assert hub.stats()["evicted"] == 1
+
+    # Listener bị tách đọc tiếp phần còn lại bằng một fetch riêng
+    rest = []
+    run_listener(stalled, 0, 65536, rest)
+    release()
+    assert rest == [media]
+    assert calls["fallback"] == 1
@@ -0,0 +1,84 @@
+import os
+import signal
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import app
+
+YDL_OPTS = {"quiet": True, "skip_download": True, "noplaylist": True, "socket_timeout": 30}
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    """Direct link: generic extractor của yt-dlp trả về info ngay, không cần mạng ngoài"""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/mp4")
+        self.send_header("Content-Length", "4")
+        self.end_headers()
+        self.wfile.write(b"\0\0\0\0")
+
+    do_HEAD = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def servers():
+    media = ThreadingHTTPServer(("127.0.0.1", 0), MediaHandler)
+    threading.Thread(target=media.serve_forever, daemon=True).start()
+    # Nhận connection nhưng không bao giờ trả lời: extraction treo tới khi bị kill
+    hang = socket.socket()
+    hang.bind(("127.0.0.1", 0))
+    hang.listen(8)
+    yield f"http://127.0.0.1:{media.server_port}/a.m4a", f"http://127.0.0.1:{hang.getsockname()[1]}/b.m4a"
+    media.shutdown()
+    hang.close()
+
+
+def test_worker_timeout_and_kill_are_recovered(servers):
+    ok_url, hang_url = servers
+    pool = app.ExtractionPool(1, 2, 60, {"test": YDL_OPTS})
+
+    # Worker process thật (spawn): lần đầu gồm cả thời gian import yt_dlp
+    assert pool.extract("test", YDL_OPTS, ok_url)["url"] == ok_url
+    first_pid = pool.stats()["pids"][0]
+
+    # Job treo quá timeout: ExtractionTimeout, worker bị kill và spawn lại
+    pool.timeout = 2
+    with pytest.raises(app.ExtractionTimeout):
+        pool.extract("test", YDL_OPTS, hang_url)
+    pool.timeout = 60
+    assert pool.extract("test", YDL_OPTS, ok_url)["url"] == ok_url
+    stats = pool.stats()
+    assert stats["timeouts"] == 1 and stats["restarts"] == 1
+    second_pid = stats["pids"][0]
+    assert second_pid != first_pid
+
+    # Worker chết giữa chừng: job hiện tại lỗi, slot có worker mới cho job sau
+    os.kill(second_pid, signal.SIGKILL)
+    with pytest.raises(RuntimeError, match="worker died"):
+        pool.extract("test", YDL_OPTS, ok_url)
+    assert pool.extract("test", YDL_OPTS, ok_url)["url"] == ok_url
+    stats = pool.stats()
+    assert stats["restarts"] == 2 and stats["pids"][0] not in (first_pid, second_pid)
+    assert stats["completed"] == 3 and stats["failed"] == 2 and stats["pending"] == 0
+
+
+def test_waiting_on_slow_in_flight_extraction_times_out():
+    flights = app.SingleFlight(0.2, timeout_error=app.ExtractionTimeout)
+    release = threading.Event()
+    leader = threading.Thread(target=flights.do, args=("key", release.wait))
+    leader.start()
+    while not flights.in_flight("key"):
+        time.sleep(0.01)
+    with pytest.raises(app.ExtractionTimeout):
+        flights.do("key", lambda: None)
+    release.set()
+    leader.join()
+    assert app.extractions.timeout_error is app.ExtractionTimeout
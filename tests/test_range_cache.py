@@ -0,0 +1,24 @@
+import pytest
+
+import app
+
+
+def test_upstream_error_aborts_missing_range(tmp_path, monkeypatch):
+    """Upstream lỗi khi fetch đoạn thiếu: iter_range phải ném lỗi, không trả body thiếu byte"""
+    chunk = 16 * 1024
+    media = bytes(range(256)) * (4 * chunk // 256)
+    cache = app.RangeCache(str(tmp_path), 16 * chunk, chunk)
+    assert cache.register("media", len(media), "audio/webm")
+    cache.store("media", 0, media[:chunk])
+
+    def iter_upstream_range(url, headers, start, end):
+        yield media[start:start + chunk]
+        raise app.UpstreamStatusError(403)
+
+    monkeypatch.setattr(app, "iter_upstream_range", iter_upstream_range)
+    out = bytearray()
+    with pytest.raises(app.UpstreamStatusError):
+        for block in cache.iter_range("media", 0, len(media) - 1, "http://upstream/media", {}):
+            out += block
+    assert bytes(out) == media[:2 * chunk]
+    assert cache.has("media", 1) and not cache.has("media", 2)
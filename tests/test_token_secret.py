@@ -0,0 +1,28 @@
+import base64
+import hashlib
+import hmac
+
+import pytest
+
+import app
+
+
+def test_generated_secret_survives_restart(tmp_path, monkeypatch):
+    monkeypatch.delenv("TOKEN_SECRET", raising=False)
+    path = str(tmp_path / "data" / "token_secret")
+    secret = app.load_token_secret(path)
+    assert len(secret) == 32
+    assert app.load_token_secret(path) == secret
+
+
+def test_env_secret_wins(tmp_path, monkeypatch):
+    monkeypatch.setenv("TOKEN_SECRET", "s3cret")
+    assert app.load_token_secret(str(tmp_path / "token_secret")) == b"s3cret"
+
+
+def test_token_signed_with_api_key_is_rejected():
+    assert app.TOKEN_SECRET != app.API_KEY.encode()
+    digest = hmac.new(app.API_KEY.encode(), b"dQw4w9WgXcQ:18", hashlib.sha256).digest()
+    forged = "dQw4w9WgXcQ:18:" + base64.urlsafe_b64encode(digest[:12]).decode()
+    with pytest.raises(PermissionError):
+        app.resolve_token(forged)
@@ -1,201 +1,3846 @@
-from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context
-import yt_dlp
+from flask import Flask, request, jsonify, send_from_directory, Response, g
 import os
 from dotenv import load_dotenv
 import requests
-from urllib.parse import quote, unquote
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+import re
+import json
+import io
+import time
+import threading
+import hashlib
+import hmac
+import base64
+import mmap
+import shutil
+import queue
+import multiprocessing
+import subprocess
+import bisect
+import socket
+import sqlite3
+import importlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from urllib.parse import quote, unquote, urlparse, parse_qs, urljoin, urlencode
+
+from extract_worker import extraction_worker
+
+
+
+class _LazyModule:
+    """Import module ở lần dùng đầu tiên: import yt_dlp mất vài giây trên armhf/armv7"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+        self.load_seconds = None
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    started = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    self.load_seconds = time.perf_counter() - started
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+
+yt_dlp = _LazyModule("yt_dlp")
+
+
+class _LoadOnFirstUse:
+    """
+    `enabled` của cache / index trên disk: _load() chạy ở lần dùng đầu tiên (hoặc load()),
+    không phải lúc import. Worker spawn import lại app.py, không được đụng tới disk.
+    """
+
+    _enabled = None  # None: chưa load, False: tắt bởi config hoặc load lỗi
+    _load_lock = threading.Lock()
+
+    def _load(self):
+        return True
+
+    def load(self):
+        if self._enabled is None:
+            with self._load_lock:
+                if self._enabled is None:
+                    self._enabled = self._load()
+        return self._enabled
+
+    @property
+    def enabled(self):
+        return self.load()
 
 # Load environment
 load_dotenv()
 
-API_KEY = os.getenv("API_KEY", "mqsmarthome")
-PORT = int(os.getenv("PORT", 5000))
-GO2RTC_URL = os.getenv("GO2RTC_URL", "http://localhost:1985")
 
-app = Flask(__name__, static_folder="static")
+def load_addon_options(path="/data/options.json"):
+    """
+    Options của add-on (config.json, sửa trong UI của Home Assistant) -> env. Env đã đặt sẵn
+    (docker -e, .env) được giữ nguyên; option không khai báo thì dùng default trong code.
+    """
+    try:
+        with open(path) as f:
+            options = json.load(f)
+    except (OSError, ValueError):
+        return
+    for name, value in options.items():
+        if value is None:
+            continue
+        os.environ.setdefault(name, str(value).lower() if isinstance(value, bool) else str(value))
+
+
+load_addon_options()
+
+
+
+def load_token_secret(path):
+    """
+    Key ký token /proxy?token=...: TOKEN_SECRET nếu có đặt, không thì key ngẫu nhiên tạo một lần
+    và lưu ở path để token còn hiệu lực sau restart. Không suy ra từ API_KEY (/config trả về
+    API_KEY không cần xác thực).
+    """
+    secret = os.getenv("TOKEN_SECRET")
+    if secret:
+        return secret.encode()
+    try:
+        with open(path, "rb") as f:
+            secret = f.read()
+        if len(secret) >= 32:
+            return secret
+    except OSError:
+        pass
+    secret = os.urandom(32)
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(tmp, "wb") as f:
+            f.write(secret)
+        os.chmod(tmp, 0o600)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"[token] Không lưu được {path} ({e}), token hết hiệu lực sau restart")
+    return secret
+
+
+API_KEY = os.getenv("API_KEY", "mqsmarthome")
+# Token lạ không kích hoạt được yt-dlp (xem load_token_secret)
+TOKEN_SECRET = load_token_secret(os.getenv("TOKEN_SECRET_PATH", "/data/token_secret"))
+PORT = int(os.getenv("PORT", 5000))
+GO2RTC_URL = os.getenv("GO2RTC_URL", "http://localhost:1985")
+# "files": ghi /config/youtube_url.txt như cũ; "api": đăng ký stream qua REST API của go2rtc
+GO2RTC_HANDOFF = os.getenv("GO2RTC_HANDOFF", "files").lower()
+# Source go2rtc của stream video / audio, {url} = googlevideo URL (rỗng = không đăng ký stream đó)
+GO2RTC_VIDEO_SOURCE = os.getenv("GO2RTC_VIDEO_SOURCE", "ffmpeg:{url}#video=mjpeg")
+GO2RTC_AUDIO_SOURCE = os.getenv("GO2RTC_AUDIO_SOURCE", "ffmpeg:{url}#audio=opus")
+# Chu kỳ (giây) đối chiếu với GET /api/streams để đăng ký lại stream mất khi go2rtc restart
+GO2RTC_SYNC_INTERVAL = int(os.getenv("GO2RTC_SYNC_INTERVAL", 30))
+# "asgi": uvicorn + coroutine cho streaming; "flask": Werkzeug threaded như cũ
+SERVER_MODE = os.getenv("SERVER_MODE", "asgi").lower()
+# Map device -> format policy, ví dụ {"kitchen_speaker": "esp-audio", "hall_screen": "screen"}
+try:
+    DEVICE_POLICIES = json.loads(os.getenv("DEVICE_POLICIES") or "{}")
+    if not isinstance(DEVICE_POLICIES, dict):
+        raise ValueError("expected a JSON object")
+except ValueError as e:
+    print(f"[config] DEVICE_POLICIES không hợp lệ ({e}), bỏ qua")
+    DEVICE_POLICIES = {}
+
+# Cache kết quả extract_info (dùng chung cho mọi endpoint)
+INFO_CACHE_MAX_MB = int(os.getenv("INFO_CACHE_MAX_MB", 32))
+INFO_CACHE_DEFAULT_TTL = int(os.getenv("INFO_CACHE_DEFAULT_TTL", 600))
+INFO_CACHE_EXPIRE_MARGIN = int(os.getenv("INFO_CACHE_EXPIRE_MARGIN", 300))
+# /search_list: TTL cache kết quả (giây), số kết quả mặc định / tối đa
+SEARCH_LIST_TTL = int(os.getenv("SEARCH_LIST_TTL", 300))
+SEARCH_LIST_DEFAULT = int(os.getenv("SEARCH_LIST_DEFAULT", 10))
+SEARCH_LIST_MAX = int(os.getenv("SEARCH_LIST_MAX", 25))
+# /resolve_batch: số item resolve song song (chung cho mọi batch), số item tối đa mỗi batch
+RESOLVE_BATCH_WORKERS = int(os.getenv("RESOLVE_BATCH_WORKERS", 4))
+RESOLVE_BATCH_MAX = int(os.getenv("RESOLVE_BATCH_MAX", 50))
+# Thời gian tối đa một request chờ extraction đang chạy của request khác
+EXTRACT_WAIT_TIMEOUT = int(os.getenv("EXTRACT_WAIT_TIMEOUT", 60))
+
+# Worker process cho yt-dlp (0 = extract ngay trong thread của request như cũ)
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", 2))
+EXTRACT_QUEUE = int(os.getenv("EXTRACT_QUEUE", 8))
+EXTRACT_TIMEOUT = int(os.getenv("EXTRACT_TIMEOUT", 45))
+EXTRACT_WORKER_NICE = int(os.getenv("EXTRACT_WORKER_NICE", 10))
+# Extraction chạy nền lúc khởi động (load extractor + cache của yt-dlp); rỗng để tắt
+WARMUP_QUERY = os.getenv("WARMUP_QUERY", "https://www.youtube.com/watch?v=jNQXAC9IVRw")
+
+# Index query text -> video id trên disk (SQLite, còn sau restart); rỗng = tắt
+QUERY_INDEX_PATH = os.getenv("QUERY_INDEX_PATH", "/config/yt_query_index.db")
+QUERY_INDEX_MAX = int(os.getenv("QUERY_INDEX_MAX", 5000))
+# Entry cũ hơn số giờ này được search lại ở thread nền (0 = không refresh)
+QUERY_INDEX_REFRESH_HOURS = float(os.getenv("QUERY_INDEX_REFRESH_HOURS", 24))
+QUERY_INDEX_REFRESH_INTERVAL = int(os.getenv("QUERY_INDEX_REFRESH_INTERVAL", 600))
+QUERY_INDEX_REFRESH_BATCH = int(os.getenv("QUERY_INDEX_REFRESH_BATCH", 10))
+
+# HTTP client dùng chung cho /proxy, /proxy_m3u8 (keep-alive tới googlevideo)
+UPSTREAM_POOL_HOSTS = int(os.getenv("UPSTREAM_POOL_HOSTS", 16))
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", 32))
+UPSTREAM_POOL_BLOCK = os.getenv("UPSTREAM_POOL_BLOCK", "false").lower() == "true"
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", 3))
+UPSTREAM_BACKOFF = float(os.getenv("UPSTREAM_BACKOFF", 0.3))
+
+# Cache byte-range của /proxy trên disk (0 = tắt)
+RANGE_CACHE_DIR = os.getenv("RANGE_CACHE_DIR", "/data/range_cache")
+RANGE_CACHE_MAX_MB = int(os.getenv("RANGE_CACHE_MAX_MB", 1024))
+RANGE_CACHE_CHUNK_KB = int(os.getenv("RANGE_CACHE_CHUNK_KB", 1024))
+
+# Fetch song song nhiều sub-range cho /proxy (0 = tắt, dùng một GET như cũ)
+PARALLEL_FETCH_WORKERS = int(os.getenv("PARALLEL_FETCH_WORKERS", 4))
+PARALLEL_FETCH_WINDOW = int(os.getenv("PARALLEL_FETCH_WINDOW_KB", 1024)) * 1024
+PARALLEL_FETCH_THREADS = int(os.getenv("PARALLEL_FETCH_THREADS", 16))
+
+# Số lần /proxy?token=... resolve lại + resume khi upstream 403/410 giữa chừng
+PROXY_RESUME_ATTEMPTS = int(os.getenv("PROXY_RESUME_ATTEMPTS", 3))
+
+# Broadcast: client cùng media dùng chung một upstream reader qua ring buffer (0 = tắt)
+BROADCAST_BUFFER_MB = int(os.getenv("BROADCAST_BUFFER_MB", 4))
+BROADCAST_SLOW_TIMEOUT = float(os.getenv("BROADCAST_SLOW_TIMEOUT", 10))
+# ASGI: số thread cho các bước đọc đồng bộ của stream (broadcast, range cache, token)
+ASGI_RELAY_THREADS = int(os.getenv("ASGI_RELAY_THREADS", 32))
+
+# Playback queue: số item đầu hàng đợi được resolve trước, kích thước tối đa
+QUEUE_PREFETCH = int(os.getenv("QUEUE_PREFETCH", 2))
+QUEUE_MAX = int(os.getenv("QUEUE_MAX", 100))
+QUEUE_WARM = os.getenv("QUEUE_WARM", "true").lower() == "true"
+
+# HLS: TTL cache playlist (live / VOD), số segment prefetch, cache segment trong RAM
+HLS_PLAYLIST_TTL = float(os.getenv("HLS_PLAYLIST_TTL", 2))
+HLS_VOD_PLAYLIST_TTL = float(os.getenv("HLS_VOD_PLAYLIST_TTL", 300))
+HLS_PREFETCH_SEGMENTS = int(os.getenv("HLS_PREFETCH_SEGMENTS", 3))
+HLS_SEGMENT_CACHE_MB = int(os.getenv("HLS_SEGMENT_CACHE_MB", 64))
+HLS_SEGMENT_TTL = int(os.getenv("HLS_SEGMENT_TTL", 120))
+
+# /transcode: số ffmpeg chạy đồng thời tối đa, binary ffmpeg
+TRANSCODE_MAX = int(os.getenv("TRANSCODE_MAX", 2))
+TRANSCODE_FFMPEG = os.getenv("TRANSCODE_FFMPEG", "ffmpeg")
+
+# /thumb: ảnh gốc ({id} = video id), cache biến thể đã resize trên disk (0 = tắt), TTL phía client
+THUMB_SOURCE = os.getenv("THUMB_SOURCE", "https://i.ytimg.com/vi/{id}/hqdefault.jpg")
+THUMB_CACHE_DIR = os.getenv("THUMB_CACHE_DIR", "/data/thumb_cache")
+THUMB_CACHE_MAX_MB = int(os.getenv("THUMB_CACHE_MAX_MB", 64))
+THUMB_MAX_SIZE = int(os.getenv("THUMB_MAX_SIZE", 1280))
+THUMB_MAX_AGE = int(os.getenv("THUMB_MAX_AGE", 86400))
+
+# Relay /proxy: chunk thích ứng theo throughput trong [MIN, MAX]; Flask mode ghi thẳng ra socket client
+RELAY_CHUNK_MIN = int(os.getenv("RELAY_CHUNK_MIN_KB", 16)) * 1024
+RELAY_CHUNK_MAX = max(int(os.getenv("RELAY_CHUNK_MAX_KB", 256)) * 1024, RELAY_CHUNK_MIN)
+RELAY_DIRECT_SOCKET = os.getenv("RELAY_DIRECT_SOCKET", "true").lower() == "true"
+# Mỗi lần đọc upstream ~ lượng dữ liệu nhận được trong khoảng này (giây)
+RELAY_CHUNK_TARGET = 0.05
+
+app = Flask(__name__, static_folder="static")
+
+# Simple API key auth
+def auth(req):
+    if not API_KEY:
+        return True
+    return req.headers.get("X-API-Key") == API_KEY
+
+
+# ======================
+# METRICS - Prometheus text format (không cần prometheus_client)
+# ======================
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+EXTRACT_BUCKETS = (0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 45, 60)
+
+
+def _label_str(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, values)) + "}"
+
+
+class Histogram:
+    """Histogram với label cố định; giá trị label phải thuộc một tập nhỏ biết trước"""
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}  # label values -> [count mỗi bucket..., +Inf, sum]
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        with self._lock:
+            snapshot = {k: list(v) for k, v in self._series.items()}
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, series in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                labels = _label_str(self.labels + ("le",), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _label_str(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Counter:
+    """Counter (hoặc gauge nếu kind="gauge") với label cố định"""
+
+    def __init__(self, name, help_text, labels=(), kind="counter"):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.kind = kind
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + value
+
+    def render(self):
+        with self._lock:
+            snapshot = dict(self._values)
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for label_values, value in sorted(snapshot.items()):
+            lines.append(f"{self.name}{_label_str(self.labels, label_values)} {value}")
+        return lines
+
+
+http_duration = Histogram(
+    "ytb_http_request_duration_seconds",
+    "Thời gian tới khi gửi response headers, theo route",
+    ("endpoint", "method", "status"),
+)
+extract_duration = Histogram(
+    "ytb_extract_duration_seconds",
+    "Thời gian extract_info (cache miss): search theo text hoặc resolve format theo video URL",
+    ("kind", "outcome"),
+    EXTRACT_BUCKETS,
+)
+upstream_connect = Histogram(
+    "ytb_upstream_connect_seconds",
+    "Thời gian mở connection mới tới upstream (TCP + TLS)",
+    ("client",),
+)
+upstream_ttfb = Histogram(
+    "ytb_upstream_ttfb_seconds",
+    "Thời gian từ lúc gửi request tới khi nhận response headers của upstream",
+    ("kind",),
+)
+relay_bytes = Counter("ytb_relay_bytes_total", "Số byte đã relay tới client", ("route",))
+active_streams = Counter("ytb_active_streams", "Số stream đang relay", ("route",), kind="gauge")
+
+METRICS = (http_duration, extract_duration, upstream_connect, upstream_ttfb, relay_bytes, active_streams)
+
+
+def status_class(status):
+    return f"{status // 100}xx"
+
+
+def upstream_kind(url):
+    """Nhãn TTFB: playlist HLS (manifest / .m3u8) hay media"""
+    return "playlist" if "manifest" in url or ".m3u8" in url else "media"
+
+
+class MeteredBody:
+    """Bọc body stream: đếm byte relay và số stream đang mở (close() khi xong hoặc client ngắt)"""
+
+    def __init__(self, body, route):
+        self.body = iter(body)
+        self.route = route
+        self.closed = False
+        active_streams.inc(1, route)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self.body)
+        except StopIteration:
+            raise
+        except Exception as e:
+            # Headers đã gửi: chỉ còn cách kết thúc body
+            print(f"Stream error: {e}")
+            raise StopIteration
+        relay_bytes.inc(len(chunk), self.route)
+        return chunk
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        active_streams.inc(-1, self.route)
+        if hasattr(self.body, "close"):
+            self.body.close()
+
+
+@app.before_request
+def _start_timer():
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def _observe_request(response):
+    started = g.get("started")
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        http_duration.observe(time.perf_counter() - started, endpoint, request.method, status_class(response.status_code))
+    return response
+
+
+# ======================
+# EXTRACTION CACHE
+# ======================
+
+_YT_ID_RE = re.compile(r'(?:v=|youtu\.be/|/shorts/|/live/|/embed/)([A-Za-z0-9_-]{11})')
+_EXPIRE_RE = re.compile(r'[?&/]expire[=/](\d+)')
+
+
+def normalize_query(query):
+    """Text search không phân biệt hoa thường / khoảng trắng thừa"""
+    return " ".join(query.lower().split())
+
+
+def cache_key(query):
+    """Key ổn định cho một query: video id nếu là URL YouTube, ngược lại là text đã normalize"""
+    match = _YT_ID_RE.search(query)
+    if match:
+        return f"id:{match.group(1)}"
+    return "q:" + normalize_query(query)
+
+
+def info_expiry(info):
+    """Thời điểm (epoch) cache entry hết hạn, lấy từ tham số expire= của googlevideo URLs"""
+    expires = []
+    for f in info.get("formats") or []:
+        match = _EXPIRE_RE.search(f.get("url") or "")
+        if match:
+            expires.append(int(match.group(1)))
+
+    if not expires:
+        return time.time() + INFO_CACHE_DEFAULT_TTL
+    # URL hết hạn sớm nhất quyết định; trừ margin để client còn thời gian phát
+    return min(expires) - INFO_CACHE_EXPIRE_MARGIN
+
+
+class LRUCache:
+    """LRU cache có TTL theo từng entry, giới hạn theo tổng dung lượng (ước lượng)"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, expires_at, size)
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return bool(entry) and entry[1] > time.time()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry:
+                self._drop(key)
+            self.misses += 1
+            return None
+
+    def put(self, keys, value, size, expires_at):
+        if expires_at <= time.time() or size > self.max_bytes:
+            return
+
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._drop(key)
+                # Mỗi alias tính size riêng — ước lượng dư, an toàn cho giới hạn RAM
+                self._entries[key] = (value, expires_at, size)
+                self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def _drop(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def invalidate(self, key):
+        """Xoá entry và mọi alias trỏ cùng value trước hạn (ví dụ URL đã bị upstream từ chối)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            for alias in [k for k, e in self._entries.items() if e[0] is entry[0]]:
+                self._drop(alias)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+info_cache = LRUCache(INFO_CACHE_MAX_MB * 1024 * 1024)
+# Kết quả /search_list (danh sách nhỏ, không có formats)
+search_cache = LRUCache(4 * 1024 * 1024)
+
+
+class ExtractionBusy(Exception):
+    """Hàng đợi extraction đầy -> từ chối nhanh thay vì xếp hàng vô hạn"""
+    status = 503
+
+
+class ExtractionTimeout(ExtractionBusy):
+    """Extraction vượt EXTRACT_TIMEOUT (tính cả thời gian chờ trong hàng đợi / chờ request trùng)"""
+    status = 504
+
+
+class _Flight:
+    """Một extraction đang chạy, các request trùng key chờ trên `done`"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Gộp các lời gọi đồng thời cùng key: chỉ request đầu tiên (leader) chạy,
+    các request sau chờ và dùng chung kết quả hoặc lỗi.
+    """
+
+    def __init__(self, wait_timeout, max_tracked_keys=100, timeout_error=TimeoutError):
+        self.wait_timeout = wait_timeout
+        self.timeout_error = timeout_error
+        self.max_tracked_keys = max_tracked_keys
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._per_key = OrderedDict()  # key -> {"leaders", "coalesced", "timeouts"}
+        self.leaders = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+                self.leaders += 1
+                self._count(key, "leaders")
+            else:
+                self.coalesced += 1
+                self._count(key, "coalesced")
+
+        if leader:
+            try:
+                flight.result = fn()
+                return flight.result
+            except Exception as e:
+                flight.error = e
+                raise
+            finally:
+                with self._lock:
+                    self._flights.pop(key, None)
+                flight.done.set()
+
+        if not flight.done.wait(self.wait_timeout):
+            with self._lock:
+                self.timeouts += 1
+                self._count(key, "timeouts")
+            raise self.timeout_error(f"Timed out waiting for in-flight request ({self.wait_timeout}s)")
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def _count(self, key, field):
+        # Giữ metrics cho các key gần nhất, tránh phình bộ nhớ
+        counters = self._per_key.get(key)
+        if counters is None:
+            counters = {"leaders": 0, "coalesced": 0, "timeouts": 0}
+            self._per_key[key] = counters
+            if len(self._per_key) > self.max_tracked_keys:
+                self._per_key.popitem(last=False)
+        else:
+            self._per_key.move_to_end(key)
+        counters[field] += 1
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._flights
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": list(self._flights),
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "timeouts": self.timeouts,
+                "per_key": {key: dict(counters) for key, counters in self._per_key.items()},
+            }
+
+
+# Chờ extraction trùng quá lâu -> ExtractionTimeout (504) như khi tự extract bị timeout
+extractions = SingleFlight(EXTRACT_WAIT_TIMEOUT, timeout_error=ExtractionTimeout)
+
+
+def extract_info_cached(query, ydl_opts, profile):
+    """
+    extract_info có cache. `profile` phân biệt các bộ ydl_opts khác nhau
+    (player_client khác nhau trả về danh sách formats khác nhau).
+    Các request trùng nhau đang chạy song song chỉ tốn một lần extraction.
+    """
+    key = f"{profile}:{cache_key(query)}"
+    info = info_cache.get(key)
+    if info is not None:
+        return info
+    return extractions.do(key, lambda: _extract_and_store(query, ydl_opts, profile, key))
+
+
+def timed_extraction(kind, profile, ydl_opts, query):
+    """run_extraction + ghi thời gian vào histogram extract_duration theo kind / outcome"""
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        info = run_extraction(profile, ydl_opts, query)
+        outcome = "ok"
+        return info
+    except ExtractionTimeout:
+        outcome = "timeout"
+        raise
+    except ExtractionBusy:
+        outcome = "rejected"
+        raise
+    finally:
+        extract_duration.observe(time.perf_counter() - started, kind, outcome)
+
+
+def _extract_and_store(query, ydl_opts, profile, key):
+    kind = "search" if cache_key(query).startswith("q:") else "video"
+    info = timed_extraction(kind, profile, ydl_opts, query)
+
+    if "entries" in info:
+        entries = info["entries"] or []
+        if not entries:
+            return info
+        info = entries[0]
+
+    # Lưu theo cả query lẫn video id để lần sau search bằng URL cũng hit
+    keys = [key]
+    if info.get("id"):
+        keys.append(f"{profile}:id:{info['id']}")
+    info_cache.put(keys, info, len(json.dumps(info, default=str)), info_expiry(info))
+    return info
+
+
+# ======================
+# EXTRACTION WORKERS - process pool giữ sẵn YoutubeDL
+# ======================
+
+def busy_response(e):
+    response = jsonify({"success": False, "error": str(e)})
+    response.status_code = e.status
+    if e.status == 503:
+        response.headers['Retry-After'] = '5'
+    return response
+
+
+class _ExtractionJob:
+    def __init__(self, profile, opts, query, deadline):
+        self.profile = profile
+        self.opts = opts
+        self.query = query
+        self.deadline = deadline
+        self.future = Future()
+
+
+class ExtractionPool:
+    """
+    Pool worker process sống lâu cho yt-dlp: hàng đợi có giới hạn (đầy -> ExtractionBusy),
+    timeout theo job (quá hạn -> kill worker và spawn lại), không giữ GIL của process chính.
+    """
+
+    def __init__(self, size, max_queue, timeout, profiles):
+        self.size = size
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.profiles = profiles
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+        self._pids = {}
+        self.pending = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.restarts = 0
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for slot in range(self.size):
+            threading.Thread(target=self._dispatch, args=(slot,), name=f"extract-{slot}", daemon=True).start()
+
+    def _spawn(self, slot):
+        # spawn thay vì fork: process chính đã có nhiều thread (fork dễ deadlock)
+        ctx = multiprocessing.get_context("spawn")
+        parent_conn, child_conn = ctx.Pipe()
+        process = ctx.Process(
+            target=extraction_worker, args=(child_conn, self.profiles, EXTRACT_WORKER_NICE), daemon=True)
+        process.start()
+        child_conn.close()
+        with self._lock:
+            self._pids[slot] = process.pid
+        return process, parent_conn
+
+    def _kill(self, process, conn):
+        conn.close()
+        process.kill()
+        process.join(5)
+
+    def submit(self, profile, opts, query):
+        self.start()
+        with self._lock:
+            if self.pending >= self.size + self.max_queue:
+                self.rejected += 1
+                raise ExtractionBusy(f"Extraction queue full ({self.pending} pending), retry later")
+            self.pending += 1
+        job = _ExtractionJob(profile, opts, query, time.monotonic() + self.timeout)
+        job.future.add_done_callback(self._job_done)
+        self._queue.put(job)
+        return job.future
+
+    def _job_done(self, future):
+        with self._lock:
+            self.pending -= 1
+
+    def extract(self, profile, opts, query):
+        # Dispatcher luôn kết thúc job trước deadline; +5s chỉ để phòng hờ
+        return self.submit(profile, opts, query).result(timeout=self.timeout + 5)
+
+    def _dispatch(self, slot):
+        process, conn = self._spawn(slot)
+        while True:
+            job = self._queue.get()
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            remaining = job.deadline - time.monotonic()
+            if remaining <= 0:
+                self._fail(job, ExtractionTimeout(f"Extraction timed out in queue after {self.timeout}s"), timeout=True)
+                continue
+
+            with self._lock:
+                self.running += 1
+            try:
+                conn.send((job.profile, job.opts, job.query))
+                if conn.poll(remaining):
+                    result = conn.recv()
+                else:
+                    result = None
+            except (EOFError, OSError) as e:
+                result = ("error", "WorkerDied", f"Extraction worker died: {e}")
+                process.join(0)
+            finally:
+                with self._lock:
+                    self.running -= 1
+
+            if result is None:
+                # Hủy job treo: kill worker, spawn worker mới cho slot này
+                self._kill(process, conn)
+                process, conn = self._respawn(slot)
+                self._fail(job, ExtractionTimeout(f"Extraction timed out after {self.timeout}s"), timeout=True)
+            elif result[0] == "ok":
+                with self._lock:
+                    self.completed += 1
+                job.future.set_result(result[1])
+            else:
+                _, name, message = result
+                if name == "WorkerDied" or not process.is_alive():
+                    self._kill(process, conn)
+                    process, conn = self._respawn(slot)
+                error = yt_dlp.utils.DownloadError(message) if name == "DownloadError" else RuntimeError(message)
+                self._fail(job, error)
+
+    def _respawn(self, slot):
+        with self._lock:
+            self.restarts += 1
+        return self._spawn(slot)
+
+    def _fail(self, job, error, timeout=False):
+        with self._lock:
+            self.failed += 1
+            if timeout:
+                self.timeouts += 1
+        job.future.set_exception(error)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.size,
+                "pids": list(self._pids.values()),
+                "max_queue": self.max_queue,
+                "timeout": self.timeout,
+                "pending": self.pending,
+                "running": self.running,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "restarts": self.restarts,
+            }
+
+
+def run_extraction(profile, ydl_opts, query):
+    """extract_info qua worker pool (EXTRACT_WORKERS > 0) hoặc ngay trong thread hiện tại"""
+    if extraction_pool is None:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            return ydl.extract_info(query, download=False)
+    return extraction_pool.extract(profile, ydl_opts, query)
+
+
+# ======================
+# UPSTREAM HTTP CLIENT
+# ======================
+
+class PoolStats:
+    """Đếm số connection mở mới / tái sử dụng / phải chờ của pool upstream"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.opened = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    def add(self, field, value=1):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + value)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "opened": self.opened,
+                "reused": max(self.requests - self.opened, 0),
+                "waits": self.waits,
+                "wait_seconds": round(self.wait_seconds, 3),
+                "pool_hosts": UPSTREAM_POOL_HOSTS,
+                "pool_size": UPSTREAM_POOL_SIZE,
+                "pool_block": UPSTREAM_POOL_BLOCK,
+            }
+
+
+upstream_stats = PoolStats()
+
+
+class _CountingHTTPConnection(HTTPConnection):
+    def connect(self):
+        upstream_stats.add("opened")
+        started = time.perf_counter()
+        super().connect()
+        upstream_connect.observe(time.perf_counter() - started, "requests")
+
+
+class _CountingHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        upstream_stats.add("opened")
+        started = time.perf_counter()
+        super().connect()
+        upstream_connect.observe(time.perf_counter() - started, "requests")
+
+
+class _CountingPoolMixin:
+    def _get_conn(self, timeout=None):
+        upstream_stats.add("requests")
+        if not (self.block and self.pool is not None and self.pool.empty()):
+            return super()._get_conn(timeout=timeout)
+        # Pool đầy và đang ở chế độ block: request phải chờ connection rảnh
+        started = time.monotonic()
+        try:
+            return super()._get_conn(timeout=timeout)
+        finally:
+            upstream_stats.add("waits")
+            upstream_stats.add("wait_seconds", time.monotonic() - started)
+
+
+class _CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    ConnectionCls = _CountingHTTPConnection
+
+
+class _CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = _CountingHTTPSConnection
+
+
+class UpstreamAdapter(HTTPAdapter):
+    """HTTPAdapter với pool có đếm connection"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, **kwargs):
+        # stream=True: trả về ngay khi có headers -> thời gian tới byte đầu tiên
+        started = time.perf_counter()
+        resp = super().send(request, **kwargs)
+        upstream_ttfb.observe(time.perf_counter() - started, upstream_kind(request.url))
+        return resp
+
+
+def make_upstream_session():
+    """Session duy nhất cho cả process: keep-alive, giới hạn connection mỗi host, retry có backoff"""
+    retry = Retry(
+        total=UPSTREAM_RETRIES,
+        backoff_factor=UPSTREAM_BACKOFF,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        raise_on_status=False,
+    )
+    adapter = UpstreamAdapter(
+        pool_connections=UPSTREAM_POOL_HOSTS,
+        pool_maxsize=UPSTREAM_POOL_SIZE,
+        pool_block=UPSTREAM_POOL_BLOCK,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+upstream = make_upstream_session()
+
+
+# ======================
+# RELAY - đọc vào buffer dùng lại, chunk thích ứng theo throughput
+# ======================
+
+class ChunkSizer:
+    """
+    Kích thước mỗi lần đọc upstream: đủ cho ~RELAY_CHUNK_TARGET giây theo throughput đo được
+    (lũy thừa 2 trong [RELAY_CHUNK_MIN, RELAY_CHUNK_MAX]). Stream chậm (loa ESP) giữ chunk
+    nhỏ cho byte tới sớm, stream 1080p dùng chunk lớn -> ít lượt đọc / ghi hơn.
+    """
+
+    def __init__(self):
+        self.size = RELAY_CHUNK_MIN
+        self.rate = None
+        self.last = time.monotonic()
+
+    def update(self, n):
+        now = time.monotonic()
+        elapsed, self.last = now - self.last, now
+        if elapsed <= 0:
+            return
+        rate = n / elapsed
+        self.rate = rate if self.rate is None else 0.7 * self.rate + 0.3 * rate
+        size = RELAY_CHUNK_MIN
+        while size < self.rate * RELAY_CHUNK_TARGET and size < RELAY_CHUNK_MAX:
+            size *= 2
+        self.size = min(size, RELAY_CHUNK_MAX)
+
+
+class UpstreamBody:
+    """
+    Body của upstream response (requests, stream=True) cho relay. readinto() đọc thẳng vào
+    buffer của caller qua http.client, không tạo bytes mỗi chunk; iterate thì ra bytes
+    (WSGI/ASGI cần bytes). `writer` (_ChunkWriter) nhận cùng dữ liệu để ghi range cache,
+    `on_close` được gọi một lần khi body đóng.
+    """
+
+    def __init__(self, resp, writer=None, on_close=None):
+        self.resp = resp
+        self.writer = writer
+        self.on_close = on_close
+        self.sizer = ChunkSizer()
+        self.view = None
+        self.closed = False
+        # Content-Encoding (gzip...) phải qua urllib3 để giải nén. `_fp` (http.client response)
+        # là chi tiết nội bộ của urllib3: không có / không có readinto() thì đọc qua resp.raw.read
+        encoding = resp.headers.get("Content-Encoding", "identity").lower()
+        fp = getattr(resp.raw, "_fp", None) if encoding == "identity" else None
+        self.fp = fp if callable(getattr(fp, "readinto", None)) else None
+
+    def readinto(self, view):
+        if self.closed:
+            return 0
+        view = view[:self.sizer.size]
+        if self.fp is not None:
+            n = self.fp.readinto(view)
+        else:
+            data = self.resp.raw.read(len(view), decode_content=True)
+            n = len(data)
+            view[:n] = data
+        if not n:
+            # Hết body: trả connection về pool trước, close() sau đó không đóng socket nữa
+            self.resp.raw.release_conn()
+            self.close()
+            return 0
+        self.sizer.update(n)
+        if self.writer:
+            self.writer.feed(view[:n])
+        return n
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.view is None:
+            self.view = memoryview(bytearray(RELAY_CHUNK_MAX))
+        n = self.readinto(self.view)
+        if not n:
+            raise StopIteration
+        # Chép có chủ ý: WSGI server / transport của asyncio có thể giữ chunk sau khi next()
+        # trả về, còn self.view bị ghi đè ở lần đọc sau. Consumer ghi ngay (SocketRelay,
+        # broadcast reader, ffmpeg stdin) dùng readinto() / iter_views() để khỏi chép
+        return bytes(self.view[:n])
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.resp.close()
+            if self.on_close:
+                self.on_close()
+
+
+class ChunkReader:
+    """readinto() trên iterable bytes (range cache, tải song song...): phần dư giữ cho lần sau"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.iterator = iter(chunks)
+        self.pending = memoryview(b"")
+
+    def readinto(self, view):
+        while not self.pending:
+            chunk = next(self.iterator, None)
+            if chunk is None:
+                return 0
+            self.pending = memoryview(chunk)
+        n = min(len(view), len(self.pending))
+        view[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def close(self):
+        if hasattr(self.chunks, "close"):
+            self.chunks.close()
+
+
+def read_body(resp):
+    """Toàn bộ body (stream=True) bằng một lần đọc thay vì resp.content ghép từng mẩu 10 KB"""
+    try:
+        return resp.raw.read(decode_content=True)
+    finally:
+        resp.close()
+
+
+def iter_views(body):
+    """
+    Chunk của body: memoryview trên một buffer dùng lại nếu body có readinto(), ngược lại
+    chính các chunk bytes. Chỉ dùng được tới lần next() sau (caller phải chép / ghi ngay).
+    """
+    if not hasattr(body, "readinto"):
+        yield from body
+        return
+    view = memoryview(bytearray(RELAY_CHUNK_MAX))
+    while True:
+        n = body.readinto(view)
+        if not n:
+            return
+        yield view[:n]
+
+
+# ======================
+# PARALLEL RANGE FETCH - vượt throttle per-connection của googlevideo
+# ======================
+
+class UpstreamStatusError(Exception):
+    """Upstream trả về status không mong đợi"""
+
+    def __init__(self, status):
+        super().__init__(f"Upstream returned {status}")
+        self.status = status
+
+    @property
+    def http_status(self):
+        """Status trả cho client: lỗi 4xx/5xx của upstream giữ nguyên, còn lại (200 thay vì 206...) -> 502"""
+        return self.status if self.status >= 400 else 502
+
+
+class RangeNotSupported(UpstreamStatusError):
+    """Upstream trả 200 (toàn bộ media) cho request có Range"""
+
+
+fetch_executor = ThreadPoolExecutor(max_workers=max(PARALLEL_FETCH_THREADS, 1), thread_name_prefix="range-fetch")
+
+
+def parse_open_range(range_header):
+    """
+    Range của client khi chưa biết total: None -> (0, None), 'bytes=a-' -> (a, None),
+    'bytes=a-b' -> (a, b). Suffix / multi-range -> ValueError.
+    """
+    if not range_header:
+        return 0, None
+    match = re.fullmatch(r'\s*bytes=(\d+)-(\d*)\s*', range_header)
+    if not match:
+        raise ValueError(f"unsupported range: {range_header}")
+    end = int(match.group(2)) if match.group(2) else None
+    if end is not None and end < int(match.group(1)):
+        raise ValueError(f"unsatisfiable range: {range_header}")
+    return int(match.group(1)), end
+
+
+def _fetch_window(url, headers, start, end):
+    """GET một window (stream=True, đọc body bằng read_body)"""
+    resp = upstream.get(url, headers=dict(headers, Range=f"bytes={start}-{end}"), stream=True, timeout=60)
+    if resp.status_code != 206:
+        resp.close()
+        raise (RangeNotSupported if resp.status_code == 200 else UpstreamStatusError)(resp.status_code)
+    return resp
+
+
+class ParallelFetch:
+    """
+    Tải [start, end] thành các window cố định, tối đa PARALLEL_FETCH_WORKERS window
+    chạy song song (read-ahead), trả về theo đúng thứ tự.
+    """
+
+    def __init__(self, url, headers, start, end=None):
+        self.url = url
+        self.headers = {k: v for k, v in headers.items() if k != 'Range'}
+        self.start = start
+        self.end = end
+        self.total = None
+        self.content_type = None
+        self._first = None
+
+    def open(self):
+        """Tải window đầu tiên (đồng bộ) để biết total / content-type và báo lỗi upstream sớm"""
+        window_end = self.start + PARALLEL_FETCH_WINDOW - 1
+        if self.end is not None:
+            window_end = min(window_end, self.end)
+        resp = _fetch_window(self.url, self.headers, self.start, window_end)
+        span = parse_content_range(resp)
+        if not span:
+            resp.close()
+            raise UpstreamStatusError(resp.status_code)
+        self.total = span[1]
+        self.end = self.total - 1 if self.end is None else min(self.end, self.total - 1)
+        self.content_type = resp.headers.get('Content-Type')
+        self._first = read_body(resp)
+
+    def __iter__(self):
+        first, self._first = self._first, None
+        yield first
+
+        windows = deque(
+            (pos, min(pos + PARALLEL_FETCH_WINDOW - 1, self.end))
+            for pos in range(self.start + len(first), self.end + 1, PARALLEL_FETCH_WINDOW)
+        )
+        pending = deque()
+        try:
+            while windows or pending:
+                while windows and len(pending) < PARALLEL_FETCH_WORKERS:
+                    start, end = windows.popleft()
+                    pending.append(fetch_executor.submit(self._read_window, start, end))
+                yield pending.popleft().result()
+        finally:
+            # Client ngắt kết nối: bỏ các window chưa chạy
+            for future in pending:
+                future.cancel()
+
+    def _read_window(self, start, end):
+        return read_body(_fetch_window(self.url, self.headers, start, end))
+
+
+def iter_upstream_range(url, headers, start, end):
+    """Bytes [start, end] từ upstream: song song nếu bật PARALLEL_FETCH_WORKERS, ngược lại một GET"""
+    if PARALLEL_FETCH_WORKERS > 0:
+        fetch = ParallelFetch(url, headers, start, end)
+        fetch.open()
+        return iter(fetch)
+
+    resp = upstream.get(url, headers=dict(headers, Range=f"bytes={start}-{end}"), stream=True, timeout=60)
+    if resp.status_code != 206:
+        resp.close()
+        raise UpstreamStatusError(resp.status_code)
+    return UpstreamBody(resp)
+
+
+def open_upstream(url, headers, start=0):
+    """
+    Mở upstream từ `start` tới hết media (song song nếu bật PARALLEL_FETCH_WORKERS, ngược lại
+    một GET). Trả về (chunks, total, content_type); UpstreamStatusError nếu upstream lỗi.
+    """
+    if PARALLEL_FETCH_WORKERS > 0:
+        fetch = ParallelFetch(url, headers, start)
+        fetch.open()
+        return iter(fetch), fetch.total, fetch.content_type
+
+    resp = upstream.get(url, headers=dict(headers, Range=f"bytes={start}-"), stream=True, timeout=60)
+    span = parse_content_range(resp)
+    if resp.status_code != 206 or not span:
+        resp.close()
+        raise UpstreamStatusError(resp.status_code)
+
+    return UpstreamBody(resp), span[1], resp.headers.get('Content-Type')
+
+
+# ======================
+# RANGE CACHE - cache byte-range của media trên disk
+# ======================
+
+def media_identity(url):
+    """
+    Identity ổn định của một media stream (không phụ thuộc chữ ký hết hạn trong URL):
+    id + itag (+ clen/range/sq nếu có). None nếu URL không đủ thông tin để cache.
+    """
+    parsed = urlparse(url)
+    params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+    # HLS segment mang tham số trong path: /videoplayback/id/X/itag/Y/sq/Z/...
+    parts = parsed.path.strip("/").split("/")
+    if parts and parts[0] == "videoplayback":
+        for k, v in zip(parts[1::2], parts[2::2]):
+            params.setdefault(k, v)
+
+    if not params.get("id") or not params.get("itag"):
+        return None
+    ident = ":".join(params.get(k, "") for k in ("id", "itag", "clen", "range", "sq"))
+    return hashlib.sha1(ident.encode()).hexdigest()[:20]
+
+
+def parse_range(range_header, total):
+    """
+    'bytes=a-b' -> (start, end) đã clamp theo total.
+    None nếu không có header; ValueError nếu không hỗ trợ / không thỏa được.
+    """
+    if not range_header:
+        return None
+    match = re.fullmatch(r'\s*bytes=(\d*)-(\d*)\s*', range_header)
+    if not match or not (match.group(1) or match.group(2)):
+        raise ValueError(f"unsupported range: {range_header}")
+    if not match.group(1):
+        # Suffix range: N bytes cuối
+        start, end = max(total - int(match.group(2)), 0), total - 1
+    else:
+        start = int(match.group(1))
+        end = min(int(match.group(2)), total - 1) if match.group(2) else total - 1
+    if start > end or start >= total:
+        raise ValueError(f"unsatisfiable range: {range_header}")
+    return start, end
+
+
+def parse_content_range(resp):
+    """(offset, total) của upstream response, None nếu không xác định được"""
+    if resp.status_code == 206:
+        match = re.match(r'bytes (\d+)-\d+/(\d+)', resp.headers.get('Content-Range', ''))
+        if match:
+            return int(match.group(1)), int(match.group(2))
+    elif resp.status_code == 200 and resp.headers.get('Content-Length', '').isdigit():
+        return 0, int(resp.headers['Content-Length'])
+    return None
+
+
+class _ChunkWriter:
+    """Tách luồng upstream (bắt đầu từ `offset`) thành các chunk trọn vẹn và ghi vào cache"""
+
+    def __init__(self, cache, key, offset, total):
+        size = cache.chunk_size
+        self.cache = cache
+        self.key = key
+        self.total = total
+        self.index = -(-offset // size)  # chunk boundary đầu tiên >= offset
+        self.skip = self.index * size - offset
+        self.buf = bytearray()
+
+    def feed(self, data):
+        if self.skip:
+            n = min(self.skip, len(data))
+            data = data[n:]
+            self.skip -= n
+            if not data:
+                return
+        self.buf += data
+        size = self.cache.chunk_size
+        while len(self.buf) >= size:
+            self.cache.store(self.key, self.index, bytes(self.buf[:size]))
+            del self.buf[:size]
+            self.index += 1
+        # Chunk cuối của file có thể ngắn hơn chunk_size
+        if self.buf and self.index * size + len(self.buf) >= self.total:
+            self.cache.store(self.key, self.index, bytes(self.buf))
+            self.buf.clear()
+            self.index += 1
+
+
+class RangeCache(_LoadOnFirstUse):
+    """
+    Cache byte-range trên disk: mỗi media một thư mục, mỗi chunk (căn theo
+    chunk_size) một file. Đọc chunk qua mmap, evict cả media theo LRU khi vượt max_bytes.
+    """
+
+    def __init__(self, root, max_bytes, chunk_size):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._media = OrderedDict()  # key -> {"total", "content_type", "chunks": set, "bytes"}
+        self._bytes = 0
+        self.hits = 0
+        self.partial_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_served = 0
+        if max_bytes <= 0:
+            self._enabled = False
+
+    def _load(self):
+        try:
+            os.makedirs(self.root, exist_ok=True)
+        except OSError as e:
+            print(f"[range_cache] Disabled, cannot create {self.root}: {e}")
+            return False
+
+        # Khôi phục index từ disk, thứ tự LRU theo mtime của meta.json
+        found = []
+        for key in os.listdir(self.root):
+            path = os.path.join(self.root, key)
+            try:
+                with open(os.path.join(path, "meta.json")) as f:
+                    meta = json.load(f)
+                chunks = {int(name) for name in os.listdir(path) if name.isdigit()}
+                size = sum(os.path.getsize(os.path.join(path, str(i))) for i in chunks)
+                found.append((os.path.getmtime(os.path.join(path, "meta.json")), key, {
+                    "total": meta["total"],
+                    "content_type": meta.get("content_type"),
+                    "chunks": chunks,
+                    "bytes": size,
+                }))
+            except (OSError, ValueError, KeyError):
+                shutil.rmtree(path, ignore_errors=True)
+
+        for _, key, entry in sorted(found, key=lambda item: item[0]):
+            self._media[key] = entry
+            self._bytes += entry["bytes"]
+        return True
+
+    def _path(self, key, index=None):
+        if index is None:
+            return os.path.join(self.root, key)
+        return os.path.join(self.root, key, str(index))
+
+    def register(self, key, total, content_type):
+        """Tạo entry cho media (nếu chưa có), trả về True nếu cache được"""
+        if not self.enabled or total <= 0:
+            return False
+        with self._lock:
+            if key in self._media:
+                return True
+        try:
+            os.makedirs(self._path(key), exist_ok=True)
+            with open(os.path.join(self._path(key), "meta.json"), "w") as f:
+                json.dump({"total": total, "content_type": content_type}, f)
+        except OSError as e:
+            print(f"[range_cache] Register error: {e}")
+            return False
+        with self._lock:
+            self._media.setdefault(key, {"total": total, "content_type": content_type, "chunks": set(), "bytes": 0})
+        return True
+
+    def has(self, key, index):
+        with self._lock:
+            entry = self._media.get(key)
+            return bool(entry) and index in entry["chunks"]
+
+    def store(self, key, index, data):
+        with self._lock:
+            entry = self._media.get(key)
+            if entry is None or index in entry["chunks"]:
+                return
+        path = self._path(key, index)
+        try:
+            # Ghi file tạm rồi rename để reader không bao giờ thấy chunk dở dang
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[range_cache] Write error: {e}")
+            return
+
+        with self._lock:
+            entry = self._media.get(key)
+            if entry is None or index in entry["chunks"]:
+                return
+            entry["chunks"].add(index)
+            entry["bytes"] += len(data)
+            self._bytes += len(data)
+            self._media.move_to_end(key)
+            evicted = self._evict_locked(keep=key)
+        for old in evicted:
+            shutil.rmtree(self._path(old), ignore_errors=True)
+
+    def _evict_locked(self, keep):
+        evicted = []
+        while self._bytes > self.max_bytes and len(self._media) > 1:
+            old = next(iter(self._media))
+            if old == keep:
+                self._media.move_to_end(old)
+                continue
+            self._bytes -= self._media.pop(old)["bytes"]
+            self.evictions += 1
+            evicted.append(old)
+        return evicted
+
+    def lookup(self, key, range_header):
+        """
+        Trả về (start, end, total, content_type) nếu chunk đầu tiên của range đã
+        có trong cache; None nếu phải đi upstream. ValueError nếu range không thỏa.
+        """
+        with self._lock:
+            entry = self._media.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            total = entry["total"]
+            content_type = entry["content_type"]
+
+        start, end = parse_range(range_header, total) or (0, total - 1)
+        first, last = start // self.chunk_size, end // self.chunk_size
+        with self._lock:
+            chunks = entry["chunks"]
+            if first not in chunks:
+                self.misses += 1
+                return None
+            if all(i in chunks for i in range(first, last + 1)):
+                self.hits += 1
+            else:
+                self.partial_hits += 1
+            self._media.move_to_end(key)
+        try:
+            os.utime(os.path.join(self._path(key), "meta.json"))
+        except OSError:
+            pass
+        return start, end, total, content_type
+
+    def iter_range(self, key, start, end, url, headers):
+        """Đọc [start, end] từ cache, các đoạn thiếu thì fetch upstream và ghi bổ sung"""
+        index, last = start // self.chunk_size, end // self.chunk_size
+        while index <= last:
+            if self.has(key, index):
+                data = self._read_chunk(key, index, start, end)
+                if data is not None:
+                    yield from data
+                    index += 1
+                    continue
+            run_end = index
+            while run_end < last and not self.has(key, run_end + 1):
+                run_end += 1
+            yield from self._fetch_run(key, index, run_end, start, end, url, headers)
+            index = run_end + 1
+
+    def _read_chunk(self, key, index, start, end):
+        base = index * self.chunk_size
+        try:
+            f = open(self._path(key, index), "rb")
+        except OSError:
+            return None  # Chunk vừa bị evict -> fetch lại từ upstream
+        return self._iter_mmap(f, max(start - base, 0), end - base + 1)
+
+    def _iter_mmap(self, f, lo, hi):
+        with f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            hi = min(hi, len(mm))
+            # Đọc từ disk: không phụ thuộc throughput upstream, dùng chunk lớn nhất
+            for pos in range(lo, hi, RELAY_CHUNK_MAX):
+                block = mm[pos:min(pos + RELAY_CHUNK_MAX, hi)]
+                with self._lock:
+                    self.bytes_served += len(block)
+                yield block
+
+    def _fetch_run(self, key, first, last, start, end, url, headers):
+        with self._lock:
+            total = self._media[key]["total"] if key in self._media else end + 1
+        run_start = first * self.chunk_size
+        run_end = min((last + 1) * self.chunk_size, total) - 1
+
+        writer = _ChunkWriter(self, key, run_start, total)
+        pos = run_start
+        try:
+            for chunk in iter_upstream_range(url, headers, run_start, run_end):
+                if not chunk:
+                    continue
+                writer.feed(chunk)
+                lo, hi = max(start - pos, 0), min(end + 1 - pos, len(chunk))
+                if lo < hi:
+                    yield chunk[lo:hi]
+                # Đọc hết run (tối đa thêm < 1 chunk) để chunk cuối cũng được lưu
+                pos += len(chunk)
+        except UpstreamStatusError as e:
+            # Ném tiếp: relay phải đứt (client / ResumableBody đọc lại), không được kết thúc
+            # body sớm như thể đã đủ byte
+            print(f"[range_cache] {e} for missing range")
+            raise
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "media": len(self._media),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "partial_hits": self.partial_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "bytes_served": self.bytes_served,
+            }
+
+
+range_cache = RangeCache(RANGE_CACHE_DIR, RANGE_CACHE_MAX_MB * 1024 * 1024, RANGE_CACHE_CHUNK_KB * 1024)
+
+
+# ======================
+# BROADCAST - nhiều client cùng media dùng chung một upstream reader
+# ======================
+
+class _BroadcastListener:
+    """
+    Một client của Broadcast: đọc ring buffer bằng cursor riêng. Bị tách khỏi broadcast
+    (đứng yên, reader dừng giữa chừng) thì tự đọc tiếp [cursor, end] từ range cache / upstream.
+    """
+
+    def __init__(self, broadcast, start, end):
+        self.broadcast = broadcast
+        self.start = start
+        self.cursor = start
+        self.end = end
+        self.evicted = False
+        self.progress_at = time.monotonic()  # lần cuối đọc được dữ liệu
+        self.waiting_since = None  # đang chờ reader ghi thêm (đã đọc tới head) từ lúc này
+        self.fallback = None
+        self.closed = False
+        self.view = None
+
+    def readinto(self, view):
+        """Chép dữ liệu tiếp theo vào `view` (buffer của caller), trả về số byte; 0 khi hết"""
+        if self.closed:
+            return 0
+        if self.fallback is None:
+            n = self.broadcast.read(self, view)
+            if n:
+                return n
+            if n is not None:
+                self.close()
+                return 0
+            self.broadcast.detach(self)
+            self.fallback = ChunkReader(self.broadcast.fallback(self.cursor, self.end))
+        n = self.fallback.readinto(view)
+        if not n:
+            self.close()
+        return n
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.view is None:
+            self.view = memoryview(bytearray(RELAY_CHUNK_MAX))
+        n = self.readinto(self.view)
+        if not n:
+            raise StopIteration
+        return bytes(self.view[:n])
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.broadcast.detach(self)
+        if self.fallback is not None:
+            self.fallback.close()
+
+
+class Broadcast:
+    """
+    Một upstream reader (từ byte `start` tới hết media) ghi vào ring buffer cố định,
+    mỗi listener đọc bằng cursor riêng. Reader chạy theo tốc độ listener chậm nhất
+    (backpressure): cả nhóm cùng nhịp phát thì chỉ tải upstream một lần. Chỉ tách ra listener
+    đứng yên quá BROADCAST_SLOW_TIMEOUT, hoặc giữ listener khác phải chờ dữ liệu quá lâu.
+    """
+
+    def __init__(self, hub, key, url, headers, start, capacity):
+        self.hub = hub
+        self.key = key
+        self.url = url
+        self.headers = {k: v for k, v in headers.items() if k != 'Range'}
+        self.capacity = capacity
+        self.buffer = bytearray(capacity)
+        self.ring = memoryview(self.buffer)
+        self.base = start  # [base, head) còn trong ring buffer
+        self.head = start
+        self.total = None
+        self.content_type = None
+        self.ready = threading.Event()
+        self.failed = False
+        self.done = False  # reader đã dừng (hết media, lỗi hoặc không còn listener)
+        self.listeners = set()
+        self.cond = threading.Condition()
+
+    def open(self):
+        """Mở upstream (đồng bộ, lỗi trả thẳng cho client đầu tiên) rồi chạy reader thread"""
+        try:
+            chunks, self.total, self.content_type = open_upstream(self.url, self.headers, self.base)
+        except Exception:
+            with self.cond:
+                self.failed = self.done = True
+            self.hub.finished(self)
+            raise
+        finally:
+            self.ready.set()
+
+        writer = None
+        if range_cache.register(self.key, self.total, self.content_type):
+            writer = _ChunkWriter(range_cache, self.key, self.base, self.total)
+        threading.Thread(target=self._run, args=(chunks, writer), name="broadcast", daemon=True).start()
+
+    def attach(self, start, end):
+        """Listener mới từ byte `start`; None nếu đoạn đó đã ra khỏi (hoặc chưa tới) ring buffer"""
+        with self.cond:
+            if self.done or not self.base <= start <= self.head:
+                return None
+            listener = _BroadcastListener(self, start, end)
+            self.listeners.add(listener)
+            return listener
+
+    def detach(self, listener):
+        with self.cond:
+            self.listeners.discard(listener)
+            self.cond.notify_all()
+
+    def read(self, listener, view):
+        """
+        Chép phần đã có trong ring buffer (tối đa len(view)) của listener vào `view`: số byte;
+        0 khi đã đọc tới end; None nếu listener phải tự đọc tiếp (bị tách vì chậm, hoặc
+        reader dừng trước end).
+        """
+        with self.cond:
+            while True:
+                if listener.evicted:
+                    return None
+                if listener.cursor > listener.end:
+                    return 0
+                if listener.cursor < self.head:
+                    n = min(self.head, listener.end + 1, listener.cursor + len(view)) - listener.cursor
+                    pos = listener.cursor % self.capacity
+                    first = min(n, self.capacity - pos)
+                    view[:first] = self.ring[pos:pos + first]
+                    if first < n:
+                        view[first:n] = self.ring[:n - first]
+                    listener.cursor += n
+                    listener.progress_at = time.monotonic()
+                    listener.waiting_since = None
+                    # Reader có thể đang chờ chỗ trống
+                    self.cond.notify_all()
+                    return n
+                if self.done:
+                    return None
+                if listener.waiting_since is None:
+                    listener.waiting_since = time.monotonic()
+                    self.cond.notify_all()
+                self.cond.wait()
+
+    def _write(self, data):
+        """
+        Ghi vào ring buffer, chờ tới khi mọi listener đã đọc qua phần sắp bị ghi đè. Listener
+        chưa đọc tới đó bị tách ra khi không đọc được byte nào trong BROADCAST_SLOW_TIMEOUT
+        (tính từ lúc reader bắt đầu chờ), hoặc khi listener nhanh hơn đã đọc hết ring và phải
+        chờ liên tục BROADCAST_SLOW_TIMEOUT vì nó. False nếu không còn listener (reader dừng).
+        """
+        n = len(data)
+        evicted = 0
+        with self.cond:
+            blocked_since = time.monotonic()
+            while self.listeners:
+                floor = self.head + n - self.capacity
+                lagging = [l for l in self.listeners if l.cursor < floor]
+                if not lagging:
+                    break
+                now = time.monotonic()
+                starved = [max(l.waiting_since, blocked_since) for l in self.listeners
+                           if l.waiting_since is not None and l.cursor >= self.head]
+                starved_deadline = min(starved) + BROADCAST_SLOW_TIMEOUT if starved else None
+                deadlines = {}
+                for listener in lagging:
+                    deadline = max(listener.progress_at, blocked_since) + BROADCAST_SLOW_TIMEOUT
+                    if starved_deadline is not None:
+                        deadline = min(deadline, starved_deadline)
+                    deadlines[listener] = deadline
+                stale = [l for l, deadline in deadlines.items() if deadline <= now]
+                if stale:
+                    for listener in stale:
+                        listener.evicted = True
+                        self.listeners.discard(listener)
+                    evicted += len(stale)
+                    continue
+                self.cond.wait(min(deadlines.values()) - now)
+
+            alive = bool(self.listeners)
+            if alive:
+                pos = self.head % self.capacity
+                first = min(n, self.capacity - pos)
+                self.ring[pos:pos + first] = data[:first]
+                self.ring[:n - first] = data[first:]
+                self.head += n
+                self.base = max(self.base, self.head - self.capacity)
+            self.cond.notify_all()
+        if evicted:
+            # Ngoài self.cond: hub.lock luôn được lấy trước cond (xem listen)
+            self.hub.count("evicted", evicted)
+        return alive
+
+    def _run(self, chunks, writer):
+        try:
+            for chunk in iter_views(chunks):
+                if writer:
+                    writer.feed(chunk)
+                # Ghi từng phần nhỏ (1/64 ring): reader chỉ phải chờ listener chậm nhất đọc thêm
+                # một phần nhỏ, listener nhanh không phải chờ lâu giữa các lần ghi
+                view = memoryview(chunk)
+                unit = max(self.capacity // 64, 1)
+                for pos in range(0, len(view), unit):
+                    if not self._write(view[pos:pos + unit]):
+                        return
+                self.hub.count("bytes_upstream", len(chunk))
+        except Exception as e:
+            print(f"Broadcast error: {e}")
+        finally:
+            chunks.close()
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+            self.hub.finished(self)
+
+    def fallback(self, start, end):
+        self.hub.count("fallbacks")
+        if range_cache.enabled:
+            return range_cache.iter_range(self.key, start, end, self.url, self.headers)
+        return iter_upstream_range(self.url, self.headers, start, end)
+
+
+class BroadcastHub:
+    """
+    Broadcast đang chạy theo media identity + counters cho /stats. Client đầu tiên của một
+    media relay thẳng như thường (không tốn ring buffer + reader thread); broadcast chỉ được
+    mở khi client thứ hai tới trong lúc client đầu còn đang phát.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.enabled = capacity > 0
+        self.lock = threading.Lock()
+        self.active = {}
+        self.relays = {}  # key -> số relay riêng (không qua broadcast) đang mở
+        self.started = 0
+        self.joined = 0
+        self.evicted = 0
+        self.fallbacks = 0
+        self.bytes_upstream = 0
+
+    def count(self, field, n=1):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + n)
+
+    def track(self, key):
+        """Ghi nhận một relay riêng của media; trả về hàm release (gọi khi body đóng, idempotent)"""
+        if not self.enabled or not key:
+            return None
+        with self.lock:
+            self.relays[key] = self.relays.get(key, 0) + 1
+        released = False
+
+        def release():
+            nonlocal released
+            with self.lock:
+                if released:
+                    return
+                released = True
+                self.relays[key] -= 1
+                if not self.relays[key]:
+                    del self.relays[key]
+
+        return release
+
+    def listen(self, key, url, headers, start, end, create=True):
+        """
+        Gắn client vào broadcast của media (create: tạo mới nếu chưa có, range mở tới hết media
+        và đang có relay riêng khác của media này). Late join: chỉ gắn được khi `start` còn
+        trong ring buffer, ngược lại trả về None để client đi đường thường (range cache /
+        upstream riêng).
+        """
+        with self.lock:
+            broadcast = self.active.get(key)
+            if broadcast is None:
+                # Range đóng (probe...) hoặc chỉ có một client: không đáng một reader riêng
+                if not create or end is not None or not self.relays.get(key):
+                    return None
+                broadcast = self.active[key] = Broadcast(self, key, url, headers, start, self.capacity)
+                self.started += 1
+                creator = True
+            else:
+                creator = False
+            listener = broadcast.attach(start, end)
+
+        if creator:
+            broadcast.open()
+        elif listener:
+            broadcast.ready.wait(60)
+            if broadcast.failed or broadcast.total is None or start >= broadcast.total:
+                listener.close()
+                return None
+            self.count("joined")
+        if listener is None:
+            return None
+
+        listener.end = broadcast.total - 1 if end is None else min(end, broadcast.total - 1)
+        return listener
+
+    def finished(self, broadcast):
+        with self.lock:
+            if self.active.get(broadcast.key) is broadcast:
+                del self.active[broadcast.key]
+
+    def stats(self):
+        with self.lock:
+            active = list(self.active.values())
+            stats = {
+                "enabled": self.enabled,
+                "buffer_bytes": self.capacity,
+                "active": len(active),
+                "relays": sum(self.relays.values()),
+                "started": self.started,
+                "joined": self.joined,
+                "evicted": self.evicted,
+                "fallbacks": self.fallbacks,
+                "bytes_upstream": self.bytes_upstream,
+            }
+        stats["listeners"] = sum(len(b.listeners) for b in active)
+        return stats
+
+
+broadcasts = BroadcastHub(BROADCAST_BUFFER_MB * 1024 * 1024)
+
+
+class TrackedBody:
+    """Body relay riêng đang được broadcasts.track(): release khi close(), kể cả body chưa được đọc"""
+
+    def __init__(self, body, release):
+        self.body = body
+        self.release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.body)
+
+    def close(self):
+        try:
+            self.body.close()
+        finally:
+            if self.release:
+                self.release()
+
+
+# ======================
+# HLS - cache playlist, rewrite URI, prefetch segment
+# ======================
+
+# Tag có URI="..." trỏ tới playlist khác (các tag còn lại: key, init segment... -> /proxy)
+_PLAYLIST_URI_TAGS = ('#EXT-X-MEDIA', '#EXT-X-I-FRAME-STREAM-INF')
+_URI_ATTR_RE = re.compile(r'URI="([^"]*)"')
+_TARGET_DURATION_RE = re.compile(r'#EXT-X-TARGETDURATION:\s*(\d+(?:\.\d+)?)')
+
+playlist_cache = LRUCache(4 * 1024 * 1024)
+playlist_fetches = SingleFlight(15)
+segment_cache = LRUCache(HLS_SEGMENT_CACHE_MB * 1024 * 1024)
+segment_fetches = SingleFlight(30)
+
+
+def _proxied(uri, base_url, path):
+    absolute = urljoin(base_url, uri)
+    if not absolute.startswith(('http://', 'https://')):
+        return uri, None  # data:, skd:// ... giữ nguyên
+    return f"{path}?url={quote(absolute)}", absolute
+
+
+def rewrite_m3u8(content, url):
+    """
+    Rewrite playlist (master hoặc media) về proxy:
+    - variant sau #EXT-X-STREAM-INF, URI="..." của #EXT-X-MEDIA / #EXT-X-I-FRAME-STREAM-INF -> /proxy_m3u8
+    - segment, URI="..." của #EXT-X-KEY / #EXT-X-MAP ... -> /proxy
+    URL tương đối resolve theo URL playlist (giữ đúng query string).
+    Trả về (playlist mới, danh sách URL tuyệt đối của segment).
+    """
+    new_lines = []
+    segments = []
+    next_is_playlist = False
+
+    for line in content.split('\n'):
+        stripped = line.strip()
+
+        if not stripped:
+            new_lines.append(line)
+            continue
+
+        if stripped.startswith('#'):
+            tag = stripped.split(':', 1)[0]
+            if tag == '#EXT-X-STREAM-INF':
+                next_is_playlist = True
+            if 'URI="' in stripped:
+                path = '/proxy_m3u8' if tag in _PLAYLIST_URI_TAGS else '/proxy'
+                line = _URI_ATTR_RE.sub(lambda m: f'URI="{_proxied(m.group(1), url, path)[0]}"', line)
+            new_lines.append(line)
+            continue
+
+        if next_is_playlist:
+            proxied_url, _ = _proxied(stripped, url, '/proxy_m3u8')
+            next_is_playlist = False
+        else:
+            proxied_url, absolute = _proxied(stripped, url, '/proxy')
+            if absolute:
+                segments.append(absolute)
+        new_lines.append(proxied_url)
+
+    return '\n'.join(new_lines), segments
+
+
+def fetch_playlist(url):
+    """Playlist từ cache ngắn hạn; nhiều client cùng poll chỉ tốn một lần fetch upstream"""
+    content = playlist_cache.get(url)
+    if content is not None:
+        return content
+    return playlist_fetches.do(url, lambda: _fetch_playlist(url))
+
+
+def _fetch_playlist(url):
+    resp = upstream.get(url, headers=M3U8_UPSTREAM_HEADERS, timeout=15)
+    if resp.status_code != 200:
+        raise UpstreamStatusError(resp.status_code)
+    content = resp.text
+
+    if '#EXT-X-ENDLIST' in content:
+        ttl = HLS_VOD_PLAYLIST_TTL
+    else:
+        # Live: không giữ lâu hơn nửa target duration để client không bị trễ segment mới
+        ttl = HLS_PLAYLIST_TTL
+        match = _TARGET_DURATION_RE.search(content)
+        if match:
+            ttl = min(ttl, float(match.group(1)) / 2)
+    playlist_cache.put([url], content, len(content), time.time() + ttl)
+    return content
+
+
+def prefetch_segments(content, segments):
+    """
+    Tải trước segment vào segment_cache: live -> N segment mới nhất (client đang
+    bám live edge), VOD -> N segment đầu.
+    """
+    if HLS_PREFETCH_SEGMENTS <= 0 or not segments:
+        return
+    if '#EXT-X-ENDLIST' in content:
+        targets = segments[:HLS_PREFETCH_SEGMENTS]
+    else:
+        targets = segments[-HLS_PREFETCH_SEGMENTS:]
+    for url in targets:
+        if url not in segment_cache and not segment_fetches.in_flight(url):
+            fetch_executor.submit(_prefetch_segment, url)
+
+
+def _prefetch_segment(url):
+    try:
+        segment_fetches.do(url, lambda: _fetch_segment(url))
+    except Exception as e:
+        print(f"[hls] Prefetch error: {e}")
+
+
+def _fetch_segment(url):
+    cached = segment_cache.get(url)
+    if cached is not None:
+        return cached
+    resp = upstream.get(url, headers=PROXY_UPSTREAM_HEADERS, stream=True, timeout=30)
+    if resp.status_code != 200:
+        resp.close()
+        raise UpstreamStatusError(resp.status_code)
+    segment = (resp.headers.get('Content-Type'), read_body(resp))
+    segment_cache.put([url], segment, len(segment[1]), time.time() + HLS_SEGMENT_TTL)
+    return segment
+
+
+def cached_segment(url):
+    """(content_type, bytes) của segment đã/đang prefetch, None nếu không có"""
+    if url in segment_cache:
+        return segment_cache.get(url)
+    if segment_fetches.in_flight(url):
+        try:
+            return segment_fetches.do(url, lambda: _fetch_segment(url))
+        except Exception:
+            return None
+    return None
+
+
+def segment_response_args(segment, range_header):
+    """(body, status, content_type, content_range) khi phục vụ segment từ cache"""
+    content_type, data = segment
+    try:
+        span = parse_range(range_header, len(data))
+    except ValueError:
+        span = None
+    if not span:
+        return data, 200, content_type, None
+    start, end = span
+    return data[start:end + 1], 206, content_type, f"bytes {start}-{end}/{len(data)}"
+
+
+# ======================
+# CONFIG ENDPOINT
+# ======================
+
+@app.route('/config', methods=['GET'])
+def get_config():
+    """Frontend gọi endpoint này để lấy API_KEY — không cần hardcode trong JS"""
+    return jsonify({"api_key": API_KEY})
+
+
+def component_stats():
+    return {
+        "info_cache": info_cache.stats(),
+        "search_cache": search_cache.stats(),
+        "extractions": extractions.stats(),
+        "extraction_pool": extraction_pool.stats() if extraction_pool else None,
+        "upstream_pool": upstream_stats.stats(),
+        "range_cache": range_cache.stats(),
+        "hls_playlist_cache": playlist_cache.stats(),
+        "hls_segment_cache": segment_cache.stats(),
+        "broadcasts": broadcasts.stats(),
+        "queue": playback_queue.stats(),
+        "transcoders": transcoders.stats(),
+        "warmup": warmup.stats(),
+        "go2rtc": go2rtc.stats(),
+        "thumbs": thumb_cache.stats(),
+        "query_index": query_index.stats(),
+    }
+
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    """Counters nội bộ (cache hit/miss...) để theo dõi hiệu năng"""
+    if not auth(request):
+        return jsonify({"error": "unauthorized"}), 401
+    return jsonify(component_stats())
+
+
+# Field tăng dần trong các stats() -> counter, còn lại (kích thước, cấu hình...) là gauge
+COUNTER_FIELDS = {
+    "hits", "misses", "partial_hits", "evictions", "bytes_served",
+    "leaders", "coalesced", "timeouts",
+    "completed", "failed", "rejected", "restarts",
+    "requests", "opened", "reused", "waits", "wait_seconds",
+    "started", "joined", "evicted", "fallbacks", "bytes_upstream",
+    "remuxed", "killed", "prefetched", "refreshed",
+    "batches", "registrations", "skipped", "resyncs",
+    "recorded", "forgotten", "changed", "fetched", "rendered",
+}
+
+
+def render_component_stats():
+    """Chuyển stats() của từng thành phần sang Prometheus; bỏ per-key (cardinality cao)"""
+    lines = []
+    for component, stats in component_stats().items():
+        for field, value in (stats or {}).items():
+            if isinstance(value, list) and field != "pids":
+                value = len(value)
+            if isinstance(value, bool):
+                value = int(value)
+            if not isinstance(value, (int, float)):
+                continue
+            counter = field in COUNTER_FIELDS
+            name = f"ytb_{component}_{field}" + ("_total" if counter else "")
+            lines.append(f"# TYPE {name} {'counter' if counter else 'gauge'}")
+            lines.append(f"{name} {value}")
+    return lines
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Prometheus scrape: histogram latency + counters. Không cần API key (không chứa
+    dữ liệu nhạy cảm). Chỉ snapshot dưới lock ngắn, không chạm tới thread đang stream.
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    lines.extend(render_component_stats())
+    return Response("\n".join(lines) + "\n", content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# ======================
+# PROXY ENDPOINTS
+# ======================
+
+PROXY_UPSTREAM_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': '*/*',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Referer': 'https://www.youtube.com/',
+    'Origin': 'https://www.youtube.com',
+    'Sec-Fetch-Dest': 'video',
+    'Sec-Fetch-Mode': 'no-cors',
+    'Sec-Fetch-Site': 'cross-site',
+}
+
+M3U8_UPSTREAM_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Referer': 'https://www.youtube.com/',
+    'Origin': 'https://www.youtube.com',
+    'Accept': '*/*'
+}
+
+M3U8_RESPONSE_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, OPTIONS',
+    'Cache-Control': 'no-cache',
+}
+
+
+def proxy_headers(content_type=None, content_length=None, content_range=None):
+    """CORS + content headers cho response của /proxy (dùng chung Flask và ASGI)"""
+    headers = {
+        # CORS headers
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, OPTIONS',
+        'Access-Control-Allow-Headers': 'Range',
+        'Access-Control-Expose-Headers': 'Content-Length, Content-Range, Accept-Ranges, Content-Type',
+        # Content headers
+        'Content-Type': content_type or 'video/mp4',
+    }
+    if content_length is not None:
+        headers['Content-Length'] = str(content_length)
+    if content_range:
+        headers['Content-Range'] = content_range
+    headers['Accept-Ranges'] = 'bytes'
+    headers['Cache-Control'] = 'public, max-age=3600'
+    return headers
+
+
+def broadcast_response_args(listener, range_header):
+    """(status, content_type, content_length, content_range) cho client gắn vào broadcast"""
+    broadcast = listener.broadcast
+    return (
+        206 if range_header else 200,
+        broadcast.content_type,
+        listener.end - listener.start + 1,
+        f"bytes {listener.start}-{listener.end}/{broadcast.total}" if range_header else None,
+    )
+
+
+class SocketRelay:
+    """
+    Body /proxy ghi thẳng ra socket của client (Werkzeug): yield b"" để server gửi status +
+    headers, sau đó readinto() vào một buffer dùng lại rồi sendall - không tạo bytes mỗi
+    chunk, không qua các lớp WSGI. Chỉ dùng khi có Content-Length (không chunked); lỗi giữa
+    chừng thì shutdown socket để client thấy EOF thay vì chờ phần body còn thiếu.
+    """
+
+    def __init__(self, body, sock, route):
+        self.body = body
+        self.sock = sock
+        self.route = route
+        self.closed = False
+        active_streams.inc(1, route)
+
+    def __iter__(self):
+        yield b""
+        view = memoryview(bytearray(RELAY_CHUNK_MAX))
+        try:
+            while True:
+                n = self.body.readinto(view)
+                if not n:
+                    return
+                self.sock.sendall(view[:n])
+                relay_bytes.inc(n, self.route)
+        except Exception as e:
+            print(f"Stream error: {e}")
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        active_streams.inc(-1, self.route)
+        if hasattr(self.body, "close"):
+            self.body.close()
+
+
+def client_socket():
+    """Socket của client nếu server cho ghi thẳng (Werkzeug, GET), ngược lại None"""
+    if not RELAY_DIRECT_SOCKET or request.method != "GET":
+        return None
+    return request.environ.get("werkzeug.socket")
+
+
+def _proxy_response(body, status, content_type=None, content_length=None, content_range=None):
+    """Response stream của /proxy với CORS + content headers"""
+    if isinstance(body, (bytes, bytearray)):
+        relay_bytes.inc(len(body), "proxy")
+    else:
+        # Body có readinto + độ dài biết trước: ghi thẳng ra socket nếu server cho phép
+        sock = client_socket() if hasattr(body, "readinto") and content_length is not None else None
+        body = SocketRelay(body, sock, "proxy") if sock else MeteredBody(body, "proxy")
+    response = Response(body, status=status)
+    response.headers.update(proxy_headers(content_type, content_length, content_range))
+    return response
+
+
+def open_media(url, range_header):
+    """
+    Mở stream cho /proxy: segment HLS đã prefetch -> broadcast đang chạy -> range cache ->
+    broadcast mới -> tải song song -> một GET. Trả về (body, status, content_type,
+    content_length, content_range); UpstreamStatusError nếu upstream từ chối.
+    """
+    headers = dict(PROXY_UPSTREAM_HEADERS)
+
+    # Range request support
+    if range_header:
+        headers['Range'] = range_header
+
+    # Segment HLS đã prefetch
+    segment = cached_segment(url)
+    if segment:
+        body, status, content_type, content_range = segment_response_args(segment, range_header)
+        return body, status, content_type, len(body), content_range
+
+    media_key = media_identity(url)
+    try:
+        start, end = parse_open_range(range_header)
+    except ValueError:
+        start = None  # Suffix / multi-range: để upstream tự xử lý
+    shared = media_key and start is not None and broadcasts.enabled
+
+    # Phòng khác đang phát cùng media: gắn vào upstream reader chung
+    if shared:
+        listener = broadcasts.listen(media_key, url, headers, start, end, create=False)
+        if listener:
+            return (listener, *broadcast_response_args(listener, range_header))
+
+    # Cache hit: phục vụ từ disk, chỉ đi upstream cho các đoạn còn thiếu
+    if media_key and range_cache.enabled:
+        try:
+            cached = range_cache.lookup(media_key, range_header)
+        except ValueError:
+            cached = None
+        if cached:
+            start, end, total, content_type = cached
+            return (
+                range_cache.iter_range(media_key, start, end, url, headers),
+                206 if range_header else 200,
+                content_type,
+                end - start + 1,
+                f"bytes {start}-{end}/{total}" if range_header else None,
+            )
+
+    # Mở broadcast mới để các client đến sau dùng chung
+    if shared:
+        listener = broadcasts.listen(media_key, url, headers, start, end)
+        if listener:
+            return (listener, *broadcast_response_args(listener, range_header))
+
+    # Relay riêng: ghi nhận ngay từ lúc mở để client tiếp theo của media (kể cả khi tới lúc
+    # client này còn đang chờ upstream) mở broadcast dùng chung; body trả về giữ release
+    release = broadcasts.track(media_key) if shared else None
+    try:
+        # Chia range của client thành nhiều window tải song song, ghép lại theo thứ tự. Chỉ khi
+        # client gửi Range; upstream trả 200 cho window đầu (không hỗ trợ Range) -> một GET như thường
+        fetch = None
+        if PARALLEL_FETCH_WORKERS > 0 and range_header and start is not None:
+            fetch = ParallelFetch(url, headers, start, end)
+            try:
+                fetch.open()
+            except RangeNotSupported:
+                print("[proxy] Upstream ignored Range, falling back to single GET")
+                fetch = None
+        if fetch:
+            writer = None
+            if media_key and range_cache.register(media_key, fetch.total, fetch.content_type):
+                writer = _ChunkWriter(range_cache, media_key, fetch.start, fetch.total)
+
+            def generate_parallel():
+                try:
+                    for chunk in fetch:
+                        if writer:
+                            writer.feed(chunk)
+                        yield chunk
+                except Exception as e:
+                    print(f"Stream error: {e}")
+
+            body = generate_parallel()
+            return (
+                TrackedBody(body, release) if release else body,
+                206 if range_header else 200,
+                fetch.content_type,
+                fetch.end - fetch.start + 1,
+                f"bytes {fetch.start}-{fetch.end}/{fetch.total}" if range_header else None,
+            )
+
+        # Dùng pool keep-alive chung (retry/backoff cấu hình trong make_upstream_session)
+        resp = upstream.get(
+            url, 
+            headers=headers, 
+            stream=True, 
+            timeout=60,
+            allow_redirects=True
+        )
+
+        # Check status
+        if resp.status_code not in [200, 206]:
+            resp.close()
+            raise UpstreamStatusError(resp.status_code)
+
+        # Ghi song song vào range cache trong lúc relay
+        writer = None
+        span = parse_content_range(resp) if media_key and range_cache.enabled else None
+        if span and range_cache.register(media_key, span[1], resp.headers.get('Content-Type')):
+            writer = _ChunkWriter(range_cache, media_key, span[0], span[1])
+
+        return (
+            UpstreamBody(resp, writer, release),
+            resp.status_code,
+            resp.headers.get('Content-Type'),
+            resp.headers.get('Content-Length'),
+            resp.headers.get('Content-Range'),
+        )
+    except BaseException:
+        if release:
+            release()
+        raise
+
+
+# Token ổn định "<video_id>:<format_id>:<chữ ký>" thay cho googlevideo URL có chữ ký hết hạn
+_TOKEN_RE = re.compile(r'([A-Za-z0-9_-]{11}):([A-Za-z0-9_.-]+):([A-Za-z0-9_-]+)')
+
+
+def _token_signature(video_id, format_id):
+    digest = hmac.new(TOKEN_SECRET, f"{video_id}:{format_id}".encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:12]).decode()
+
+
+def media_token(video_id, format_id):
+    return f"{video_id}:{format_id}:{_token_signature(video_id, format_id)}"
+
+
+def url_expiring(url, margin=60):
+    match = _EXPIRE_RE.search(url)
+    return bool(match) and int(match.group(1)) <= time.time() + margin
+
+
+def resolve_token(token, stale_url=None):
+    """
+    googlevideo URL hiện tại của token (qua info cache). URL trong cache trùng `stale_url`
+    (vừa bị upstream từ chối) hoặc sắp hết hạn -> bỏ cache, extract lại.
+    ValueError nếu token sai định dạng, PermissionError nếu chữ ký sai (kiểm tra trước khi
+    extract), LookupError nếu video không có format đó.
+    """
+    match = _TOKEN_RE.fullmatch(token)
+    if not match:
+        raise ValueError(f"invalid token: {token}")
+    video_id, format_id, signature = match.groups()
+    if not hmac.compare_digest(signature, _token_signature(video_id, format_id)):
+        raise PermissionError("invalid token signature")
+    query = f"https://www.youtube.com/watch?v={video_id}"
+
+    for attempt in range(2):
+        info = resolve_info(query)
+        url = next((f.get("url") for f in info.get("formats") or [] if f.get("format_id") == format_id), None)
+        if not url:
+            raise LookupError(f"format {format_id} not found for {video_id}")
+        if attempt or (url != stale_url and not url_expiring(url)):
+            return url
+        info_cache.invalidate(f"resolve:{cache_key(query)}")
+    return url
+
+
+def _resume_body(url, start, end):
+    """Đọc tiếp [start, end] (end=None: tới hết media) bằng URL mới"""
+    headers = dict(PROXY_UPSTREAM_HEADERS)
+    if end is None:
+        chunks, _, _ = open_upstream(url, headers, start)
+        return chunks
+    media_key = media_identity(url)
+    if media_key and range_cache.enabled:
+        return range_cache.iter_range(media_key, start, end, url, headers)
+    return iter_upstream_range(url, headers, start, end)
+
+
+class ResumableBody:
+    """
+    Relay body của token; upstream lỗi hoặc đứt giữa chừng (403/410, URL hết hạn...) thì
+    resolve lại token và đọc tiếp từ byte hiện tại bằng Range, client không bị ngắt.
+    end=None (không biết độ dài): chỉ resume khi có exception.
+    """
+
+    def __init__(self, body, token, url, start, end):
+        self.token = token
+        self.url = url
+        self.pos = start
+        self.end = end
+        self.resumes = 0
+        self.view = None
+        self.closed = False
+        self._use(body)
+
+    def _use(self, body):
+        self.body = body
+        self.reader = body if hasattr(body, "readinto") else ChunkReader(body)
+
+    def _close_body(self):
+        if hasattr(self.body, "close"):
+            self.body.close()
+
+    def readinto(self, view):
+        while not self.closed:
+            failed = False
+            try:
+                n = self.reader.readinto(view)
+            except Exception as e:
+                print(f"Stream error at byte {self.pos}: {e}")
+                n, failed = 0, True
+            if n:
+                self.pos += n
+                return n
+
+            self._close_body()
+            if not failed and (self.end is None or self.pos > self.end):
+                break
+            if self.resumes == PROXY_RESUME_ATTEMPTS:
+                print(f"[proxy] Giving up on {self.token} at byte {self.pos}")
+                break
+            self.resumes += 1
+            try:
+                self.url = resolve_token(self.token, stale_url=self.url)
+                self._use(_resume_body(self.url, self.pos, self.end))
+            except Exception as e:
+                print(f"[proxy] Resume failed for {self.token}: {e}")
+                break
+            print(f"[proxy] Resumed {self.token} at byte {self.pos}")
+        self.closed = True
+        return 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.view is None:
+            self.view = memoryview(bytearray(RELAY_CHUNK_MAX))
+        n = self.readinto(self.view)
+        if not n:
+            raise StopIteration
+        return bytes(self.view[:n])
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._close_body()
+
+
+def open_token(token, range_header):
+    """open_media cho token: URL bị 403/410 lúc mở thì resolve lại một lần, body tự resume"""
+    url = resolve_token(token)
+    try:
+        body, status, content_type, content_length, content_range = open_media(url, range_header)
+    except UpstreamStatusError as e:
+        if e.status not in (403, 410):
+            raise
+        print(f"[proxy] {token}: upstream {e.status}, re-resolving")
+        url = resolve_token(token, stale_url=url)
+        body, status, content_type, content_length, content_range = open_media(url, range_header)
+
+    match = re.match(r'bytes (\d+)-(\d+)/', content_range or '')
+    if match:
+        start, end = int(match.group(1)), int(match.group(2))
+    else:
+        start, end = 0, int(content_length) - 1 if content_length else None
+    if not isinstance(body, (bytes, bytearray)):
+        body = ResumableBody(body, token, url, start, end)
+    return body, status, content_type, content_length, content_range
+
+
+@app.route('/proxy', methods=['GET', 'OPTIONS'])
+def proxy_stream():
+    """Proxy video/audio stream (?url=... hoặc ?token=<video_id>:<format_id>:<chữ ký>)"""
+    if request.method == 'OPTIONS':
+        response = Response()
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Range, Content-Type, Accept'
+        response.headers['Access-Control-Max-Age'] = '3600'
+        return response
+    
+    url = request.args.get('url')
+    token = request.args.get('token')
+    if not url and not token:
+        return jsonify({"error": "missing url parameter"}), 400
+    
+    try:
+        range_header = request.headers.get('Range')
+        if token:
+            return _proxy_response(*open_token(token, range_header))
+        return _proxy_response(*open_media(unquote(url), range_header))
+
+    except UpstreamStatusError as e:
+        print(f"Proxy error: Status {e.status}")
+        return jsonify({"error": str(e)}), e.http_status
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except PermissionError as e:
+        return jsonify({"error": str(e)}), 403
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except ExtractionBusy as e:
+        print(f"Extraction unavailable: {e}")
+        return busy_response(e)
+    except yt_dlp.utils.DownloadError as de:
+        print(f"[/proxy] yt-dlp error: {de}")
+        return jsonify({"error": f"yt-dlp error: {str(de)}"}), 502
+    except requests.exceptions.Timeout:
+        print("Proxy timeout")
+        return jsonify({"error": "Request timeout"}), 504
+    except requests.exceptions.ConnectionError as e:
+        print(f"Connection error: {e}")
+        return jsonify({"error": "Connection failed"}), 502
+    except Exception as e:
+        print(f"Proxy error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/proxy_m3u8', methods=['GET', 'OPTIONS'])
+def proxy_m3u8():
+    """Proxy m3u8 playlist và rewrite URLs"""
+    if request.method == 'OPTIONS':
+        response = Response()
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+        return response
+    
+    url = request.args.get('url')
+    if not url:
+        return jsonify({"error": "missing url parameter"}), 400
+    
+    try:
+        url = unquote(url)
+        
+        try:
+            content = fetch_playlist(url)
+        except UpstreamStatusError as e:
+            print(f"M3U8 fetch error: {e.status}")
+            return jsonify({"error": f"Failed to fetch m3u8: {e.status}"}), e.http_status
+        
+        playlist, segments = rewrite_m3u8(content, url)
+        prefetch_segments(content, segments)
+        
+        response = Response(playlist, mimetype='application/vnd.apple.mpegurl')
+        response.headers.update(M3U8_RESPONSE_HEADERS)
+        
+        return response
+        
+    except requests.exceptions.Timeout:
+        print("M3U8 timeout")
+        return jsonify({"error": "M3U8 fetch timeout"}), 504
+    except Exception as e:
+        print(f"M3U8 proxy error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+# ======================
+# TRANSCODE - stream audio qua ffmpeg cho thiết bị không decode được webm/m4a
+# ======================
+
+# codec -> (encoder ffmpeg, container output, mimetype, bitrate mặc định)
+TRANSCODE_CODECS = {
+    "mp3": ("libmp3lame", "mp3", "audio/mpeg", "128k"),
+    "aac": ("aac", "adts", "audio/aac", "96k"),
+    "opus": ("libopus", "ogg", "audio/ogg", "64k"),
+}
+# Sample rate encoder hỗ trợ (libopus chỉ nhận các rate chuẩn của opus)
+TRANSCODE_SAMPLE_RATES = {
+    "mp3": (8000, 11025, 12000, 16000, 22050, 24000, 32000, 44100, 48000),
+    "aac": (8000, 11025, 12000, 16000, 22050, 24000, 32000, 44100, 48000),
+    "opus": (8000, 12000, 16000, 24000, 48000),
+}
+# mime của source (tham số mime= trong URL googlevideo) -> codec chỉ cần remux, không encode lại
+REMUX_SOURCES = {"audio/webm": "opus", "audio/mp4": "aac"}
+
+
+class TranscodeBusy(Exception):
+    """Đã đủ TRANSCODE_MAX ffmpeg đang chạy"""
+    status = 503
+
+
+class Transcoders:
+    """Giới hạn số ffmpeg đồng thời + counters cho /stats"""
+
+    def __init__(self, max_active):
+        self.max_active = max_active
+        self.lock = threading.Lock()
+        self.active = 0
+        self.started = 0
+        self.remuxed = 0
+        self.rejected = 0
+        self.killed = 0
+        self.failed = 0
+
+    def acquire(self):
+        with self.lock:
+            if self.active >= self.max_active:
+                self.rejected += 1
+                raise TranscodeBusy(f"too many transcoders ({self.max_active} active)")
+            self.active += 1
+            self.started += 1
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+
+    def count(self, field):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "max_active": self.max_active,
+                "active": self.active,
+                "started": self.started,
+                "remuxed": self.remuxed,
+                "rejected": self.rejected,
+                "killed": self.killed,
+                "failed": self.failed,
+            }
+
+
+transcoders = Transcoders(TRANSCODE_MAX)
+
+
+def transcode_options(args):
+    """codec / bitrate / sample_rate / channels từ query string, ValueError nếu không hợp lệ"""
+    codec = (args.get("codec") or "mp3").lower()
+    if codec not in TRANSCODE_CODECS:
+        raise ValueError(f"unsupported codec: {codec} (use one of {', '.join(TRANSCODE_CODECS)})")
+
+    bitrate = args.get("bitrate")
+    if bitrate is not None:
+        match = re.fullmatch(r'(\d+)k?', bitrate.strip().lower())
+        if not match or not 8 <= int(match.group(1)) <= 320:
+            raise ValueError(f"invalid bitrate: {bitrate} (8k-320k)")
+        bitrate = f"{match.group(1)}k"
+
+    sample_rate = args.get("sample_rate")
+    if sample_rate is not None:
+        if not sample_rate.isdigit() or int(sample_rate) not in TRANSCODE_SAMPLE_RATES[codec]:
+            raise ValueError(f"invalid sample_rate for {codec}: {sample_rate}")
+        sample_rate = int(sample_rate)
+
+    channels = args.get("channels")
+    if channels is not None:
+        if channels not in ("1", "2"):
+            raise ValueError(f"invalid channels: {channels} (1 or 2)")
+        channels = int(channels)
+
+    return {"codec": codec, "bitrate": bitrate, "sample_rate": sample_rate, "channels": channels}
+
+
+def can_remux(url, opts):
+    """Source đã đúng codec và client không đòi bitrate / sample rate / channels -> chỉ đổi container"""
+    if opts["bitrate"] or opts["sample_rate"] or opts["channels"]:
+        return False
+    mime = (parse_qs(urlparse(url).query).get("mime") or [""])[0]
+    return REMUX_SOURCES.get(mime) == opts["codec"]
+
+
+def ffmpeg_command(opts, remux=False):
+    encoder, container, _, default_bitrate = TRANSCODE_CODECS[opts["codec"]]
+    cmd = [TRANSCODE_FFMPEG, "-hide_banner", "-loglevel", "error", "-i", "pipe:0", "-vn"]
+    if remux:
+        cmd += ["-c:a", "copy"]
+    else:
+        cmd += ["-c:a", encoder, "-b:a", opts["bitrate"] or default_bitrate]
+        if opts["sample_rate"]:
+            cmd += ["-ar", str(opts["sample_rate"])]
+        if opts["channels"]:
+            cmd += ["-ac", str(opts["channels"])]
+    # Flush từng packet để thiết bị nhận byte đầu tiên ngay
+    return cmd + ["-flush_packets", "1", "-f", container, "pipe:1"]
+
+
+def open_transcode_source(url):
+    """
+    Toàn bộ media làm input cho ffmpeg: range cache nếu đã có, broadcast nếu bật, ngược lại
+    tải thẳng upstream và ghi vào range cache như /proxy. UpstreamStatusError nếu upstream lỗi.
+    """
+    headers = dict(PROXY_UPSTREAM_HEADERS)
+    media_key = media_identity(url)
+    shared = media_key and broadcasts.enabled
+
+    # Phòng khác đang phát cùng media: đọc chung upstream reader
+    if shared:
+        listener = broadcasts.listen(media_key, url, headers, 0, None, create=False)
+        if listener:
+            return listener
+
+    if media_key and range_cache.enabled:
+        cached = range_cache.lookup(media_key, None)
+        if cached:
+            start, end, _, _ = cached
+            return range_cache.iter_range(media_key, start, end, url, headers)
+
+    if shared:
+        listener = broadcasts.listen(media_key, url, headers, 0, None)
+        if listener:
+            return listener
+
+    # Relay riêng: ghi nhận từ lúc mở để client tiếp theo mở broadcast dùng chung
+    release = broadcasts.track(media_key) if shared else None
+    try:
+        chunks, total, content_type = open_upstream(url, headers)
+    except BaseException:
+        if release:
+            release()
+        raise
+    writer = None
+    if media_key and range_cache.register(media_key, total, content_type):
+        writer = _ChunkWriter(range_cache, media_key, 0, total)
+
+    def generate():
+        try:
+            for chunk in chunks:
+                if writer:
+                    writer.feed(chunk)
+                yield chunk
+        finally:
+            chunks.close()
+
+    return TrackedBody(generate(), release) if release else generate()
+
+
+def _feed_ffmpeg(proc, source):
+    """Thread đẩy bytes upstream vào stdin của ffmpeg"""
+    try:
+        for chunk in iter_views(source):
+            proc.stdin.write(chunk)
+    except (BrokenPipeError, ValueError):
+        pass  # ffmpeg đã thoát / bị kill khi client ngắt kết nối
+    except Exception as e:
+        print(f"Transcode source error: {e}")
+    finally:
+        source.close()
+        try:
+            proc.stdin.close()
+        except (BrokenPipeError, ValueError):
+            pass
+
+
+class _TranscodeOutput:
+    """
+    Output của ffmpeg. close() (hết stream hoặc client ngắt kết nối, kể cả khi chưa đọc
+    chunk nào) -> kill ffmpeg nếu còn chạy và trả slot.
+    """
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = b"" if self.closed else self.proc.stdout.read1(RELAY_CHUNK_MIN)
+        if data:
+            return data
+        if not self.closed and self.proc.wait() != 0:
+            print(f"ffmpeg exited with {self.proc.returncode}")
+            transcoders.count("failed")
+        self.close()
+        raise StopIteration
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.proc.poll() is None:
+            self.proc.kill()
+            transcoders.count("killed")
+        self.proc.wait()
+        self.proc.stdout.close()
+        transcoders.release()
+
+
+def start_transcode(url, opts):
+    """
+    Chiếm một slot, mở source và spawn ffmpeg (stdin <- upstream, stdout -> client).
+    TranscodeBusy nếu hết slot, UpstreamStatusError nếu upstream lỗi.
+    """
+    transcoders.acquire()
+    try:
+        source = open_transcode_source(url)
+        try:
+            remux = can_remux(url, opts)
+            proc = subprocess.Popen(ffmpeg_command(opts, remux), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        except Exception:
+            source.close()
+            raise
+    except Exception:
+        transcoders.release()
+        raise
+
+    if remux:
+        transcoders.count("remuxed")
+    threading.Thread(target=_feed_ffmpeg, args=(proc, source), name="transcode-feed", daemon=True).start()
+    return _TranscodeOutput(proc)
+
+
+def transcode_headers(opts):
+    return {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, OPTIONS',
+        'Content-Type': TRANSCODE_CODECS[opts["codec"]][2],
+        # Output sinh ra theo thời gian thực: không seek được, không cache
+        'Accept-Ranges': 'none',
+        'Cache-Control': 'no-store',
+    }
+
+
+def transcode_query(opts):
+    """Query string (sau url=...) của /transcode cho opts"""
+    return "".join(f"&{k}={v}" for k, v in opts.items() if v)
+
+
+@app.route('/transcode', methods=['GET', 'OPTIONS'])
+def transcode_stream():
+    """Stream audio transcode sang mp3/aac/opus (chunked) cho loa không decode được webm/m4a"""
+    if request.method == 'OPTIONS':
+        response = Response()
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
+        response.headers['Access-Control-Max-Age'] = '3600'
+        return response
+
+    url = request.args.get('url')
+    if not url:
+        return jsonify({"error": "missing url parameter"}), 400
+
+    try:
+        opts = transcode_options(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        output = start_transcode(unquote(url), opts)
+    except TranscodeBusy as e:
+        print(f"Transcode unavailable: {e}")
+        return busy_response(e)
+    except UpstreamStatusError as e:
+        print(f"Transcode error: Status {e.status}")
+        return jsonify({"error": str(e)}), e.http_status
+    except requests.exceptions.Timeout:
+        print("Transcode timeout")
+        return jsonify({"error": "Request timeout"}), 504
+    except requests.exceptions.ConnectionError as e:
+        print(f"Connection error: {e}")
+        return jsonify({"error": "Connection failed"}), 502
+    except Exception as e:
+        print(f"Transcode error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+    # Không có Content-Length -> chunked transfer
+    return Response(MeteredBody(output, "transcode"), headers=transcode_headers(opts))
+
+
+# ======================
+# THUMBNAIL - resize / re-encode cho màn hình yếu, cache trên disk
+# ======================
+
+_VIDEO_ID_RE = re.compile(r'[A-Za-z0-9_-]{11}')
+# format -> (đuôi file cache, Content-Type)
+THUMB_FORMATS = {
+    "jpeg": ("jpg", "image/jpeg"),
+    "rgb565": ("rgb565", "application/octet-stream"),     # little-endian (ESP32 / LVGL)
+    "rgb565be": ("rgb565be", "application/octet-stream"),
+}
+THUMB_FITS = ("cover", "contain")
+
+
+class ThumbnailUnavailable(Exception):
+    """Resize cần Pillow (optional dependency) mà image không cài được"""
+    status = 501
+
+
+class ThumbCache(_LoadOnFirstUse):
+    """
+    Thumbnail trên disk: mỗi video một thư mục gồm ảnh gốc và các biến thể đã resize /
+    re-encode. Ảnh gốc chỉ tải một lần cho mọi biến thể; evict cả video theo LRU khi vượt max_bytes.
+    """
+
+    ORIGINAL = "original.jpg"
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._videos = OrderedDict()  # video id -> tổng bytes trên disk
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.fetched = 0
+        self.rendered = 0
+        self.evictions = 0
+        if max_bytes <= 0:
+            self._enabled = False
+
+    def _load(self):
+        try:
+            os.makedirs(self.root, exist_ok=True)
+        except OSError as e:
+            print(f"[thumbs] Disk cache disabled, cannot create {self.root}: {e}")
+            return False
+
+        found = []
+        for video_id in os.listdir(self.root):
+            path = os.path.join(self.root, video_id)
+            try:
+                names = os.listdir(path)
+                size = sum(os.path.getsize(os.path.join(path, name)) for name in names)
+                found.append((os.path.getmtime(path), video_id, size))
+            except OSError:
+                shutil.rmtree(path, ignore_errors=True)
+
+        for _, video_id, size in sorted(found):
+            self._videos[video_id] = size
+            self._bytes += size
+        return True
+
+    def get(self, video_id, variant, produce):
+        """Bytes của biến thể từ disk, miss thì produce() rồi lưu lại"""
+        path = os.path.join(self.root, video_id, variant)
+        if self.enabled:
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                with self._lock:
+                    self.hits += 1
+                    if video_id in self._videos:
+                        self._videos.move_to_end(video_id)
+                return data
+            except OSError:
+                pass
+        with self._lock:
+            self.misses += 1
+
+        data = produce()
+        with self._lock:
+            if variant == self.ORIGINAL:
+                self.fetched += 1
+            else:
+                self.rendered += 1
+        if self.enabled and len(data) <= self.max_bytes:
+            self._store(video_id, path, data)
+        return data
+
+    def _store(self, video_id, path, data):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Ghi file tạm rồi rename: request khác không đọc được file ghi dở
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[thumbs] Cannot write {path}: {e}")
+            return
+
+        with self._lock:
+            self._videos[video_id] = self._videos.get(video_id, 0) + len(data)
+            self._videos.move_to_end(video_id)
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes and len(self._videos) > 1:
+                oldest, size = self._videos.popitem(last=False)
+                self._bytes -= size
+                self.evictions += 1
+                shutil.rmtree(os.path.join(self.root, oldest), ignore_errors=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "videos": len(self._videos),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "fetched": self.fetched,
+                "rendered": self.rendered,
+                "evictions": self.evictions,
+            }
+
+
+thumb_cache = ThumbCache(THUMB_CACHE_DIR, THUMB_CACHE_MAX_MB * 1024 * 1024)
+thumb_flights = SingleFlight(30)
+
+
+def thumb_spec(args):
+    """
+    Tham số /thumb: w, h (px), format (jpeg | rgb565 | rgb565be), fit (cover | contain), q (chất
+    lượng JPEG). Không có tham số nào -> None (trả ảnh gốc). ValueError nếu sai.
+    """
+    if not any(k in args for k in ("w", "h", "format", "fit", "q")):
+        return None
+    try:
+        width = int(args["w"]) if args.get("w") else None
+        height = int(args["h"]) if args.get("h") else None
+        quality = int(args.get("q") or 75)
+    except ValueError:
+        raise ValueError("w, h, q must be integers")
+    fmt = args.get("format") or "jpeg"
+    fit = args.get("fit") or "cover"
+    if fmt not in THUMB_FORMATS:
+        raise ValueError(f"unsupported format: {fmt} ({', '.join(THUMB_FORMATS)})")
+    if fit not in THUMB_FITS:
+        raise ValueError(f"unsupported fit: {fit} ({', '.join(THUMB_FITS)})")
+    if any(v is not None and not 1 <= v <= THUMB_MAX_SIZE for v in (width, height)):
+        raise ValueError(f"w, h must be between 1 and {THUMB_MAX_SIZE}")
+    if not 1 <= quality <= 95:
+        raise ValueError("q must be between 1 and 95")
+    if fmt != "jpeg" and not (width and height):
+        # Raw pixel: client cần biết chính xác kích thước
+        raise ValueError(f"{fmt} requires both w and h")
+    return {"width": width, "height": height, "format": fmt, "fit": fit, "quality": quality}
+
+
+def thumb_variant(spec):
+    """Tên file cache của biến thể"""
+    ext = THUMB_FORMATS[spec["format"]][0]
+    quality = f"_q{spec['quality']}" if spec["format"] == "jpeg" else ""
+    return f"{spec['width'] or ''}x{spec['height'] or ''}_{spec['fit']}{quality}.{ext}"
+
+
+def thumb_url(video_id, params=None):
+    """URL /thumb của video (params mặc định theo format policy, ví dụ {"w": 320, "h": 180})"""
+    if not video_id:
+        return None
+    return f"/thumb/{video_id}" + (f"?{urlencode(params)}" if params else "")
+
+
+def fetch_thumbnail(video_id):
+    """Ảnh gốc từ i.ytimg.com (THUMB_SOURCE)"""
+    resp = upstream.get(THUMB_SOURCE.format(id=video_id), stream=True, timeout=10)
+    if resp.status_code != 200:
+        resp.close()
+        raise UpstreamStatusError(resp.status_code)
+    return read_body(resp)
+
+
+def _rgb565(img, big_endian=False):
+    """RGB565 raw từ ảnh RGB: tính hai byte của mỗi pixel bằng point() / add() (C), không loop Python"""
+    from PIL import Image, ImageChops
+
+    r, g, b = img.split()
+    high = ImageChops.add(r.point(lambda v: v & 0xF8), g.point(lambda v: v >> 5))
+    low = ImageChops.add(g.point(lambda v: (v << 3) & 0xE0), b.point(lambda v: v >> 3))
+    return Image.merge("LA", (high, low) if big_endian else (low, high)).tobytes()
+
+
+def render_thumbnail(data, spec):
+    """Resize + re-encode ảnh gốc theo spec (cần Pillow)"""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        raise ThumbnailUnavailable("Pillow is not installed: /thumb can only serve the original thumbnail")
+
+    with Image.open(io.BytesIO(data)) as source:
+        img = source.convert("RGB")
+    width, height = spec["width"], spec["height"]
+    if width and height:
+        if spec["fit"] == "cover":
+            img = ImageOps.fit(img, (width, height), Image.LANCZOS)
+        else:
+            img = ImageOps.contain(img, (width, height), Image.LANCZOS)
+            if spec["format"] != "jpeg":
+                # Raw pixel luôn đúng w x h: thêm viền đen
+                img = ImageOps.pad(img, (width, height), color=(0, 0, 0))
+    elif width or height:
+        scale = (width or img.width * height / img.height) / img.width
+        img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+
+    if spec["format"] == "jpeg":
+        # Baseline (không progressive): decoder JPEG của ESP32 chỉ đọc được baseline
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=spec["quality"], optimize=True, progressive=False)
+        return out.getvalue()
+    return _rgb565(img, big_endian=spec["format"] == "rgb565be")
+
+
+def thumbnail_bytes(video_id, spec):
+    """Bytes của thumbnail (gốc nếu spec None); request trùng chỉ tải / render một lần"""
+    def original():
+        return thumb_flights.do(
+            f"{video_id}/original",
+            lambda: thumb_cache.get(video_id, ThumbCache.ORIGINAL, lambda: fetch_thumbnail(video_id)),
+        )
+
+    if spec is None:
+        return original()
+    variant = thumb_variant(spec)
+    return thumb_flights.do(
+        f"{video_id}/{variant}",
+        lambda: thumb_cache.get(video_id, variant, lambda: render_thumbnail(original(), spec)),
+    )
+
+
+@app.route('/thumb/<video_id>', methods=['GET'])
+def thumbnail(video_id):
+    """
+    Thumbnail của video, resize / re-encode theo ?w=&h=&format=&fit=&q= cho màn hình nhỏ.
+    Không cần API key (dùng trực tiếp trong <img>); ETag + Cache-Control để client không tải lại.
+    """
+    if not _VIDEO_ID_RE.fullmatch(video_id):
+        return jsonify({"error": "invalid video id"}), 400
+    try:
+        spec = thumb_spec(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        data = thumbnail_bytes(video_id, spec)
+    except UpstreamStatusError as e:
+        print(f"[/thumb] Upstream status {e.status} for {video_id}")
+        return jsonify({"error": str(e)}), 404 if e.status == 404 else 502
+    except ThumbnailUnavailable as e:
+        return jsonify({"error": str(e)}), e.status
+    except requests.exceptions.RequestException as e:
+        print(f"[/thumb] Connection error: {e}")
+        return jsonify({"error": "Connection failed"}), 502
+    except Exception as e:
+        print(f"[/thumb] Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+    response = Response(data, content_type=THUMB_FORMATS[spec["format"]][1] if spec else "image/jpeg")
+    response.set_etag(hashlib.sha1(data).hexdigest()[:20])
+    response.headers['Cache-Control'] = f'public, max-age={THUMB_MAX_AGE}'
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    if spec and spec["format"] != "jpeg":
+        response.headers['X-Image-Width'] = str(spec["width"])
+        response.headers['X-Image-Height'] = str(spec["height"])
+    # 304 nếu If-None-Match khớp ETag
+    return response.make_conditional(request)
+
+
+# ======================
+# FORMAT SELECTION - policy theo loại thiết bị
+# ======================
+
+# Mỗi policy gồm rule cho audio-only / muxed / HLS (None = không chọn loại đó).
+# audio: codecs ưu tiên, khoảng bitrate (kbps), "lowest"/"highest"
+# video, hls: chiều cao tối đa, ext ưu tiên
+# transcode (tuỳ chọn): tham số /transcode cho audio
+FORMAT_POLICIES = {
+    # Mặc định: audio bitrate cao nhất, muxed <= 1080p
+    "default": {
+        "audio": {"prefer": "highest"},
+        "video": {"max_height": 1080, "ext": "mp4"},
+        "hls": {"max_height": 1080},
+    },
+    # Loa ESPHome: audio opus/aac nhẹ nhất nhưng >= 64 kbps, không cần video
+    "esp-audio": {
+        "audio": {"codecs": ("opus", "mp4a"), "min_abr": 64, "prefer": "lowest"},
+        "video": None,
+        "hls": None,
+        # Kèm transcode_url: mp3 mono cho loa không decode được opus/aac
+        "transcode": {"codec": "mp3", "bitrate": "64k", "sample_rate": None, "channels": 1},
+        # thumb_url: JPEG baseline nhỏ cho màn hình của loa (nếu có)
+        "thumb": {"w": 160, "h": 120, "q": 70},
+    },
+    # Màn hình nhỏ: muxed mp4 <= 480p, audio vừa đủ
+    "screen": {
+        "audio": {"min_abr": 64, "prefer": "lowest"},
+        "video": {"max_height": 480, "ext": "mp4"},
+        "hls": {"max_height": 480},
+        "thumb": {"w": 320, "h": 180},
+    },
+    # Chất lượng cao nhất
+    "hifi": {
+        "audio": {"prefer": "highest"},
+        "video": {"max_height": 2160},
+        "hls": {"max_height": 2160},
+    },
+}
+
+
+def request_policy(data):
+    """Policy của request: "policy" trong body, hoặc theo "device" (DEVICE_POLICIES), mặc định "default" """
+    name = data.get("policy") or DEVICE_POLICIES.get(data.get("device") or "") or "default"
+    if name not in FORMAT_POLICIES:
+        raise ValueError(f"unknown policy: {name} (available: {', '.join(FORMAT_POLICIES)})")
+    return name
+
+
+def _bitrate(f, duration):
+    """kbps: abr/tbr, hoặc ước lượng từ filesize nếu thiếu"""
+    rate = f.get("abr") or f.get("tbr")
+    if rate:
+        return rate
+    size = f.get("filesize") or f.get("filesize_approx")
+    if size and duration:
+        return size * 8 / duration / 1000
+    return 0
+
+
+def index_formats(info):
+    """Một lượt qua info["formats"]: phân loại audio-only / muxed / HLS kèm bitrate"""
+    index = {"audio": [], "video": [], "hls": []}
+    duration = info.get("duration")
+
+    for f in info.get("formats") or []:
+        if not f.get("url"):
+            continue
+        vcodec = f.get("vcodec") or "none"
+        acodec = f.get("acodec") or "none"
+        protocol = f.get("protocol") or ""
+
+        if protocol.startswith("m3u8"):
+            if vcodec != "none":
+                index["hls"].append(f)
+        elif vcodec == "none" and acodec != "none":
+            index["audio"].append((_bitrate(f, duration), f))
+        elif vcodec != "none" and acodec != "none":
+            index["video"].append(f)
+
+    return index
+
+
+def _select_audio(candidates, rule):
+    if not candidates or rule is None:
+        return None
+    codecs = rule.get("codecs")
+    min_abr = rule.get("min_abr", 0)
+    max_abr = rule.get("max_abr", float("inf"))
+
+    def matches(rate, f, check_codec, check_rate):
+        if check_codec and codecs and not (f.get("acodec") or "").startswith(codecs):
+            return False
+        return not check_rate or min_abr <= rate <= max_abr
+
+    # Nới dần điều kiện nếu không format nào thỏa: bỏ codec, rồi bỏ khoảng bitrate
+    for check_codec, check_rate in ((True, True), (False, True), (False, False)):
+        matched = [(rate, f) for rate, f in candidates if matches(rate, f, check_codec, check_rate)]
+        if matched:
+            pick = min if rule.get("prefer") == "lowest" else max
+            return pick(matched, key=lambda item: item[0])[1]
+    return None
+
+
+def _select_video(candidates, rule):
+    if not candidates or rule is None:
+        return None
+    max_height = rule.get("max_height", float("inf"))
+    allowed = [f for f in candidates if (f.get("height") or 0) <= max_height]
+    if not allowed:
+        return None
+    ext = rule.get("ext")
+    return max(allowed, key=lambda f: ((f.get("height") or 0), f.get("ext") == ext, f.get("tbr") or 0))
+
+
+def pick_formats(info, policy="default"):
+    """(audio, video, hls) theo policy: audio-only, muxed (có cả audio), HLS variant"""
+    rules = FORMAT_POLICIES[policy]
+    index = index_formats(info)
+    return (
+        _select_audio(index["audio"], rules["audio"]),
+        _select_video(index["video"], rules["video"]),
+        _select_video(index["hls"], rules["hls"]),
+    )
+
+
+# ======================
+# RESOLVE ENDPOINT - một lần extract, trả về cả audio/video/HLS
+# ======================
+
+RESOLVE_YDL_OPTS = {
+    "quiet": True,
+    "default_search": "ytsearch1",
+    "skip_download": True,
+    "noplaylist": True,
+    # Chỉ để yt-dlp không báo lỗi format; việc chọn format do pick_formats() làm
+    "format": "bestaudio/best",
+    # Không dùng live_from_start: video live khi đó chỉ còn DASH từ đầu buổi phát, mất format HLS
+    # mà /play, /play_on_go2rtc, /search, /get_video_stream và field hls của /resolve cần
+    "extractor_retries": 3,
+    "extractor_args": {
+        "youtube": {
+            # web_creator như /search cũ: vẫn có formats khi các client khác bị chặn
+            "player_client": ["web", "android", "ios", "web_creator"],
+        }
+    },
+}
+
+# Search nhẹ "ytsearchN:<query>": chỉ lấy danh sách kết quả (id, title...), không extract formats
+SEARCH_YDL_OPTS = {
+    "quiet": True,
+    "skip_download": True,
+    "extract_flat": "in_playlist",
+    "extractor_retries": 3,
+}
+
+# Profile ydl_opts mà worker dựng sẵn YoutubeDL khi khởi động
+EXTRACT_PROFILES = {
+    "resolve": RESOLVE_YDL_OPTS,
+    "search": SEARCH_YDL_OPTS,
+}
+
+extraction_pool = ExtractionPool(EXTRACT_WORKERS, EXTRACT_QUEUE, EXTRACT_TIMEOUT, EXTRACT_PROFILES) if EXTRACT_WORKERS > 0 else None
+
 
-# Simple API key auth
-def auth(req):
-    if not API_KEY:
+# ======================
+# QUERY INDEX - query quen (voice intent) đi thẳng tới video id, không ytsearch lại
+# ======================
+
+class QueryIndex(_LoadOnFirstUse):
+    """
+    Map query text (đã normalize như cache_key) -> video id + metadata trong SQLite, kèm số lần
+    hit và lần dùng gần nhất; sống qua restart add-on. Entry cũ hơn refresh_age được search
+    lại ở thread nền (hit nhiều trước), request không phải chờ search.
+    """
+
+    def __init__(self, path, max_entries, refresh_age, refresh_interval, refresh_batch):
+        self.path = path
+        self.max_entries = max_entries
+        self.refresh_age = refresh_age
+        self.refresh_interval = refresh_interval
+        self.refresh_batch = refresh_batch
+        self._lock = threading.Lock()
+        self._db = None
+        self.thread = None
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+        self.forgotten = 0
+        self.refreshed = 0
+        self.changed = 0
+        self.failed = 0
+        if not path:
+            self._enabled = False
+
+    def _load(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # Autocommit; WAL + synchronous=NORMAL: không fsync mỗi lần cập nhật hits
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS queries ("
+                " query TEXT PRIMARY KEY, video_id TEXT NOT NULL, title TEXT, channel TEXT,"
+                " duration REAL, hits INTEGER NOT NULL DEFAULT 0, last_used REAL NOT NULL,"
+                " refreshed_at REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS queries_last_used ON queries (last_used)")
+        except (OSError, sqlite3.Error) as e:
+            print(f"[query_index] Disabled, cannot open {self.path}: {e}")
+            return False
+        self._db = db
         return True
-    return req.headers.get("X-API-Key") == API_KEY
+
+    def _execute(self, sql, params=()):
+        # Lỗi SQLite (disk đầy, file hỏng...) không được làm hỏng request: coi như miss
+        try:
+            return self._db.execute(sql, params).fetchall()
+        except sqlite3.Error as e:
+            print(f"[query_index] {e}")
+            return []
+
+    def start(self):
+        with self._lock:
+            if self.thread is not None or not self.enabled or self.refresh_age <= 0:
+                return
+            self.thread = threading.Thread(target=self._run, name="query-index", daemon=True)
+        self.thread.start()
+
+    def lookup(self, text):
+        """Video id đã lưu cho query (tăng hits, cập nhật last_used); None nếu chưa biết"""
+        if not self.enabled:
+            return None
+        self.start()
+        with self._lock:
+            rows = self._execute("SELECT video_id FROM queries WHERE query = ?", (text,))
+            if not rows:
+                self.misses += 1
+                return None
+            self._execute("UPDATE queries SET hits = hits + 1, last_used = ? WHERE query = ?", (time.time(), text))
+            self.hits += 1
+            return rows[0][0]
+
+    def record(self, text, info):
+        """Lưu video mà search của query trả về (info đã extract), giữ tối đa max_entries"""
+        if not self.enabled or not info.get("id") or "entries" in info:
+            return
+        now = time.time()
+        with self._lock:
+            self._execute(
+                "INSERT INTO queries (query, video_id, title, channel, duration, hits, last_used, refreshed_at)"
+                " VALUES (?, ?, ?, ?, ?, 0, ?, ?) ON CONFLICT (query) DO UPDATE SET"
+                " video_id = excluded.video_id, title = excluded.title, channel = excluded.channel,"
+                " duration = excluded.duration, last_used = excluded.last_used, refreshed_at = excluded.refreshed_at",
+                (text, info["id"], info.get("title"), info.get("channel") or info.get("uploader"),
+                 info.get("duration"), now, now),
+            )
+            # Quá giới hạn: bỏ các query lâu không dùng nhất
+            self._execute(
+                "DELETE FROM queries WHERE query IN"
+                " (SELECT query FROM queries ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self.recorded += 1
+
+    def forget(self, text):
+        """Xoá query (video đã lưu không còn xem được) để lần sau search lại"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._execute("DELETE FROM queries WHERE query = ?", (text,))
+            self.forgotten += 1
+
+    def _run(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh_stale()
+            except Exception as e:
+                print(f"[query_index] Refresh error: {e}")
+
+    def refresh_stale(self):
+        """Search lại tối đa refresh_batch entry cũ hơn refresh_age, query hit nhiều trước"""
+        with self._lock:
+            rows = self._execute(
+                "SELECT query, video_id FROM queries WHERE refreshed_at < ?"
+                " ORDER BY hits DESC, last_used DESC LIMIT ?",
+                (time.time() - self.refresh_age, self.refresh_batch),
+            )
+        for text, video_id in rows:
+            try:
+                info = run_extraction("search", SEARCH_YDL_OPTS, f"ytsearch1:{text}")
+                entry = next(iter(info.get("entries") or []), None)
+            except ExtractionBusy:
+                return  # Worker đang bận với request thật: để lượt sau
+            except Exception as e:
+                print(f"[query_index] Refresh failed for '{text}': {e}")
+                entry = None
+
+            with self._lock:
+                if not entry or not entry.get("id"):
+                    # Giữ video cũ, thử lại sau một chu kỳ refresh_age
+                    self.failed += 1
+                    self._execute("UPDATE queries SET refreshed_at = ? WHERE query = ?", (time.time(), text))
+                    continue
+                self._execute(
+                    "UPDATE queries SET video_id = ?, title = ?, channel = ?, duration = ?, refreshed_at = ?"
+                    " WHERE query = ?",
+                    (entry["id"], entry.get("title"), entry.get("channel") or entry.get("uploader"),
+                     entry.get("duration"), time.time(), text),
+                )
+                self.refreshed += 1
+                if entry["id"] != video_id:
+                    self.changed += 1
+                    print(f"[query_index] '{text}': {video_id} -> {entry['id']}")
+
+    def stats(self):
+        with self._lock:
+            rows = self._execute("SELECT COUNT(*) FROM queries") if self.enabled else []
+            return {
+                "enabled": self.enabled,
+                "path": self.path,
+                "entries": rows[0][0] if rows else 0,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "recorded": self.recorded,
+                "forgotten": self.forgotten,
+                "refreshed": self.refreshed,
+                "changed": self.changed,
+                "failed": self.failed,
+            }
+
+
+query_index = QueryIndex(
+    QUERY_INDEX_PATH, QUERY_INDEX_MAX, QUERY_INDEX_REFRESH_HOURS * 3600,
+    QUERY_INDEX_REFRESH_INTERVAL, QUERY_INDEX_REFRESH_BATCH,
+)
 
 
 # ======================
-# CONFIG ENDPOINT
+# WARM-UP + HEALTH - server bind ngay, yt-dlp load và chạy thử ở thread nền
 # ======================
 
-@app.route('/config', methods=['GET'])
-def get_config():
-    """Frontend gọi endpoint này để lấy API_KEY — không cần hardcode trong JS"""
-    return jsonify({"api_key": API_KEY})
+class WarmUp:
+    """
+    Import yt-dlp, spawn worker và chạy một extraction thử (mỗi worker một lần) ở thread nền,
+    để request thật đầu tiên sau khi restart không phải chịu cold start.
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self.state = "pending"  # pending -> loading -> extracting -> ready
+        self.warm_seconds = None
+        self.error = None
+        self._started = False
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, name="warmup", daemon=True).start()
+
+    def _run(self):
+        started = time.perf_counter()
+        try:
+            self.state = "loading"
+            yt_dlp.load()
+            if extraction_pool:
+                extraction_pool.start()
+            print(f"[warmup] yt-dlp loaded in {yt_dlp.load_seconds:.1f}s")
+
+            if self.query:
+                self.state = "extracting"
+                workers = [
+                    threading.Thread(target=self._extract, daemon=True)
+                    for _ in range(extraction_pool.size if extraction_pool else 1)
+                ]
+                for t in workers:
+                    t.start()
+                for t in workers:
+                    t.join()
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            self.warm_seconds = time.perf_counter() - started
+            self.state = "ready"
+            print(f"[warmup] ready in {self.warm_seconds:.1f}s" + (f" ({self.error})" if self.error else ""))
+
+    def _extract(self):
+        # Không qua info cache: mục đích là làm nóng YoutubeDL của từng worker
+        try:
+            run_extraction("resolve", RESOLVE_YDL_OPTS, self.query)
+        except Exception as e:
+            self.error = f"warm-up extraction failed: {e}"
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "ready": self.ready,
+            "yt_dlp_loaded": yt_dlp.loaded,
+            "load_seconds": round(yt_dlp.load_seconds, 3) if yt_dlp.load_seconds is not None else None,
+            "warm_seconds": round(self.warm_seconds, 3) if self.warm_seconds is not None else None,
+            "error": self.error,
+        }
+
+
+warmup = WarmUp(WARMUP_QUERY)
+
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness: process còn phục vụ được request. Không I/O, không cần API key"""
+    return jsonify({"status": "ok"})
+
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """Readiness: yt-dlp đã load và warm-up xong (503 khi chưa)"""
+    stats = warmup.stats()
+    return jsonify(stats), 200 if stats["ready"] else 503
+
+
+def resolve_info(query):
+    """
+    extract_info một lần cho mọi endpoint (dùng chung cache + single-flight). Query text đã có
+    trong query_index thì extract thẳng video id đã lưu, không qua ytsearch.
+    """
+    key = cache_key(query)
+    if not key.startswith("q:") or not query_index.enabled:
+        return extract_info_cached(query, RESOLVE_YDL_OPTS, "resolve")
+
+    text = key[2:]
+    video_id = query_index.lookup(text)
+    if video_id:
+        try:
+            return extract_info_cached(f"https://www.youtube.com/watch?v={video_id}", RESOLVE_YDL_OPTS, "resolve")
+        except yt_dlp.utils.DownloadError as e:
+            # Video bị xoá / private...: search lại như query mới
+            print(f"[query_index] {video_id} unavailable for '{text}': {e}")
+            query_index.forget(text)
+
+    info = extract_info_cached(query, RESOLVE_YDL_OPTS, "resolve")
+    query_index.record(text, info)
+    return info
+
+
+def _format_entry(f, proxy_path="/proxy", transcode=None, video_id=None):
+    if not f:
+        return None
+    entry = {
+        "format_id": f.get("format_id"),
+        "ext": f.get("ext"),
+        "height": f.get("height"),
+        "abr": f.get("abr"),
+        "tbr": f.get("tbr"),
+        "proxy_url": f"{proxy_path}?url={quote(f['url'])}",
+        "direct_url": f["url"],
+    }
+    if video_id and f.get("format_id"):
+        # URL ổn định: /proxy tự resolve lại khi googlevideo URL hết hạn / bị 403
+        entry["token_url"] = f"/proxy?token={quote(media_token(video_id, f['format_id']))}"
+    if transcode:
+        entry["transcode_url"] = f"/transcode?url={quote(f['url'])}{transcode_query(transcode)}"
+    return entry
+
+
+def build_resolution(info, policy="default"):
+    """Kết quả /resolve: metadata + audio/video/HLS (proxy URL và direct URL) theo policy"""
+    audio, video, hls = pick_formats(info, policy)
+    return {
+        "success": bool(audio or video or hls),
+        "policy": policy,
+        "id": info.get("id"),
+        "title": info.get("title"),
+        "artist": info.get("channel", ""),
+        "duration": info.get("duration"),
+        "is_live": info.get("is_live") or info.get("live_status") == "is_live",
+        "thumbnail": f"https://i.ytimg.com/vi/{info.get('id')}/hqdefault.jpg",
+        "thumb_url": thumb_url(info.get("id"), FORMAT_POLICIES[policy].get("thumb")),
+        "audio": _format_entry(audio, transcode=FORMAT_POLICIES[policy].get("transcode"), video_id=info.get("id")),
+        "video": _format_entry(video, video_id=info.get("id")),
+        "hls": _format_entry(hls, "/proxy_m3u8"),
+    }
+
+
+@app.route('/resolve', methods=['POST'])
+def resolve():
+    """Search + extract một lần, trả về audio-only, muxed <=1080p và HLS cùng lúc"""
+    if not auth(request):
+        return jsonify({"error": "unauthorized"}), 401
+
+    data = request.get_json(silent=True) or {}
+    query = data.get("query", "").strip()
+
+    if not query:
+        return jsonify({"success": False, "error": "missing query"}), 400
+
+    try:
+        policy = request_policy(data)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    try:
+        result = build_resolution(resolve_info(query), policy)
+        if not result["success"]:
+            result["error"] = "no playable stream"
+        return jsonify(result)
+
+    except ExtractionBusy as e:
+        print(f"Extraction unavailable: {e}")
+        return busy_response(e)
+    except yt_dlp.utils.DownloadError as de:
+        print(f"[/resolve] yt-dlp error: {de}")
+        return jsonify({"success": False, "error": f"yt-dlp error: {str(de)}"}), 500
+    except Exception as e:
+        print(f"[/resolve] Error: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
 
 
 # ======================
-# PROXY ENDPOINTS
+# RESOLVE BATCH - nhiều query / playlist, NDJSON từng dòng ngay khi item resolve xong
 # ======================
 
-@app.route('/proxy', methods=['GET', 'OPTIONS'])
-def proxy_stream():
-    """Proxy video/audio stream"""
-    if request.method == 'OPTIONS':
-        response = Response()
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
-        response.headers['Access-Control-Allow-Headers'] = 'Range, Content-Type, Accept'
-        response.headers['Access-Control-Max-Age'] = '3600'
-        return response
-    
-    url = request.args.get('url')
-    if not url:
-        return jsonify({"error": "missing url parameter"}), 400
-    
+# Giới hạn chung cho mọi batch: không đẩy quá nhiều job vào ExtractionPool (đầy -> 503)
+batch_executor = ThreadPoolExecutor(max_workers=max(RESOLVE_BATCH_WORKERS, 1), thread_name_prefix="resolve-batch")
+
+
+def is_playlist_url(query):
+    """URL playlist YouTube (có list=, không trỏ tới một video cụ thể)"""
+    if not query.startswith(("http://", "https://")) or _YT_ID_RE.search(query):
+        return False
+    return "list" in parse_qs(urlparse(query).query)
+
+
+def _resolve_batch_item(line, query, policy):
     try:
-        url = unquote(url)
-        
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Accept': '*/*',
-            'Accept-Language': 'en-US,en;q=0.9',
-            'Referer': 'https://www.youtube.com/',
-            'Origin': 'https://www.youtube.com',
-            'Sec-Fetch-Dest': 'video',
-            'Sec-Fetch-Mode': 'no-cors',
-            'Sec-Fetch-Site': 'cross-site',
-        }
-        
-        # Range request support
-        range_header = request.headers.get('Range')
-        if range_header:
-            headers['Range'] = range_header
-        
-        # Tăng timeout và thêm retry logic
-        session = requests.Session()
-        session.mount('https://', requests.adapters.HTTPAdapter(max_retries=3))
-        
-        resp = session.get(
-            url, 
-            headers=headers, 
-            stream=True, 
-            timeout=60,
-            allow_redirects=True
-        )
-        
-        # Check status
-        if resp.status_code not in [200, 206]:
-            print(f"Proxy error: Status {resp.status_code}")
-            return jsonify({"error": f"Upstream returned {resp.status_code}"}), resp.status_code
-        
-        @stream_with_context
-        def generate():
-            try:
-                for chunk in resp.iter_content(chunk_size=16384):
-                    if chunk:
-                        yield chunk
-            except Exception as e:
-                print(f"Stream error: {e}")
-        
-        response = Response(generate(), status=resp.status_code)
-        
-        # CORS headers
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
-        response.headers['Access-Control-Allow-Headers'] = 'Range'
-        response.headers['Access-Control-Expose-Headers'] = 'Content-Length, Content-Range, Accept-Ranges, Content-Type'
-        
-        # Content headers
-        response.headers['Content-Type'] = resp.headers.get('Content-Type', 'video/mp4')
-        
-        if 'Content-Length' in resp.headers:
-            response.headers['Content-Length'] = resp.headers['Content-Length']
-        if 'Content-Range' in resp.headers:
-            response.headers['Content-Range'] = resp.headers['Content-Range']
-        
-        response.headers['Accept-Ranges'] = 'bytes'
-        response.headers['Cache-Control'] = 'public, max-age=3600'
-            
-        return response
-        
-    except requests.exceptions.Timeout:
-        print("Proxy timeout")
-        return jsonify({"error": "Request timeout"}), 504
-    except requests.exceptions.ConnectionError as e:
-        print(f"Connection error: {e}")
-        return jsonify({"error": "Connection failed"}), 502
+        result = build_resolution(resolve_info(query), policy)
+        if not result["success"]:
+            result["error"] = "no playable stream"
+        line.update(result)
+    except ExtractionBusy as e:
+        line.update(success=False, error=str(e), status=e.status)
     except Exception as e:
-        print(f"Proxy error: {e}")
-        return jsonify({"error": str(e)}), 500
+        print(f"[/resolve_batch] Error for {query}: {e}")
+        line.update(success=False, error=str(e))
+    return line, []
 
 
-@app.route('/proxy_m3u8', methods=['GET', 'OPTIONS'])
-def proxy_m3u8():
-    """Proxy m3u8 playlist và rewrite URLs"""
-    if request.method == 'OPTIONS':
-        response = Response()
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
-        return response
-    
-    url = request.args.get('url')
-    if not url:
-        return jsonify({"error": "missing url parameter"}), 400
-    
+def _expand_playlist(line, url):
+    """Danh sách video của playlist qua flat extraction (không extract formats từng video)"""
     try:
-        url = unquote(url)
-        
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            'Referer': 'https://www.youtube.com/',
-            'Origin': 'https://www.youtube.com',
-            'Accept': '*/*'
-        }
-        
-        resp = requests.get(url, headers=headers, timeout=15)
-        
-        if resp.status_code != 200:
-            print(f"M3U8 fetch error: {resp.status_code}")
-            return jsonify({"error": f"Failed to fetch m3u8: {resp.status_code}"}), resp.status_code
-        
-        content = resp.text
-        lines = content.split('\n')
-        new_lines = []
-        base_url = '/'.join(url.split('/')[:-1])
-        
-        for line in lines:
-            stripped = line.strip()
-            
-            # Skip empty lines and comments
-            if not stripped or stripped.startswith('#'):
-                new_lines.append(line)
-                continue
-            
-            # Process URL lines
-            if stripped.startswith('http'):
-                # Absolute URL
-                proxied_url = f"/proxy?url={quote(stripped)}"
-            else:
-                # Relative URL
-                full_url = f"{base_url}/{stripped}"
-                proxied_url = f"/proxy?url={quote(full_url)}"
-            
-            new_lines.append(proxied_url)
-        
-        modified_content = '\n'.join(new_lines)
-        
-        response = Response(modified_content, mimetype='application/vnd.apple.mpegurl')
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
-        response.headers['Cache-Control'] = 'no-cache'
-        
-        return response
-        
-    except requests.exceptions.Timeout:
-        print("M3U8 timeout")
-        return jsonify({"error": "M3U8 fetch timeout"}), 504
+        info = timed_extraction("playlist", "search", SEARCH_YDL_OPTS, url)
     except Exception as e:
-        print(f"M3U8 proxy error: {e}")
-        return jsonify({"error": str(e)}), 500
+        print(f"[/resolve_batch] Playlist error for {url}: {e}")
+        line.update(success=False, error=str(e), status=getattr(e, "status", None))
+        return line, []
+    queries = [
+        f"https://www.youtube.com/watch?v={e['id']}"
+        for e in info.get("entries") or []
+        if e.get("id") and e.get("ie_key", "Youtube") == "Youtube"
+    ]
+    line.update(success=True, playlist=True, title=info.get("title"))
+    return line, queries
+
+
+def resolve_batch_lines(queries, policy):
+    """
+    Generator NDJSON: mỗi item một dòng theo thứ tự resolve xong (field "index" = vị trí trong
+    request, "position" = vị trí trong playlist), lỗi từng item không làm hỏng cả batch.
+    Playlist được mở rộng rồi resolve từng video, tổng số video không vượt RESOLVE_BATCH_MAX.
+    """
+    done = queue.Queue()
+    futures = []
+    budget = RESOLVE_BATCH_MAX - sum(1 for q in queries if not is_playlist_url(q))
+
+    def submit(fn, *args):
+        future = batch_executor.submit(fn, *args)
+        future.add_done_callback(done.put)
+        futures.append(future)
+
+    for index, query in enumerate(queries):
+        line = {"index": index, "query": query}
+        if is_playlist_url(query):
+            submit(_expand_playlist, line, query)
+        else:
+            submit(_resolve_batch_item, line, query, policy)
+
+    resolved = failed = 0
+    remaining = len(futures)
+    try:
+        while remaining:
+            future = done.get()
+            remaining -= 1
+            line, expanded = future.result()
+            if line.get("playlist"):
+                expanded = expanded[:max(budget, 0)]
+                budget -= len(expanded)
+                line["count"] = len(expanded)
+            for position, video_url in enumerate(expanded):
+                item = {"index": line["index"], "position": position, "query": video_url}
+                submit(_resolve_batch_item, item, video_url, policy)
+                remaining += 1
+            if not line.get("playlist"):
+                if line["success"]:
+                    resolved += 1
+                else:
+                    failed += 1
+            yield json.dumps(line) + "\n"
+        yield json.dumps({"done": True, "resolved": resolved, "failed": failed}) + "\n"
+    finally:
+        # Client ngắt giữa chừng: bỏ các item chưa chạy (item đang chạy vẫn vào info cache)
+        for future in futures:
+            future.cancel()
+
+
+@app.route('/resolve_batch', methods=['POST'])
+def resolve_batch():
+    """Resolve nhiều query / URL / playlist song song, stream kết quả dạng NDJSON"""
+    if not auth(request):
+        return jsonify({"error": "unauthorized"}), 401
+
+    data = request.get_json(silent=True) or {}
+    queries = data.get("queries")
+
+    if not isinstance(queries, list) or not queries:
+        return jsonify({"success": False, "error": "missing queries"}), 400
+    queries = [q.strip() if isinstance(q, str) else "" for q in queries]
+    if not all(queries):
+        return jsonify({"success": False, "error": "queries must be non-empty strings"}), 400
+    if len(queries) > RESOLVE_BATCH_MAX:
+        return jsonify({"success": False, "error": f"too many queries (max {RESOLVE_BATCH_MAX})"}), 400
+
+    try:
+        policy = request_policy(data)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    print(f"[/resolve_batch] {len(queries)} items")
+    response = Response(resolve_batch_lines(queries, policy), mimetype="application/x-ndjson")
+    # Proxy phía trước (Ingress của HA) không được gom cả response rồi mới gửi
+    response.headers["X-Accel-Buffering"] = "no"
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
 
 # ======================
@@ -214,151 +3859,161 @@ def search_video():
     if not query:
         return jsonify({"success": False, "error": "missing query"}), 400
 
-    ydl_opts = {
-        "quiet": True,
-        "default_search": "ytsearch1",
-        "skip_download": True,
-        "noplaylist": True,
-        "format": "bestaudio/best",
-        "extractor_args": {
-            "youtube": {
-                "player_client": ["web", "android", "ios", "web_creator"],
-                "player_skip": ["js", "web"],
-            }
-        },
-        "no_warnings": False,
-    }
-
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(query, download=False)
-            if "entries" in info:
-                info = info["entries"][0]
-
-        # Extract audio stream - proxy qua backend
-        stream_url = None
-        for f in info.get("formats", []):
-            url = f.get("url")
-            if url and "googlevideo.com" in url and f.get("acodec") != "none" and f.get("vcodec") == "none":
-                stream_url = f"/proxy?url={quote(url)}"
-                break
+        resolved = build_resolution(resolve_info(query))
 
-        # Extract video
-        video_url = None
-        best_video = None
-        best_height = 0
-        
-        for f in info.get("formats", []):
-            url = f.get("url", "")
-            if "googlevideo.com" in url and f.get("vcodec") != "none":
-                height = f.get("height", 0) or 0
-                if height > best_height:
-                    best_height = height
-                    best_video = url
-        
-        if best_video:
-            video_url = f"/proxy?url={quote(best_video)}"
+        stream_url = resolved["audio"]["proxy_url"] if resolved["audio"] else None
+        video_url = resolved["video"]["proxy_url"] if resolved["video"] else None
 
         if not stream_url and not video_url:
             return jsonify({"success": False, "error": "no playable stream"}), 200
 
         result = {
             "success": True,
-            "title": info.get("title"),
-            "duration": info.get("duration"),
+            "title": resolved["title"],
+            "duration": resolved["duration"],
             "stream_url": stream_url or video_url,
             "video_url": video_url,
-            "thumbnail": f"https://i.ytimg.com/vi/{info.get('id')}/hqdefault.jpg",
-            "artist": info.get("channel", ""),
+            "thumbnail": resolved["thumbnail"],
+            "thumb_url": resolved["thumb_url"],
+            "artist": resolved["artist"],
+        }
+        return jsonify(result)
+
+    except ExtractionBusy as e:
+        print(f"Extraction unavailable: {e}")
+        return busy_response(e)
+    except Exception as e:
+        print(f"Search error: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+@app.route('/get_video_stream', methods=['POST'])
+def get_video_stream():
+    """Legacy endpoint - trả về proxy URLs cho frontend"""
+    if not auth(request):
+        return jsonify({"error": "unauthorized"}), 401
+        
+    data = request.get_json(silent=True) or {}
+    query = data.get("query", "").strip()
+
+    if not query:
+        return jsonify({"success": False, "error": "missing query"}), 400
+
+    try:
+        resolved = build_resolution(resolve_info(query))
+
+        video_url = None
+        if resolved["video"]:
+            video_url = resolved["video"]["proxy_url"]
+            print(f"✓ Selected format: {resolved['video']['format_id']} - {resolved['video']['height']}p")
+        elif resolved["hls"]:
+            # Live stream chỉ có HLS
+            video_url = resolved["hls"]["proxy_url"]
+
+        if not video_url:
+            return jsonify({
+                "success": False, 
+                "error": "Không tìm thấy stream video có âm thanh"
+            }), 200
+
+        result = {
+            "success": True,
+            "title": resolved["title"],
+            "duration": resolved["duration"],
+            "video_url": video_url,
+            "is_live": resolved["is_live"],
+            "thumbnail": resolved["thumbnail"],
+            "thumb_url": resolved["thumb_url"],
+            "artist": resolved["artist"],
         }
         return jsonify(result)
 
-    except Exception as e:
-        print(f"Search error: {e}")
-        return jsonify({"success": False, "error": str(e)}), 500
+    except ExtractionBusy as e:
+        print(f"Extraction unavailable: {e}")
+        return busy_response(e)
+    except yt_dlp.utils.DownloadError as de:
+        print(f"yt-dlp error: {de}")
+        return jsonify({"success": False, "error": f"yt-dlp error: {str(de)}"}), 500
+    except Exception as e:
+        print(f"Get video error: {e}")
+        return jsonify({"success": False, "error": f"Unexpected error: {str(e)}"}), 500
+
+
+def direct_urls(resolved):
+    """(video_url, audio_url) direct cho go2rtc; thiếu cái nào thì dùng cái còn lại"""
+    video = resolved["video"] or resolved["hls"]
+    video_url = video["direct_url"] if video else None
+    audio_url = resolved["audio"]["direct_url"] if resolved["audio"] else None
+    return video_url or audio_url, audio_url or video_url
+
+
+# ======================
+# SEARCH LIST ENDPOINT - top N kết quả, flat extraction (một lần tải trang search)
+# ======================
+
+def search_entry(entry):
+    """Một kết quả flat search: metadata để hiển thị, formats chỉ resolve khi phát (/resolve, /play...)"""
+    return {
+        "id": entry["id"],
+        "title": entry.get("title"),
+        "channel": entry.get("channel") or entry.get("uploader", ""),
+        "duration": entry.get("duration"),
+        "is_live": entry.get("live_status") == "is_live",
+        "thumbnail": f"https://i.ytimg.com/vi/{entry['id']}/hqdefault.jpg",
+        "thumb_url": thumb_url(entry["id"]),
+        "url": f"https://www.youtube.com/watch?v={entry['id']}",
+    }
+
 
+def search_results(query, limit):
+    """Top `limit` kết quả cho query, cache SEARCH_LIST_TTL giây; request trùng chỉ search một lần"""
+    key = f"search:{limit}:{normalize_query(query)}"
+    results = search_cache.get(key)
+    if results is not None:
+        return results
+    return extractions.do(key, lambda: _search_and_store(query, limit, key))
 
-@app.route('/get_video_stream', methods=['POST'])
-def get_video_stream():
-    """Legacy endpoint - trả về proxy URLs cho frontend"""
+
+def _search_and_store(query, limit, key):
+    info = timed_extraction("search_list", "search", SEARCH_YDL_OPTS, f"ytsearch{limit}:{query}")
+    # Bỏ kết quả không phải video (channel, playlist...)
+    results = [search_entry(e) for e in info.get("entries") or [] if e.get("id") and e.get("ie_key", "Youtube") == "Youtube"]
+    search_cache.put([key], results, len(json.dumps(results)), time.time() + SEARCH_LIST_TTL)
+    return results
+
+
+@app.route('/search_list', methods=['POST'])
+def search_list():
+    """Danh sách kết quả search (id, title, channel, duration, thumbnail) để UI cho chọn"""
     if not auth(request):
         return jsonify({"error": "unauthorized"}), 401
-        
+
     data = request.get_json(silent=True) or {}
     query = data.get("query", "").strip()
 
     if not query:
         return jsonify({"success": False, "error": "missing query"}), 400
 
-    ydl_opts = {
-        "quiet": True,
-        "default_search": "ytsearch1",
-        "skip_download": True,
-        "noplaylist": True,
-        "format": "best[ext=mp4][height<=1080]/best[height<=1080]/best",
-        "live_from_start": True,
-        "extractor_retries": 10,
-    }
+    try:
+        limit = int(data.get("limit", SEARCH_LIST_DEFAULT))
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "error": "invalid limit"}), 400
+    limit = max(1, min(limit, SEARCH_LIST_MAX))
 
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(query, download=False)
-
-            if "entries" in info and info["entries"]:
-                info = info["entries"][0]
-
-            is_live = info.get("is_live") or info.get("live_status") == "is_live"
-
-            video_url = None
-            best_format = None
-            best_height = 0
-            
-            for f in info.get("formats", []):
-                url = f.get("url", "")
-                protocol = f.get("protocol", "")
-                vcodec = f.get("vcodec", "none")
-                acodec = f.get("acodec", "none")
-                
-                if ("googlevideo.com" in url and 
-                    vcodec != "none" and 
-                    acodec != "none" and
-                    not protocol.startswith("m3u8")):
-                    
-                    height = f.get("height", 0) or 0
-                    if height <= 1080 and height > best_height:
-                        best_height = height
-                        best_format = f
-            
-            if best_format:
-                video_url = f"/proxy?url={quote(best_format['url'])}"
-                print(f"✓ Selected format: {best_format.get('format_id')} - {best_height}p")
-
-            if not video_url and 'url' in info:
-                video_url = f"/proxy?url={quote(info['url'])}"
-
-            if not video_url:
-                return jsonify({
-                    "success": False, 
-                    "error": "Không tìm thấy stream video có âm thanh"
-                }), 200
-
-            result = {
-                "success": True,
-                "title": info.get("title"),
-                "duration": info.get("duration"),
-                "video_url": video_url,
-                "is_live": is_live,
-                "thumbnail": f"https://i.ytimg.com/vi/{info.get('id')}/hqdefault.jpg",
-                "artist": info.get("channel", ""),
-            }
-            return jsonify(result)
+        results = search_results(query, limit)
+        return jsonify({"success": True, "query": query, "results": results})
 
+    except ExtractionBusy as e:
+        print(f"Extraction unavailable: {e}")
+        return busy_response(e)
     except yt_dlp.utils.DownloadError as de:
-        print(f"yt-dlp error: {de}")
+        print(f"[/search_list] yt-dlp error: {de}")
         return jsonify({"success": False, "error": f"yt-dlp error: {str(de)}"}), 500
     except Exception as e:
-        print(f"Get video error: {e}")
-        return jsonify({"success": False, "error": f"Unexpected error: {str(e)}"}), 500
+        print(f"[/search_list] Error: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
 
 
 # ======================
@@ -382,57 +4037,27 @@ def play_direct():
     if not query:
         return jsonify({"success": False, "error": "missing query"}), 400
 
-    print(f"[/play] Query: {query}")
+    try:
+        policy = request_policy(data)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
 
-    ydl_opts = {
-        "quiet": True,
-        "default_search": "ytsearch1",
-        "skip_download": True,
-        "noplaylist": True,
-        "format": "best[ext=mp4][height<=1080]/best[height<=1080]/best",
-        "extractor_args": {
-            "youtube": {
-                "player_client": ["web", "android", "ios"],
-            }
-        },
-    }
+    print(f"[/play] Query: {query}")
 
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(query, download=False)
-            if "entries" in info:
-                info = info["entries"][0]
-
-        # Extract best video URL (có audio)
-        video_url = None
-        audio_url = None
-        
-        for f in info.get("formats", []):
-            url = f.get("url", "")
-            vcodec = f.get("vcodec", "none")
-            acodec = f.get("acodec", "none")
-            
-            # Video có cả âm thanh
-            if vcodec != "none" and acodec != "none" and not video_url:
-                video_url = url
-            
-            # Audio only
-            if vcodec == "none" and acodec != "none" and not audio_url:
-                audio_url = url
+        resolved = build_resolution(resolve_info(query), policy)
+        video_url, audio_url = direct_urls(resolved)
 
         if not video_url and not audio_url:
             return jsonify({"success": False, "error": "no stream found"}), 200
 
-        # Fallback: nếu không có audio riêng, dùng video URL cho cả 2
-        if not audio_url:
-            audio_url = video_url
-
         result = {
             "success": True,
-            "title": info.get("title"),
-            "artist": info.get("channel", ""),
-            "thumbnail": f"https://i.ytimg.com/vi/{info.get('id')}/hqdefault.jpg",
-            "duration": info.get("duration"),
+            "title": resolved["title"],
+            "artist": resolved["artist"],
+            "thumbnail": resolved["thumbnail"],
+            "thumb_url": resolved["thumb_url"],
+            "duration": resolved["duration"],
             # Direct URLs - go2rtc pull trực tiếp từ YouTube
             "video_url": video_url,
             "audio_url": audio_url,
@@ -441,6 +4066,9 @@ def play_direct():
         print(f"[/play] Found: {result['title']} by {result['artist']}")
         return jsonify(result)
 
+    except ExtractionBusy as e:
+        print(f"Extraction unavailable: {e}")
+        return busy_response(e)
     except Exception as e:
         print(f"[/play] Error: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
@@ -450,6 +4078,241 @@ def play_direct():
 # CẢI TIẾN 5: ENDPOINT /PLAY_ON_GO2RTC - Tích hợp go2rtc
 # ======================
 
+def write_url_files(video_url, audio_url):
+    """Ghi URLs vào file cho go2rtc đọc (qua exec command)"""
+    # File paths - go2rtc sẽ đọc từ đây qua exec command
+    video_url_file = "/config/youtube_url.txt"
+    audio_url_file = "/config/youtube_audio_url.txt"
+
+    # Ghi file tạm rồi os.replace: exec source của go2rtc không bao giờ đọc phải URL ghi dở
+    for path, url in ((video_url_file, video_url), (audio_url_file, audio_url)):
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'w') as f:
+            f.write(url)
+        os.replace(tmp, path)
+        print(f"[play_on_go2rtc] Written URL to {path}")
+
+
+class Go2rtcError(Exception):
+    """go2rtc từ chối / không phản hồi khi cập nhật stream"""
+
+
+class Go2rtcStreams:
+    """
+    Đăng ký / cập nhật named stream của go2rtc qua REST API (PATCH /api/streams: tạo mới
+    hoặc thay source) trên một connection keep-alive. Một thread gom các update thành batch
+    (mỗi stream chỉ giữ source mới nhất), update trùng source đang chạy thì bỏ qua, và định kỳ
+    đối chiếu GET /api/streams để đăng ký lại stream bị mất khi go2rtc restart.
+    """
+
+    def __init__(self, base_url, sync_interval, timeout=(2, 10)):
+        self.base_url = base_url.rstrip("/")
+        self.sync_interval = sync_interval
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.cond = threading.Condition()
+        self.desired = {}   # name -> source cần có trên go2rtc
+        self.streams = {}   # name -> {"source", "state", "error", "updated_at", "registrations"}
+        self.requested = 0  # generation của update mới nhất / đã áp dụng
+        self.applied = 0
+        self.thread = None
+        self.batches = 0
+        self.registrations = 0
+        self.skipped = 0
+        self.failed = 0
+        self.resyncs = 0
+
+    def publish(self, sources, timeout=15):
+        """
+        Đặt source cho các stream {name: source} và chờ batch chứa update này chạy xong.
+        Raise Go2rtcError nếu go2rtc lỗi / không phản hồi kịp.
+        """
+        with self.cond:
+            if all(self._current(name, source) for name, source in sources.items()):
+                self.skipped += len(sources)
+                return
+            self.desired.update(sources)
+            self.requested += 1
+            generation = self.requested
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="go2rtc-streams", daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+
+            deadline = time.monotonic() + timeout
+            while self.applied < generation:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Go2rtcError(f"go2rtc not responding ({self.base_url})")
+                self.cond.wait(remaining)
+
+            errors = [f"{name}: {self.streams[name]['error']}" for name in sources
+                      if self.streams[name]["state"] == "error"]
+        if errors:
+            raise Go2rtcError("; ".join(errors))
+
+    def _current(self, name, source):
+        state = self.streams.get(name)
+        return state is not None and state["source"] == source and state["state"] == "registered"
+
+    def _register(self, name, source):
+        try:
+            resp = self.session.patch(f"{self.base_url}/api/streams",
+                                      params={"name": name, "src": source}, timeout=self.timeout)
+            error = None if resp.ok else f"HTTP {resp.status_code} {resp.text.strip()[:200]}"
+        except requests.RequestException as e:
+            error = str(e)
+
+        with self.cond:
+            state = self.streams.setdefault(name, {"registrations": 0})
+            state.update(source=source, updated_at=time.time(), error=error,
+                         state="error" if error else "registered")
+            if error:
+                self.failed += 1
+                print(f"[go2rtc] {name}: {error}")
+            else:
+                state["registrations"] += 1
+                self.registrations += 1
+
+    def _sync(self):
+        """Stream đã đăng ký nhưng không còn trên go2rtc (restart) -> đánh dấu để đăng ký lại"""
+        try:
+            resp = self.session.get(f"{self.base_url}/api/streams", timeout=self.timeout)
+            resp.raise_for_status()
+            remote = resp.json() or {}
+        except (requests.RequestException, ValueError) as e:
+            print(f"[go2rtc] Sync error: {e}")
+            return
+        with self.cond:
+            for name, state in self.streams.items():
+                if state["state"] == "registered" and name not in remote:
+                    state["state"] = "missing"
+                    self.resyncs += 1
+
+    def _run(self):
+        next_sync = time.monotonic() + self.sync_interval
+        while True:
+            with self.cond:
+                while self.applied == self.requested and time.monotonic() < next_sync:
+                    self.cond.wait(next_sync - time.monotonic())
+                generation = self.requested
+                # Update dồn lại trong lúc batch trước chạy -> chỉ còn source mới nhất mỗi stream
+                pending = {name: source for name, source in self.desired.items()
+                           if not self._current(name, source)}
+
+            if time.monotonic() >= next_sync:
+                self._sync()
+                next_sync = time.monotonic() + self.sync_interval
+                with self.cond:
+                    pending = {name: source for name, source in self.desired.items()
+                               if not self._current(name, source)}
+
+            for name, source in pending.items():
+                self._register(name, source)
+
+            with self.cond:
+                if pending:
+                    self.batches += 1
+                self.applied = generation
+                self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {
+                "handoff": GO2RTC_HANDOFF,
+                "url": self.base_url,
+                "batches": self.batches,
+                "registrations": self.registrations,
+                "skipped": self.skipped,
+                "failed": self.failed,
+                "resyncs": self.resyncs,
+                "streams": {name: dict(state) for name, state in self.streams.items()},
+            }
+
+
+go2rtc = Go2rtcStreams(GO2RTC_URL, GO2RTC_SYNC_INTERVAL)
+
+# Room mặc định giữ tên stream cũ (youtube_video / youtube_audio)
+ROOM_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+
+
+def request_room(data):
+    """Room của request ("room" trong body): mỗi room một cặp named stream trên go2rtc"""
+    room = data.get("room") or None
+    if room is None:
+        return None
+    if not isinstance(room, str) or not ROOM_PATTERN.match(room):
+        raise ValueError("invalid room (1-32 characters: letters, digits, '_', '-')")
+    if GO2RTC_HANDOFF == "files":
+        raise ValueError("rooms require GO2RTC_HANDOFF=api")
+    return room
+
+
+def go2rtc_stream_names(room=None):
+    prefix = f"youtube_{room}" if room else "youtube"
+    return {"video": f"{prefix}_video", "audio": f"{prefix}_audio"}
+
+
+def handoff_urls(video_url, audio_url, room=None):
+    """
+    Giao URL cho go2rtc: một PATCH /api/streams mỗi stream đổi source, hoặc file như cũ.
+    Chặn tới khi go2rtc nhận (tối đa vài giây): chỉ gọi từ thread của request Flask, không
+    gọi trên event loop của ASGI.
+    """
+    if GO2RTC_HANDOFF == "files":
+        write_url_files(video_url, audio_url)
+        return
+    names = go2rtc_stream_names(room)
+    sources = {}
+    if video_url and GO2RTC_VIDEO_SOURCE:
+        sources[names["video"]] = GO2RTC_VIDEO_SOURCE.format(url=video_url)
+    if audio_url and GO2RTC_AUDIO_SOURCE:
+        sources[names["audio"]] = GO2RTC_AUDIO_SOURCE.format(url=audio_url)
+    if sources:
+        go2rtc.publish(sources)
+
+
+def go2rtc_result(resolved, audio_url, host_url, room=None):
+    """Response của /play_on_go2rtc: metadata + stream URLs cho ESPHome và RemoteWebView"""
+    # Lấy host từ request hoặc dùng localhost
+    backend_host = host_url.rstrip('/')  # http://IP:5000
+
+    metadata = {
+        "title": resolved["title"] or "Unknown",
+        "artist": resolved["artist"] or "Unknown",
+        "thumbnail": resolved["thumbnail"],
+        # Thumbnail qua backend (resize theo policy), URL tuyệt đối như stream_url
+        "thumb_url": f"{backend_host}{resolved['thumb_url']}" if resolved["thumb_url"] else None,
+        "duration": resolved["duration"] or 0,
+    }
+    video_stream_name = go2rtc_stream_names(room)["video"]
+
+    # Token URL nếu có: tạm dừng lâu rồi phát tiếp không bị 403 do URL hết hạn
+    audio = resolved["audio"]
+    if audio and audio["direct_url"] == audio_url and audio.get("token_url"):
+        stream_path = audio["token_url"]
+    else:
+        stream_path = f"/proxy?url={quote(audio_url)}"
+
+    return {
+        "success": True,
+        "metadata": metadata,
+        # Stream URLs cho ESPHome và RemoteWebView
+        "stream_url": f"{backend_host}{stream_path}",
+        "video_url": f"{GO2RTC_URL}/api/stream.mjpeg?src={video_stream_name}",
+        "room": room,
+        # Thông tin bổ sung
+        "title": metadata["title"],
+        "artist": metadata["artist"],
+        "thumbnail": metadata["thumbnail"],
+        "thumb_url": metadata["thumb_url"],
+        "duration": metadata["duration"]
+    }
+
+
 @app.route('/play_on_go2rtc', methods=['POST'])
 def play_on_go2rtc():
     """
@@ -468,77 +4331,30 @@ def play_on_go2rtc():
     if not query:
         return jsonify({"success": False, "error": "missing query"}), 400
 
-    print(f"[play_on_go2rtc] Query: {query}")
+    try:
+        policy = request_policy(data)
+        room = request_room(data)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
 
-    # Step 1: Search YouTube
-    ydl_opts = {
-        "quiet": True,
-        "default_search": "ytsearch1",
-        "skip_download": True,
-        "noplaylist": True,
-        "format": "best[ext=mp4][height<=1080]/best[height<=1080]/best",
-        "extractor_args": {
-            "youtube": {
-                "player_client": ["web", "android", "ios"],
-            }
-        },
-    }
+    print(f"[play_on_go2rtc] Query: {query}")
 
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(query, download=False)
-            if "entries" in info:
-                info = info["entries"][0]
-
-        # Step 2: Extract URLs
-        video_url = None
-        audio_url = None
-        
-        for f in info.get("formats", []):
-            url = f.get("url", "")
-            vcodec = f.get("vcodec", "none")
-            acodec = f.get("acodec", "none")
-            
-            # Best video with audio
-            if vcodec != "none" and acodec != "none" and not video_url:
-                video_url = url
-            
-            # Best audio only
-            if vcodec == "none" and acodec != "none" and not audio_url:
-                audio_url = url
+        # Step 1 + 2: Search YouTube và chọn URLs (dùng chung cache với /resolve)
+        resolved = build_resolution(resolve_info(query), policy)
+        video_url, audio_url = direct_urls(resolved)
 
         if not video_url and not audio_url:
             return jsonify({"success": False, "error": "no stream found"}), 200
 
-        # Fallback
-        if not audio_url:
-            audio_url = video_url
-
-        metadata = {
-            "title": info.get("title", "Unknown"),
-            "artist": info.get("channel", "Unknown"),
-            "thumbnail": f"https://i.ytimg.com/vi/{info.get('id')}/hqdefault.jpg",
-            "duration": info.get("duration", 0),
-        }
+        print(f"[play_on_go2rtc] Found: {resolved['title']} by {resolved['artist']}")
 
-        print(f"[play_on_go2rtc] Found: {metadata['title']} by {metadata['artist']}")
-
-        # Step 3: Ghi URLs vào file cho go2rtc đọc
-        try:
-            # File paths - go2rtc sẽ đọc từ đây qua exec command
-            video_url_file = "/config/youtube_url.txt"
-            audio_url_file = "/config/youtube_audio_url.txt"
-            
-            # Ghi video URL
-            with open(video_url_file, 'w') as f:
-                f.write(video_url)
-            print(f"[play_on_go2rtc] Written video URL to {video_url_file}")
-            
-            # Ghi audio URL
-            with open(audio_url_file, 'w') as f:
-                f.write(audio_url)
-            print(f"[play_on_go2rtc] Written audio URL to {audio_url_file}")
-            
+        # Step 3: Cập nhật stream của room trên go2rtc
+        try:
+            handoff_urls(video_url, audio_url, room)
+        except Go2rtcError as e:
+            print(f"[play_on_go2rtc] go2rtc error: {e}")
+            return jsonify({"success": False, "error": f"Cannot update go2rtc streams: {e}"}), 502
         except Exception as e:
             print(f"[play_on_go2rtc] File write error: {e}")
             return jsonify({
@@ -547,24 +4363,11 @@ def play_on_go2rtc():
             }), 500
 
         # Step 4: Return success với metadata và URLs đơn giản
-        video_stream_name = "youtube_video"
-        
-        # Lấy host từ request hoặc dùng localhost
-        backend_host = request.host_url.rstrip('/')  # http://IP:5000
-        
-        return jsonify({
-            "success": True,
-            "metadata": metadata,
-            # Stream URLs cho ESPHome và RemoteWebView
-            "stream_url": f"{backend_host}/proxy?url={quote(audio_url)}",
-            "video_url": f"{GO2RTC_URL}/api/stream.mjpeg?src={video_stream_name}",
-            # Thông tin bổ sung
-            "title": metadata["title"],
-            "artist": metadata["artist"],
-            "thumbnail": metadata["thumbnail"],
-            "duration": metadata["duration"]
-        })
+        return jsonify(go2rtc_result(resolved, audio_url, request.host_url, room))
 
+    except ExtractionBusy as e:
+        print(f"Extraction unavailable: {e}")
+        return busy_response(e)
     except yt_dlp.utils.DownloadError as de:
         print(f"[yt-dlp] Error: {de}")
         return jsonify({"success": False, "error": f"yt-dlp error: {str(de)}"}), 500
@@ -573,6 +4376,271 @@ def play_on_go2rtc():
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+# ======================
+# PLAYBACK QUEUE - resolve trước các bài tiếp theo
+# ======================
+
+def warm_stream(url):
+    """Tải trước chunk đầu của media vào range cache (đồng thời mở sẵn connection tới googlevideo)"""
+    media_key = media_identity(url)
+    if not media_key or not range_cache.enabled or range_cache.has(media_key, 0):
+        return
+    resp = _fetch_window(url, PROXY_UPSTREAM_HEADERS, 0, range_cache.chunk_size - 1)
+    span = parse_content_range(resp)
+    if span and range_cache.register(media_key, span[1], resp.headers.get('Content-Type')):
+        _ChunkWriter(range_cache, media_key, 0, span[1]).feed(read_body(resp))
+    else:
+        resp.close()
+
+
+class QueueItem:
+    def __init__(self, item_id, query, policy):
+        self.id = item_id
+        self.query = query
+        self.policy = policy
+        self.state = "pending"  # pending -> resolving -> ready | error
+        self.resolved = None
+        self.expires_at = 0
+        self.error = None
+
+    def fresh(self):
+        return self.state == "ready" and time.time() < self.expires_at
+
+    def to_dict(self):
+        resolved = self.resolved or {}
+        return {
+            "id": self.id,
+            "query": self.query,
+            "policy": self.policy,
+            "state": self.state,
+            "title": resolved.get("title"),
+            "artist": resolved.get("artist"),
+            "duration": resolved.get("duration"),
+            "expires_in": max(int(self.expires_at - time.time()), 0) if self.resolved else None,
+            "error": self.error,
+        }
+
+
+class PlaybackQueue:
+    """
+    Hàng đợi phát: thread nền resolve trước `prefetch` item đầu (extract + warm chunk đầu
+    của audio) và resolve lại khi URL tới hạn info_expiry, nên next() chỉ còn cập nhật go2rtc.
+    """
+
+    def __init__(self, prefetch, max_items):
+        self.prefetch = prefetch
+        self.max_items = max_items
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.next_id = 1
+        self.thread = None
+        self.prefetched = 0
+        self.refreshed = 0
+        self.hits = 0
+        self.misses = 0
+
+    def enqueue(self, query, policy):
+        with self.cond:
+            if len(self.items) >= self.max_items:
+                raise ValueError(f"queue full ({self.max_items} items)")
+            item = QueueItem(self.next_id, query, policy)
+            self.next_id += 1
+            self.items.append(item)
+            if self.thread is None and self.prefetch > 0:
+                self.thread = threading.Thread(target=self._run, name="queue-prefetch", daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+            return item
+
+    def pop(self):
+        with self.cond:
+            item = self.items.popleft() if self.items else None
+            self.cond.notify_all()
+            return item
+
+    def clear(self):
+        with self.cond:
+            count = len(self.items)
+            self.items.clear()
+            return count
+
+    def list(self):
+        with self.cond:
+            return [item.to_dict() for item in self.items]
+
+    def __len__(self):
+        with self.cond:
+            return len(self.items)
+
+    def resolution(self, item):
+        """Kết quả resolve của item: bản đã resolve trước nếu còn hạn, ngược lại resolve ngay"""
+        if item.fresh():
+            with self.cond:
+                self.hits += 1
+            return item.resolved
+        with self.cond:
+            self.misses += 1
+        # Prefetch đang chạy cùng query -> single-flight, không extract lần hai
+        resolved, _ = self._resolve(item)
+        return resolved
+
+    def _resolve(self, item):
+        info = resolve_info(item.query)
+        return build_resolution(info, item.policy), info_expiry(info)
+
+    def _due(self):
+        """(item cần resolve, số giây tới lần refresh gần nhất) trong `prefetch` item đầu"""
+        now = time.time()
+        wait = None
+        for item in list(self.items)[:self.prefetch]:
+            if item.state == "pending" or (item.state == "ready" and now >= item.expires_at):
+                return item, 0
+            if item.state == "ready":
+                wait = item.expires_at - now if wait is None else min(wait, item.expires_at - now)
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self.cond:
+                item, wait = self._due()
+                while item is None:
+                    self.cond.wait(wait)
+                    item, wait = self._due()
+                refresh = item.state == "ready"
+                item.state = "resolving"
+
+            try:
+                resolved, expires_at = self._resolve(item)
+            except ExtractionBusy:
+                # Pool đang bận với request của người dùng: thử lại sau
+                with self.cond:
+                    item.state = "pending"
+                time.sleep(5)
+                continue
+            except Exception as e:
+                print(f"[queue] Prefetch error for '{item.query}': {e}")
+                with self.cond:
+                    item.state = "error"
+                    item.error = str(e)
+                continue
+
+            with self.cond:
+                item.resolved = resolved
+                # Không refresh dồn dập nếu URL đã quá hạn margin ngay khi resolve
+                item.expires_at = max(expires_at, time.time() + 60)
+                item.state = "ready"
+                item.error = None
+                if refresh:
+                    self.refreshed += 1
+                else:
+                    self.prefetched += 1
+
+            if QUEUE_WARM and resolved["audio"]:
+                try:
+                    warm_stream(resolved["audio"]["direct_url"])
+                except Exception as e:
+                    print(f"[queue] Warm error for '{item.query}': {e}")
+
+    def stats(self):
+        with self.cond:
+            return {
+                "length": len(self.items),
+                "prefetch": self.prefetch,
+                "prefetched": self.prefetched,
+                "refreshed": self.refreshed,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+playback_queue = PlaybackQueue(QUEUE_PREFETCH, QUEUE_MAX)
+
+
+@app.route('/queue', methods=['GET', 'POST', 'DELETE'])
+def queue_items():
+    """GET: danh sách, POST: thêm {"query"} hoặc {"queries": [...]}, DELETE: xoá hết"""
+    if not auth(request):
+        return jsonify({"error": "unauthorized"}), 401
+
+    if request.method == 'GET':
+        return jsonify({"success": True, "items": playback_queue.list()})
+
+    if request.method == 'DELETE':
+        return jsonify({"success": True, "cleared": playback_queue.clear()})
+
+    data = request.get_json(silent=True) or {}
+    queries = data.get("queries") or [data.get("query", "")]
+    queries = [q.strip() for q in queries if isinstance(q, str) and q.strip()]
+
+    if not queries:
+        return jsonify({"success": False, "error": "missing query"}), 400
+
+    try:
+        policy = request_policy(data)
+        items = [playback_queue.enqueue(q, policy) for q in queries]
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    print(f"[queue] Added {len(items)} item(s), length {len(playback_queue)}")
+    return jsonify({
+        "success": True,
+        "items": [item.to_dict() for item in items],
+        "length": len(playback_queue),
+    })
+
+
+@app.route('/queue/next', methods=['POST'])
+def queue_next():
+    """Phát item đầu hàng đợi như /play_on_go2rtc, dùng kết quả đã resolve trước"""
+    if not auth(request):
+        return jsonify({"error": "unauthorized"}), 401
+
+    try:
+        room = request_room(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    item = playback_queue.pop()
+    if item is None:
+        return jsonify({"success": False, "error": "queue empty"}), 404
+
+    print(f"[queue] Next: {item.query} ({item.state})")
+
+    try:
+        prefetched = item.fresh()
+        resolved = playback_queue.resolution(item)
+        video_url, audio_url = direct_urls(resolved)
+
+        if not video_url and not audio_url:
+            return jsonify({"success": False, "error": "no stream found"}), 200
+
+        try:
+            handoff_urls(video_url, audio_url, room)
+        except Go2rtcError as e:
+            print(f"[queue] go2rtc error: {e}")
+            return jsonify({"success": False, "error": f"Cannot update go2rtc streams: {e}"}), 502
+        except Exception as e:
+            print(f"[queue] File write error: {e}")
+            return jsonify({
+                "success": False,
+                "error": f"Cannot write URL files: {str(e)}"
+            }), 500
+
+        result = go2rtc_result(resolved, audio_url, request.host_url, room)
+        result["queue"] = {"prefetched": prefetched, "remaining": len(playback_queue)}
+        return jsonify(result)
+
+    except ExtractionBusy as e:
+        print(f"Extraction unavailable: {e}")
+        return busy_response(e)
+    except yt_dlp.utils.DownloadError as de:
+        print(f"[queue] yt-dlp error: {de}")
+        return jsonify({"success": False, "error": f"yt-dlp error: {str(de)}"}), 500
+    except Exception as e:
+        print(f"[queue] Error: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
 # ======================
 # Serve UI
 # ======================
@@ -582,12 +4650,516 @@ def index():
     return send_from_directory(app.static_folder, "index.html")
 
 
+# ======================
+# ASYNC SERVER (ASGI) - relay /proxy, /proxy_m3u8 bằng coroutine
+# ======================
+
+def make_asgi_app():
+    """
+    ASGI app cho uvicorn: /proxy và /proxy_m3u8 chạy bằng coroutine (httpx async),
+    mỗi stream chỉ tốn một task thay vì một OS thread. Các route còn lại chạy qua
+    Flask (WsgiToAsgi) trong thread pool nên yt-dlp không chặn event loop.
+    """
+    import asyncio
+    import contextvars
+    import httpx
+    from asgiref.sync import ThreadSensitiveContext
+    from asgiref.wsgi import WsgiToAsgi
+
+    def closing_app(environ, start_response):
+        # WsgiToAsgi không gọi close() của body (HEAD, dừng ở Content-Length...) -> upstream
+        # / listener của /proxy chỉ được giải phóng khi GC
+        body = app(environ, start_response)
+        try:
+            yield from body
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+
+    wsgi_app = WsgiToAsgi(closing_app)
+    # Executor riêng (có giới hạn) cho việc chờ ring buffer / đọc range cache / token body:
+    # không chiếm default executor của loop (fetch_playlist, cached_segment...)
+    relay_executor = ThreadPoolExecutor(max_workers=max(ASGI_RELAY_THREADS, 1), thread_name_prefix="asgi-relay")
+
+    def connect_trace(scheme):
+        """Trace httpcore: đo thời gian mở connection mới (TCP, + TLS nếu https)"""
+        done_event = "connection.start_tls.complete" if scheme == "https" else "connection.connect_tcp.complete"
+        started = None
+
+        async def trace(event, info):
+            nonlocal started
+            if event == "connection.connect_tcp.started":
+                started = time.perf_counter()
+            elif event == done_event and started is not None:
+                upstream_connect.observe(time.perf_counter() - started, "httpx")
+
+        return trace
+
+    async def on_request(request):
+        request.extensions["trace"] = connect_trace(request.url.scheme)
+        request.extensions["ytb_started"] = time.perf_counter()
+
+    async def on_response(response):
+        started = response.request.extensions.get("ytb_started")
+        if started is not None:
+            upstream_ttfb.observe(time.perf_counter() - started, upstream_kind(str(response.request.url)))
+
+    client = httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(
+            retries=UPSTREAM_RETRIES,
+            limits=httpx.Limits(
+                max_connections=UPSTREAM_POOL_HOSTS * UPSTREAM_POOL_SIZE,
+                max_keepalive_connections=UPSTREAM_POOL_SIZE,
+            ),
+        ),
+        timeout=httpx.Timeout(60.0, connect=15.0),
+        follow_redirects=True,
+        event_hooks={"request": [on_request], "response": [on_response]},
+    )
+
+    async def send_response(send, status, headers, body=b""):
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(k.lower().encode(), str(v).encode()) for k, v in headers.items()],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def send_json(send, status, payload):
+        body = json.dumps(payload).encode() + b"\n"
+        await send_response(send, status, {"Content-Type": "application/json"}, body)
+
+    async def send_busy(send, e):
+        """Tương đương busy_response: 503 kèm Retry-After, 504 khi quá hạn"""
+        headers = {"Content-Type": "application/json"}
+        if e.status == 503:
+            headers["Retry-After"] = "5"
+        body = json.dumps({"success": False, "error": str(e)}).encode() + b"\n"
+        await send_response(send, e.status, headers, body)
+
+    async def stream_body(receive, send, status, headers, chunks, route="proxy"):
+        """Gửi chunks ra client, dừng ngay khi client ngắt kết nối"""
+        disconnected = asyncio.Event()
+        active_streams.inc(1, route)
+
+        async def watch_disconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(k.lower().encode(), str(v).encode()) for k, v in headers.items()],
+            })
+            async for chunk in chunks:
+                if disconnected.is_set():
+                    break
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                    relay_bytes.inc(len(chunk), route)
+            await send({"type": "http.response.body", "body": b""})
+        except Exception as e:
+            print(f"Stream error: {e}")
+        finally:
+            active_streams.inc(-1, route)
+            watcher.cancel()
+            await chunks.aclose()
+
+    async def iter_sync(iterator):
+        """Chạy iterator đồng bộ (range cache, broadcast...) trong relay_executor, từng chunk một"""
+        loop = asyncio.get_running_loop()
+        done = object()
+        try:
+            while True:
+                chunk = await loop.run_in_executor(relay_executor, next, iterator, done)
+                if chunk is done:
+                    return
+                yield chunk
+        finally:
+            await loop.run_in_executor(relay_executor, iterator.close)
+
+    def cache_writer(media_key, offset, total, content_type):
+        """range_cache.register (mkdir + meta.json) rồi _ChunkWriter; chạy trong relay_executor"""
+        if media_key and range_cache.register(media_key, total, content_type):
+            return _ChunkWriter(range_cache, media_key, offset, total)
+        return None
+
+    async def tee(chunks, writer):
+        """
+        Relay chunks; bản cho range cache gom thành batch ~chunk_size và ghi (file I/O) trong
+        relay_executor, lần lượt từng batch để giữ thứ tự, không chặn event loop
+        """
+        loop = asyncio.get_running_loop()
+        batch, batch_bytes, write = [], 0, None
+
+        def feed(items):
+            for item in items:
+                writer.feed(item)
+
+        try:
+            async for chunk in chunks:
+                if writer:
+                    batch.append(chunk)
+                    batch_bytes += len(chunk)
+                    if batch_bytes >= writer.cache.chunk_size:
+                        if write:
+                            await write
+                        write = loop.run_in_executor(relay_executor, feed, batch)
+                        batch, batch_bytes = [], 0
+                yield chunk
+            if write:
+                await write
+            if batch:
+                await loop.run_in_executor(relay_executor, feed, batch)
+        finally:
+            await chunks.aclose()
+
+    async def fetch_window(url, headers, start, end):
+        request = client.build_request("GET", url, headers=dict(headers, Range=f"bytes={start}-{end}"))
+        resp = await client.send(request, stream=True)
+        if resp.status_code != 206:
+            # Không đọc body: upstream trả 200 là cả media
+            await resp.aclose()
+            raise (RangeNotSupported if resp.status_code == 200 else UpstreamStatusError)(resp.status_code)
+        await resp.aread()
+        return resp
+
+    async def open_parallel(url, headers, start, end):
+        """Tương đương ParallelFetch: window đầu tải ngay, các window sau read-ahead song song"""
+        headers = {k: v for k, v in headers.items() if k != 'Range'}
+        window_end = start + PARALLEL_FETCH_WINDOW - 1
+        if end is not None:
+            window_end = min(window_end, end)
+        resp = await fetch_window(url, headers, start, window_end)
+        span = parse_content_range(resp)
+        if not span:
+            raise UpstreamStatusError(resp.status_code)
+        total = span[1]
+        end = total - 1 if end is None else min(end, total - 1)
+        first = resp.content
+
+        async def chunks():
+            yield first
+            windows = deque(
+                (pos, min(pos + PARALLEL_FETCH_WINDOW - 1, end))
+                for pos in range(start + len(first), end + 1, PARALLEL_FETCH_WINDOW)
+            )
+            pending = deque()
+            try:
+                while windows or pending:
+                    while windows and len(pending) < PARALLEL_FETCH_WORKERS:
+                        window_start, window_stop = windows.popleft()
+                        pending.append(asyncio.ensure_future(fetch_window(url, headers, window_start, window_stop)))
+                    yield (await pending.popleft()).content
+            finally:
+                for task in pending:
+                    task.cancel()
+
+        return total, end, resp.headers.get('Content-Type'), chunks()
+
+    def broadcast_asgi_args(listener, range_header):
+        status, content_type, content_length, content_range = broadcast_response_args(listener, range_header)
+        return status, proxy_headers(content_type, content_length, content_range), iter_sync(listener)
+
+    def request_params(scope):
+        params = parse_qs(scope["query_string"].decode("latin-1"))
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        url = (params.get("url") or [None])[0]
+        return (unquote(url) if url else None), headers
+
+    async def proxy_token(send, receive, token, range_header):
+        """Token cần yt-dlp + resume đồng bộ: chạy pipeline của Flask trong executor"""
+        loop = asyncio.get_running_loop()
+        try:
+            body, status, content_type, content_length, content_range = await loop.run_in_executor(
+                None, open_token, token, range_header)
+        except UpstreamStatusError as e:
+            print(f"Proxy error: Status {e.status}")
+            return await send_json(send, e.http_status, {"error": str(e)})
+        except ValueError as e:
+            return await send_json(send, 400, {"error": str(e)})
+        except PermissionError as e:
+            return await send_json(send, 403, {"error": str(e)})
+        except LookupError as e:
+            return await send_json(send, 404, {"error": str(e)})
+        except ExtractionBusy as e:
+            print(f"Extraction unavailable: {e}")
+            return await send_busy(send, e)
+        except Exception as e:
+            print(f"Proxy error: {e}")
+            return await send_json(send, 500, {"error": str(e)})
+
+        headers = proxy_headers(content_type, content_length, content_range)
+        if isinstance(body, (bytes, bytearray)):
+            return await send_response(send, status, headers, body)
+        await stream_body(receive, send, status, headers, iter_sync(body))
+
+    async def proxy(scope, receive, send):
+        url, client_headers = request_params(scope)
+        token = (parse_qs(scope["query_string"].decode("latin-1")).get("token") or [None])[0]
+        if token:
+            return await proxy_token(send, receive, token, client_headers.get("range"))
+        if not url:
+            return await send_json(send, 400, {"error": "missing url parameter"})
+
+        headers = dict(PROXY_UPSTREAM_HEADERS)
+        range_header = client_headers.get("range")
+        if range_header:
+            headers['Range'] = range_header
+
+        loop = asyncio.get_running_loop()
+        try:
+            if url in segment_cache or segment_fetches.in_flight(url):
+                segment = await loop.run_in_executor(None, cached_segment, url)
+                if segment:
+                    body, status, content_type, content_range = segment_response_args(segment, range_header)
+                    headers = proxy_headers(content_type, len(body), content_range)
+                    return await send_response(send, status, headers, body)
+
+            media_key = media_identity(url)
+            try:
+                start, end = parse_open_range(range_header)
+            except ValueError:
+                start = None
+            shared = media_key and start is not None and broadcasts.enabled
+
+            if shared:
+                # Chờ window đầu của broadcast (nếu vừa mở) trong executor
+                listener = await loop.run_in_executor(
+                    relay_executor, lambda: broadcasts.listen(media_key, url, headers, start, end, create=False))
+                if listener:
+                    return await stream_body(receive, send, *broadcast_asgi_args(listener, range_header))
+
+            if media_key and range_cache.enabled:
+                try:
+                    # lookup chạm meta.json trên disk (utime): không chạy trên loop
+                    cached = await loop.run_in_executor(relay_executor, range_cache.lookup, media_key, range_header)
+                except ValueError:
+                    cached = None
+                if cached:
+                    start, end, total, content_type = cached
+                    body = iter_sync(range_cache.iter_range(media_key, start, end, url, headers))
+                    return await stream_body(receive, send, 206 if range_header else 200, proxy_headers(
+                        content_type, end - start + 1, f"bytes {start}-{end}/{total}" if range_header else None,
+                    ), body)
+
+            if shared:
+                try:
+                    listener = await loop.run_in_executor(
+                        relay_executor, lambda: broadcasts.listen(media_key, url, headers, start, end))
+                except UpstreamStatusError as e:
+                    print(f"Proxy error: Status {e.status}")
+                    return await send_json(send, e.http_status, {"error": str(e)})
+                if listener:
+                    return await stream_body(receive, send, *broadcast_asgi_args(listener, range_header))
+
+            # Relay riêng: ghi nhận từ lúc mở để client tiếp theo của media mở broadcast dùng chung
+            release = broadcasts.track(media_key) if shared else None
+            try:
+                # Song song chỉ khi client gửi Range; upstream bỏ qua Range (200) -> một GET như thường
+                chunks = None
+                if PARALLEL_FETCH_WORKERS > 0 and range_header and start is not None:
+                    try:
+                        total, end, content_type, chunks = await open_parallel(url, headers, start, end)
+                    except RangeNotSupported:
+                        print("[proxy] Upstream ignored Range, falling back to single GET")
+                    except UpstreamStatusError as e:
+                        print(f"Proxy error: Status {e.status}")
+                        return await send_json(send, e.http_status, {"error": str(e)})
+                if chunks is not None:
+                    writer = await loop.run_in_executor(
+                        relay_executor, cache_writer, media_key, start, total, content_type)
+                    return await stream_body(receive, send, 206 if range_header else 200, proxy_headers(
+                        content_type, end - start + 1, f"bytes {start}-{end}/{total}" if range_header else None,
+                    ), tee(chunks, writer))
+
+                resp = await client.send(client.build_request("GET", url, headers=headers), stream=True)
+                if resp.status_code not in [200, 206]:
+                    print(f"Proxy error: Status {resp.status_code}")
+                    await resp.aclose()
+                    e = UpstreamStatusError(resp.status_code)
+                    return await send_json(send, e.http_status, {"error": str(e)})
+
+                writer = None
+                span = parse_content_range(resp) if media_key and range_cache.enabled else None
+                if span:
+                    writer = await loop.run_in_executor(
+                        relay_executor, cache_writer, media_key, span[0], span[1], resp.headers.get('Content-Type'))
+
+                async def relay():
+                    # Giữ nguyên chunk của mỗi lần đọc socket (httpcore đọc tối đa 64 KB), không
+                    # cắt / ghép lại thành chunk cố định; chỉ giải nén khi có Content-Encoding
+                    identity = resp.headers.get("Content-Encoding", "identity").lower() == "identity"
+                    try:
+                        async for chunk in (resp.aiter_raw() if identity else resp.aiter_bytes()):
+                            yield chunk
+                    finally:
+                        await resp.aclose()
+
+                await stream_body(receive, send, resp.status_code, proxy_headers(
+                    resp.headers.get('Content-Type'), resp.headers.get('Content-Length'), resp.headers.get('Content-Range'),
+                ), tee(relay(), writer))
+            finally:
+                if release:
+                    release()
+
+        except httpx.TimeoutException:
+            print("Proxy timeout")
+            await send_json(send, 504, {"error": "Request timeout"})
+        except httpx.TransportError as e:
+            print(f"Connection error: {e}")
+            await send_json(send, 502, {"error": "Connection failed"})
+        except Exception as e:
+            print(f"Proxy error: {e}")
+            await send_json(send, 500, {"error": str(e)})
+
+    async def proxy_m3u8_async(scope, receive, send):
+        url, _ = request_params(scope)
+        if not url:
+            return await send_json(send, 400, {"error": "missing url parameter"})
+
+        try:
+            # Playlist cache + single-flight dùng chung với Flask (fetch ngắn, chạy trong executor)
+            loop = asyncio.get_running_loop()
+            try:
+                content = await loop.run_in_executor(None, fetch_playlist, url)
+            except UpstreamStatusError as e:
+                print(f"M3U8 fetch error: {e.status}")
+                return await send_json(send, e.http_status, {"error": f"Failed to fetch m3u8: {e.status}"})
+
+            playlist, segments = rewrite_m3u8(content, url)
+            prefetch_segments(content, segments)
+
+            headers = dict(M3U8_RESPONSE_HEADERS, **{'Content-Type': 'application/vnd.apple.mpegurl'})
+            await send_response(send, 200, headers, playlist.encode())
+
+        except (httpx.TimeoutException, requests.exceptions.Timeout):
+            print("M3U8 timeout")
+            await send_json(send, 504, {"error": "M3U8 fetch timeout"})
+        except Exception as e:
+            print(f"M3U8 proxy error: {e}")
+            await send_json(send, 500, {"error": str(e)})
+
+    async def transcode(scope, receive, send):
+        url, _ = request_params(scope)
+        if not url:
+            return await send_json(send, 400, {"error": "missing url parameter"})
+        args = {k: v[0] for k, v in parse_qs(scope["query_string"].decode("latin-1")).items()}
+        try:
+            opts = transcode_options(args)
+        except ValueError as e:
+            return await send_json(send, 400, {"error": str(e)})
+
+        try:
+            # Spawn ffmpeg + window đầu của upstream: blocking, chạy trong executor
+            loop = asyncio.get_running_loop()
+            output = await loop.run_in_executor(None, start_transcode, url, opts)
+        except TranscodeBusy as e:
+            print(f"Transcode unavailable: {e}")
+            return await send_busy(send, e)
+        except UpstreamStatusError as e:
+            print(f"Transcode error: Status {e.status}")
+            return await send_json(send, e.http_status, {"error": str(e)})
+        except requests.exceptions.Timeout:
+            print("Transcode timeout")
+            return await send_json(send, 504, {"error": "Request timeout"})
+        except requests.exceptions.ConnectionError as e:
+            print(f"Connection error: {e}")
+            return await send_json(send, 502, {"error": "Connection failed"})
+        except Exception as e:
+            print(f"Transcode error: {e}")
+            return await send_json(send, 500, {"error": str(e)})
+
+        # Client ngắt kết nối -> stream_body đóng iterator -> kill ffmpeg
+        await stream_body(receive, send, 200, transcode_headers(opts), iter_sync(output), route="transcode")
+
+    async def healthz_async(scope, receive, send):
+        # Probe trả lời ngay trên event loop, không chờ thread pool đang bận
+        await send_json(send, 200, {"status": "ok"})
+
+    async def readyz_async(scope, receive, send):
+        stats = warmup.stats()
+        await send_json(send, 200 if stats["ready"] else 503, stats)
+
+    async_routes = {
+        "/proxy": proxy,
+        "/proxy_m3u8": proxy_m3u8_async,
+        "/transcode": transcode,
+        "/healthz": healthz_async,
+        "/readyz": readyz_async,
+    }
+
+    async def run_flask(scope, receive, send):
+        # Mặc định WsgiToAsgi chạy mọi request Flask trên MỘT thread (thread_sensitive):
+        # ThreadSensitiveContext cho mỗi request một thread riêng, yt-dlp và handoff go2rtc
+        # (/play_on_go2rtc, /queue/next) chạy ở đó, không chặn nhau và không chặn event loop
+        async with ThreadSensitiveContext():
+            await wsgi_app(scope, receive, send)
+
+    async def application(scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await client.aclose()
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+
+        if scope["type"] == "http" and scope["method"] == "GET":
+            handler = async_routes.get(scope["path"])
+            if handler:
+                started = time.perf_counter()
+
+                async def timed_send(message):
+                    if message["type"] == "http.response.start":
+                        http_duration.observe(
+                            time.perf_counter() - started, scope["path"], "GET", status_class(message["status"])
+                        )
+                    await send(message)
+
+                return await handler(scope, receive, timed_send)
+
+        # Các route còn lại (OPTIONS, /search, /play...) giữ nguyên qua Flask.
+        # Chạy trong context rỗng: với keep-alive, uvicorn có thể tạo request kế tiếp ngay trong
+        # send() của request trước (context của thread Flask cũ) -> asgiref dùng lại executor đã đóng
+        await contextvars.Context().run(asyncio.ensure_future, run_flask(scope, receive, send))
+
+    return application
+
+
 if __name__ == "__main__":
     print(f"YT Backend Server running on 0.0.0.0:{PORT}")
     print(f"  API_KEY: {API_KEY}")
-    print(f"  go2rtc URL: {GO2RTC_URL}")
+    print(f"  go2rtc URL: {GO2RTC_URL} (handoff: {GO2RTC_HANDOFF})")
     print("Endpoints:")
     print("  Legacy: /search, /get_video_stream (proxy URLs)")
+    print("  Search list: /search_list (top N, không extract formats)")
     print("  New: /play (direct URLs)")
     print("  Integrated: /play_on_go2rtc (auto update go2rtc)")
+    print("  Transcode: /transcode (mp3/aac/opus qua ffmpeg)")
+
+    # Cache / index trên disk load ở process chính (import app.py không đụng tới disk)
+    for store in (range_cache, thumb_cache, query_index):
+        store.load()
+
+    # Import yt-dlp + spawn worker + extraction thử ở thread nền; server bind ngay
+    warmup.start()
+
+    if SERVER_MODE == "asgi":
+        try:
+            import uvicorn
+            asgi_app = make_asgi_app()
+        except ImportError as e:
+            print(f"ASGI mode unavailable ({e}), falling back to Flask threaded server")
+        else:
+            print("  Server mode: asgi (uvicorn)")
+            uvicorn.run(asgi_app, host="0.0.0.0", port=PORT, log_level="warning")
+            raise SystemExit(0)
+
+    print("  Server mode: flask (threaded)")
     app.run(host="0.0.0.0", port=PORT, threaded=True, debug=False)
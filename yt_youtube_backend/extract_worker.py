@@ -0,0 +1,34 @@
+"""
+Worker process của ExtractionPool (spawn). Module riêng, import không có side effect:
+process con chỉ cần module này + yt_dlp, không dựng lại cache / index / thread của app.py.
+"""
+import os
+
+
+def extraction_worker(conn, profiles, nice):
+    """
+    Vòng lặp của worker process: dựng sẵn một YoutubeDL cho mỗi profile
+    (load extractor một lần), sau đó nhận job (profile, ydl_opts, query) qua pipe.
+    """
+    try:
+        # Nhường CPU cho các thread đang stream /proxy
+        os.nice(nice)
+    except OSError:
+        pass
+
+    import yt_dlp
+
+    ydls = {name: yt_dlp.YoutubeDL(opts) for name, opts in profiles.items()}
+    while True:
+        try:
+            profile, opts, query = conn.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            ydl = ydls.get(profile)
+            if ydl is None:
+                ydl = ydls[profile] = yt_dlp.YoutubeDL(opts)
+            info = ydl.extract_info(query, download=False)
+            conn.send(("ok", ydl.sanitize_info(info)))
+        except Exception as e:
+            conn.send(("error", type(e).__name__, str(e)))